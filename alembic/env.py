@@ -0,0 +1,63 @@
+"""
+Entorno de Alembic: usa DATABASE_URL y los modelos de app.models.
+
+Cada migración va en su propia transacción (transaction_per_migration), así las
+que crean índices con CONCURRENTLY pueden salir de ella con autocommit_block().
+"""
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool
+
+from app.config import DATABASE_URL
+from app.db import Base
+from app import models  # noqa: F401  (registra las tablas en Base.metadata)
+
+config = context.config
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+target_metadata = Base.metadata
+
+# Índices que solo existen en Postgres (expresiones con COLLATE); fuera de los
+# modelos para que create_all funcione en SQLite. --autogenerate no debe borrarlos.
+POSTGRES_ONLY_INDEXES = {"ix_templates_s3_key_c", "ix_templates_with_images_s3_key_c"}
+
+
+def include_object(obj, name, type_, reflected, compare_to):
+    if type_ == "index" and reflected and name in POSTGRES_ONLY_INDEXES:
+        return False
+    return True
+
+
+def run_migrations_offline():
+    context.configure(
+        url=DATABASE_URL,
+        target_metadata=target_metadata,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+        include_object=include_object,
+        transaction_per_migration=True,
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    engine = create_engine(DATABASE_URL, poolclass=NullPool)
+    with engine.connect() as connection:
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            include_object=include_object,
+            transaction_per_migration=True,
+        )
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
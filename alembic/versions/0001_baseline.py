@@ -0,0 +1,61 @@
+"""Esquema inicial (el que creaba Base.metadata.create_all)
+
+Las bases de datos existentes ya tienen estas tablas: solo se crean las que faltan,
+así la migración sirve tanto para una BD nueva como para adoptar una en producción.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    existing = set(sa.inspect(op.get_bind()).get_table_names())
+
+    if "users" not in existing:
+        op.create_table(
+            "users",
+            sa.Column("id", sa.String(), primary_key=True),
+            sa.Column("email", sa.String(), nullable=False),
+            sa.Column("hashed_password", sa.String(), nullable=True),
+            sa.Column("full_name", sa.String(), nullable=True),
+            sa.Column("is_active", sa.Boolean(), nullable=True),
+            sa.Column("is_google", sa.Boolean(), nullable=True),
+        )
+        op.create_index("ix_users_id", "users", ["id"])
+        op.create_index("ix_users_email", "users", ["email"], unique=True)
+
+    if "templates" not in existing:
+        op.create_table(
+            "templates",
+            sa.Column("id", sa.String(), primary_key=True),
+            sa.Column("s3_key", sa.String(), nullable=False),
+            sa.Column("user_id", sa.String(), sa.ForeignKey("users.id"), nullable=True),
+            sa.Column("is_public", sa.Boolean(), nullable=True),
+        )
+        op.create_index("ix_templates_id", "templates", ["id"])
+        op.create_index("ix_templates_is_public", "templates", ["is_public"])
+
+    if "templates_with_images" not in existing:
+        op.create_table(
+            "templates_with_images",
+            sa.Column("id", sa.String(), primary_key=True),
+            sa.Column("s3_key", sa.String(), nullable=False),
+            sa.Column("user_id", sa.String(), sa.ForeignKey("users.id"), nullable=True),
+            sa.Column("template_id", sa.String(), sa.ForeignKey("templates.id"), nullable=False),
+        )
+        op.create_index("ix_templates_with_images_id", "templates_with_images", ["id"])
+
+
+def downgrade():
+    op.drop_table("templates_with_images")
+    op.drop_table("templates")
+    op.drop_table("users")
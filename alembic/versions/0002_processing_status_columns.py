@@ -0,0 +1,43 @@
+"""Estado del procesamiento en segundo plano (status y processing_*)
+
+Las filas existentes quedan con status NULL (la API las trata como 'done'). Si una
+columna ya existe (BD creada con create_all después de añadirla al modelo) no se toca.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+TABLES = ("templates", "templates_with_images")
+
+COLUMNS = (
+    ("status", sa.String),
+    ("processing_started_at", sa.DateTime),
+    ("processing_finished_at", sa.DateTime),
+    ("processing_error", sa.String),
+)
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+
+    for table in TABLES:
+        existing = {column["name"] for column in inspector.get_columns(table)}
+        for name, type_ in COLUMNS:
+            if name not in existing:
+                op.add_column(table, sa.Column(name, type_(), nullable=True))
+
+
+def downgrade():
+    for table in TABLES:
+        with op.batch_alter_table(table) as batch:
+            for name, _ in reversed(COLUMNS):
+                batch.drop_column(name)
@@ -0,0 +1,32 @@
+"""Formato de salida de cada imagen (content_type)
+
+Las filas existentes quedan con NULL: son anteriores al formato configurable (PNG).
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+TABLES = ("templates", "templates_with_images")
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+
+    for table in TABLES:
+        if "content_type" not in {column["name"] for column in inspector.get_columns(table)}:
+            op.add_column(table, sa.Column("content_type", sa.String(), nullable=True))
+
+
+def downgrade():
+    for table in TABLES:
+        with op.batch_alter_table(table) as batch:
+            batch.drop_column("content_type")
@@ -0,0 +1,32 @@
+"""Miniaturas generadas de cada imagen (renditions, "formato:ancho,ancho...")
+
+Las filas existentes quedan con NULL: no tienen miniaturas y se sirve el original.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+TABLES = ("templates", "templates_with_images")
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+
+    for table in TABLES:
+        if "renditions" not in {column["name"] for column in inspector.get_columns(table)}:
+            op.add_column(table, sa.Column("renditions", sa.String(), nullable=True))
+
+
+def downgrade():
+    for table in TABLES:
+        with op.batch_alter_table(table) as batch:
+            batch.drop_column("renditions")
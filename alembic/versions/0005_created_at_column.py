@@ -0,0 +1,49 @@
+"""Fecha de creación (created_at), clave de orden de los listados paginados
+
+Las filas existentes quedan con la fecha de la migración.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+TABLES = ("templates", "templates_with_images")
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+
+    for table in TABLES:
+        if "created_at" in {column["name"] for column in inspector.get_columns(table)}:
+            continue
+
+        if bind.dialect.name == "postgresql":
+            # Con un DEFAULT estable Postgres no reescribe la tabla: es inmediato
+            op.add_column(table, sa.Column("created_at", sa.DateTime(), nullable=False, server_default=sa.func.now()))
+        else:
+            # SQLite no admite ADD COLUMN con DEFAULT CURRENT_TIMESTAMP: se añade
+            # vacía, se rellena y se recrea la tabla con el DEFAULT y el NOT NULL
+            op.add_column(table, sa.Column("created_at", sa.DateTime(), nullable=True))
+            op.execute(sa.text(f"UPDATE {table} SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL"))
+            with op.batch_alter_table(table) as batch:
+                batch.alter_column(
+                    "created_at",
+                    existing_type=sa.DateTime(),
+                    nullable=False,
+                    server_default=sa.func.now()
+                )
+
+
+def downgrade():
+    for table in TABLES:
+        with op.batch_alter_table(table) as batch:
+            batch.drop_column("created_at")
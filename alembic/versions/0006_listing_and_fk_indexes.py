@@ -0,0 +1,66 @@
+"""Índices de los listados paginados, de template_id y de la limpieza por s3_key
+
+- (user_id, created_at, id): /templates/my y /my-with-images (paginate) y las
+  comprobaciones de propietario; también sirve para buscar por user_id.
+- (is_public, created_at, id): /templates/public.
+- template_id: plantillas referenciadas por imágenes (limpieza, borrados).
+- s3_key COLLATE "C", id (solo Postgres): el recorrido ordenado de perform_s3_cleanup.
+
+En Postgres se crean con CREATE INDEX CONCURRENTLY, fuera de la transacción de la
+migración: no bloquean escrituras y se pueden aplicar con la API en marcha. Si se
+interrumpe, el índice puede quedar INVALID: borrarlo (DROP INDEX CONCURRENTLY) y
+volver a ejecutar `alembic upgrade head`.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+INDEXES = (
+    ("ix_templates_user_id_created_at", "templates", ["user_id", "created_at", "id"]),
+    ("ix_templates_is_public_created_at", "templates", ["is_public", "created_at", "id"]),
+    ("ix_templates_with_images_user_id_created_at", "templates_with_images", ["user_id", "created_at", "id"]),
+    ("ix_templates_with_images_template_id", "templates_with_images", ["template_id"]),
+)
+
+# Mismo orden que list_objects_v2 (byte a byte), ver iter_record_keys
+POSTGRES_KEY_INDEXES = (
+    ("ix_templates_s3_key_c", "templates"),
+    ("ix_templates_with_images_s3_key_c", "templates_with_images"),
+)
+
+
+def upgrade():
+    if op.get_context().dialect.name != "postgresql":
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, if_not_exists=True)
+        return
+
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, postgresql_concurrently=True, if_not_exists=True)
+        for name, table in POSTGRES_KEY_INDEXES:
+            op.execute(sa.text(
+                f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} (s3_key COLLATE "C", id)'
+            ))
+
+
+def downgrade():
+    if op.get_context().dialect.name != "postgresql":
+        for name, table, _ in INDEXES:
+            op.drop_index(name, table_name=table, if_exists=True)
+        return
+
+    with op.get_context().autocommit_block():
+        for name, table in POSTGRES_KEY_INDEXES:
+            op.execute(sa.text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+        for name, table, _ in INDEXES:
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
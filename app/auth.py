@@ -1,50 +1,74 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Request
 from fastapi.responses import RedirectResponse, JSONResponse
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from app.db import get_db
 from app import models, schemas
-from app.utils import hash_password, verify_password, create_access_token, create_refresh_token, decode_token
+from app.utils import hash_password_async, verify_password_async, create_access_token, create_refresh_token, decode_token
 from app.config import GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET, GOOGLE_REDIRECT_URI, FRONTEND_URL
 from urllib.parse import urlencode
-from authlib.integrations.starlette_client import OAuth, OAuthError
+import threading
 import uuid
 import os
 
 router = APIRouter(prefix="/auth", tags=["auth"])
 
-oauth = OAuth()
 CONF_URL = 'https://accounts.google.com/.well-known/openid-configuration'
-oauth.register(
-    name='google',
-    client_id=GOOGLE_CLIENT_ID,
-    client_secret=GOOGLE_CLIENT_SECRET,
-    server_metadata_url=CONF_URL,
-    client_kwargs={'scope': 'openid email profile'}
-)
+
+# Authlib (y su cliente httpx) se cargan en el primer login con Google, no al
+# arrancar el worker
+_oauth = None
+_oauth_lock = threading.Lock()
+
+def get_oauth():
+    global _oauth
+    if _oauth is None:
+        with _oauth_lock:
+            if _oauth is None:
+                from authlib.integrations.starlette_client import OAuth
+
+                oauth = OAuth()
+                oauth.register(
+                    name='google',
+                    client_id=GOOGLE_CLIENT_ID,
+                    client_secret=GOOGLE_CLIENT_SECRET,
+                    server_metadata_url=CONF_URL,
+                    client_kwargs={'scope': 'openid email profile'}
+                )
+                _oauth = oauth
+    return _oauth
+
+def find_user_by_email(db: Session, email: str):
+    return db.query(models.User).filter(models.User.email == email).first()
+
+def save_user(db: Session, user: models.User):
+    db.add(user)
+    db.commit()
+    db.refresh(user)
 
 # Register user (email+password)
+# Las rutas con bcrypt son async: el hash va al executor de contraseñas y la BD al
+# threadpool, así ningún hilo del threadpool queda esperando a bcrypt
 @router.post("/register", response_model=schemas.UserOut)
-def register(user_in: schemas.UserCreate, db: Session = Depends(get_db)):
-    existing = db.query(models.User).filter(models.User.email == user_in.email).first()
+async def register(user_in: schemas.UserCreate, db: Session = Depends(get_db)):
+    existing = await run_in_threadpool(find_user_by_email, db, user_in.email)
     if existing:
         raise HTTPException(status_code=400, detail="Email already registered")
     user = models.User(
         id=str(uuid.uuid4()),
         email=user_in.email,
-        hashed_password=hash_password(user_in.password),
+        hashed_password=await hash_password_async(user_in.password),
         full_name=user_in.full_name,
         is_google=False
     )
-    db.add(user)
-    db.commit()
-    db.refresh(user)
+    await run_in_threadpool(save_user, db, user)
     return user
 
 # Login with email/password
 @router.post("/login", response_model=schemas.Token)
-def login(form_data: schemas.UserCreate, db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.email == form_data.email).first()
-    if not user or not user.hashed_password or not verify_password(form_data.password, user.hashed_password):
+async def login(form_data: schemas.UserCreate, db: Session = Depends(get_db)):
+    user = await run_in_threadpool(find_user_by_email, db, form_data.email)
+    if not user or not user.hashed_password or not await verify_password_async(form_data.password, user.hashed_password):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     access = create_access_token({"sub": str(user.id), "email": user.email})
     refresh = create_refresh_token({"sub": str(user.id), "email": user.email})
@@ -75,11 +99,14 @@ def refresh_token(payload: dict, db: Session = Depends(get_db)):
 async def google_login(request: Request):
     redirect_uri = GOOGLE_REDIRECT_URI
     # Authlib will create the authorization URL
-    return await oauth.google.authorize_redirect(request, redirect_uri)
+    return await get_oauth().google.authorize_redirect(request, redirect_uri)
 
 # Google callback - exchange code for tokens and create/find user
 @router.get("/google/callback")
 async def google_callback(request: Request, db: Session = Depends(get_db)):
+    from authlib.integrations.starlette_client import OAuthError
+
+    oauth = get_oauth()
     try:
         token = await oauth.google.authorize_access_token(request)
     except OAuthError as e:
@@ -0,0 +1,111 @@
+"""
+Caché en Redis de las respuestas de /templates/public.
+
+El catálogo público solo cambia cuando se crea o termina una plantilla pública o
+cuando se borra una, y lo piden todos los kioscos al arrancar. Cada página (sus
+filas, su ETag y el cursor de la siguiente) se guarda como un campo del hash
+`totem:catalogue:pages`, así que un acierto es un único HGET.
+
+Las filas se guardan sin URLs: con IMAGE_DELIVERY_MODE=presigned las firmas
+caducan mucho antes que la caché, así que la ruta las genera en cada respuesta.
+Con URLs estables (proxy, public) se guarda además el cuerpo ya serializado.
+
+Invalidar borra el hash e incrementa `totem:catalogue:version`. Quien rellena la
+caché lee la versión antes de consultar la BD y solo escribe si no ha cambiado:
+una consulta que empezó antes de invalidar no puede dejar una página vieja.
+
+Si Redis no responde, se va a la BD como si no hubiera caché.
+"""
+import hashlib
+import json
+
+from app.config import PUBLIC_CATALOGUE_CACHE_TTL
+from app.redis_client import redis_client, async_redis_client
+
+CACHE_KEY = "totem:catalogue:pages"
+VERSION_KEY = "totem:catalogue:version"
+
+# Guarda la página solo si la versión sigue siendo la leída antes de la consulta
+STORE_SCRIPT = async_redis_client.register_script("""
+if (redis.call('GET', KEYS[1]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[2], ARGV[2], ARGV[3])
+if redis.call('TTL', KEYS[2]) < 0 then
+    redis.call('EXPIRE', KEYS[2], ARGV[4])
+end
+return 1
+""")
+
+
+def page_field(cursor: str | None, limit: int) -> str:
+    return f"{limit}:{cursor or ''}"
+
+
+def make_entry(rows: list, next_cursor: str | None, content: str | None = None) -> dict:
+    """`rows` sin URLs; `content`, el cuerpo ya generado si sus URLs no caducan."""
+    serialized = json.dumps(rows, separators=(",", ":"))
+    etag = '"' + hashlib.sha256(serialized.encode("utf-8")).hexdigest()[:32] + '"'
+    return {"rows": rows, "content": content, "etag": etag, "next_cursor": next_cursor}
+
+
+async def get_page(field: str) -> dict | None:
+    try:
+        raw = await async_redis_client.hget(CACHE_KEY, field)
+    except Exception as e:
+        print(f"Catalogue cache: Redis error reading: {e}")
+        return None
+    return json.loads(raw) if raw else None
+
+
+async def current_version() -> str | None:
+    try:
+        version = await async_redis_client.get(VERSION_KEY)
+    except Exception as e:
+        print(f"Catalogue cache: Redis error reading version: {e}")
+        return None
+    return version.decode() if version else "0"
+
+
+async def store_page(field: str, entry: dict, version: str | None):
+    if version is None:
+        return
+    try:
+        await STORE_SCRIPT(
+            keys=[VERSION_KEY, CACHE_KEY],
+            args=[version, field, json.dumps(entry), PUBLIC_CATALOGUE_CACHE_TTL]
+        )
+    except Exception as e:
+        print(f"Catalogue cache: Redis error storing: {e}")
+
+
+def invalidate():
+    """Descarta todas las páginas cacheadas (API y worker)."""
+    try:
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.incr(VERSION_KEY)
+        pipe.delete(CACHE_KEY)
+        pipe.execute()
+    except Exception as e:
+        print(f"Catalogue cache: Redis error invalidating: {e}")
+
+
+async def invalidate_async():
+    """Como invalidate(), para las rutas async (no bloquea el event loop)."""
+    try:
+        pipe = async_redis_client.pipeline(transaction=True)
+        pipe.incr(VERSION_KEY)
+        pipe.delete(CACHE_KEY)
+        await pipe.execute()
+    except Exception as e:
+        print(f"Catalogue cache: Redis error invalidating: {e}")
+
+
+def stats() -> dict:
+    try:
+        return {
+            "cached_pages": redis_client.hlen(CACHE_KEY),
+            "version": int(redis_client.get(VERSION_KEY) or 0),
+        }
+    except Exception:
+        return {"cached_pages": None, "version": None}
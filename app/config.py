@@ -1,4 +1,5 @@
 from dotenv import load_dotenv
+from sqlalchemy.engine import make_url
 import os
 
 load_dotenv()
@@ -11,6 +12,40 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("ERROR: La variable de entorno DATABASE_URL no está configurada.")
 
+# Motor asíncrono de las rutas async: por defecto la misma BD con el driver asyncpg
+# (aiosqlite para SQLite en local). Los parámetros de la URL son del driver: de los de
+# psycopg2 solo se traduce sslmode (asyncpg lo llama ssl); con cualquier otro hay que
+# dar DATABASE_ASYNC_URL a mano.
+ASYNCPG_QUERY_ARGS = {"sslmode": "ssl", "ssl": "ssl"}
+
+DATABASE_ASYNC_URL = os.getenv("DATABASE_ASYNC_URL")
+if not DATABASE_ASYNC_URL:
+    sync_url = make_url(DATABASE_URL)
+    backend = sync_url.drivername.split("+")[0]
+    if backend in ("postgres", "postgresql"):
+        unsupported = sorted(set(sync_url.query) - set(ASYNCPG_QUERY_ARGS))
+        if unsupported:
+            raise ValueError(
+                "ERROR: DATABASE_URL lleva parámetros que asyncpg no admite "
+                f"({', '.join(unsupported)}); configura DATABASE_ASYNC_URL."
+            )
+        async_url = sync_url.set(
+            drivername="postgresql+asyncpg",
+            query={ASYNCPG_QUERY_ARGS[name]: value for name, value in sync_url.query.items()}
+        )
+    elif backend == "sqlite":
+        async_url = sync_url.set(drivername="sqlite+aiosqlite")
+    else:
+        raise ValueError("ERROR: Configura DATABASE_ASYNC_URL (no se puede deducir de DATABASE_URL).")
+    DATABASE_ASYNC_URL = async_url.render_as_string(hide_password=False)
+
+# Pool de conexiones de cada motor, por worker de gunicorn
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 5))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("true", "1", "t")
+
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
 GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
 GOOGLE_REDIRECT_URI = os.getenv("GOOGLE_REDIRECT_URI")
@@ -23,6 +58,89 @@ S3_REGION = os.getenv("S3_REGION", "us-east-1")
 S3_USE_SSL = os.getenv("S3_USE_SSL", "true").lower() in ("true", "1", "t")
 S3_ACCESS_KEY = os.getenv("S3_ACCESS_KEY")
 S3_SECRET_KEY = os.getenv("S3_SECRET_KEY")
+S3_PUBLIC_ENDPOINT = os.getenv("S3_PUBLIC_ENDPOINT")
+S3_PRESIGNED_URL_EXPIRES = int(os.getenv("S3_PRESIGNED_URL_EXPIRES", 900))
+# Conexiones HTTP a S3 por proceso (y hilos del executor de S3 de las rutas async)
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", 50))
+# Plazos de conexión/lectura de cada petición a S3 e intentos (botocore reintenta con backoff)
+S3_CONNECT_TIMEOUT_SECONDS = float(os.getenv("S3_CONNECT_TIMEOUT_SECONDS", 5))
+S3_READ_TIMEOUT_SECONDS = float(os.getenv("S3_READ_TIMEOUT_SECONDS", 30))
+S3_MAX_ATTEMPTS = int(os.getenv("S3_MAX_ATTEMPTS", 3))
+
+# proxy: las imágenes pasan por /templates/image (con CORS)
+# presigned: URLs firmadas de S3 de corta duración
+# public: URLs directas al bucket (objetos subidos con ACL public-read)
+IMAGE_DELIVERY_MODE = os.getenv("IMAGE_DELIVERY_MODE", "proxy").lower()
+if IMAGE_DELIVERY_MODE not in ("proxy", "presigned", "public"):
+    raise ValueError("ERROR: IMAGE_DELIVERY_MODE debe ser 'proxy', 'presigned' o 'public'.")
+
+IMAGE_STREAM_CHUNK_SIZE = int(os.getenv("IMAGE_STREAM_CHUNK_SIZE", 64 * 1024))
+IMAGE_CACHE_CONTROL = os.getenv("IMAGE_CACHE_CONTROL", "public, max-age=31536000, immutable")
+
+IMAGE_CACHE_MEMORY_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MEMORY_MAX_BYTES", 64 * 1024 * 1024))
+# Los borrados se avisan a todos los workers por pub/sub; el TTL acota lo que dura
+# una entrada en memoria si se pierde algún aviso (Redis caído o reconectando)
+IMAGE_CACHE_MEMORY_TTL = float(os.getenv("IMAGE_CACHE_MEMORY_TTL", 300))
+IMAGE_CACHE_DISK_DIR = os.getenv("IMAGE_CACHE_DISK_DIR", "/tmp/totem-image-cache")
+IMAGE_CACHE_DISK_MAX_BYTES = int(os.getenv("IMAGE_CACHE_DISK_MAX_BYTES", 1024 * 1024 * 1024))
+# Caducidad de las entradas en disco: acota cuánto puede servirse una imagen borrada
+# si su aviso de invalidación no llegó a esta máquina
+IMAGE_CACHE_DISK_TTL = float(os.getenv("IMAGE_CACHE_DISK_TTL", 3600))
+IMAGE_CACHE_MAX_ITEM_BYTES = int(os.getenv("IMAGE_CACHE_MAX_ITEM_BYTES", 8 * 1024 * 1024))
+
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", 64_000_000))
+
+# Tamaño máximo de una subida (foto o referencia) y parte de ella que el worker
+# mantiene en memoria al leerla de S3 antes de pasar a disco
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 25 * 1024 * 1024))
+UPLOAD_SPOOL_MAX_MEMORY = int(os.getenv("UPLOAD_SPOOL_MAX_MEMORY", 1024 * 1024))
+
+# Codificación de las imágenes generadas. Las fotos integradas son opacas:
+# png, jpeg, webp o avif. Las plantillas necesitan alfa y se guardan siempre en PNG.
+RESULT_IMAGE_FORMAT = os.getenv("RESULT_IMAGE_FORMAT", "webp").lower()
+if RESULT_IMAGE_FORMAT not in ("png", "jpeg", "webp", "avif"):
+    raise ValueError("ERROR: RESULT_IMAGE_FORMAT debe ser 'png', 'jpeg', 'webp' o 'avif'.")
+RESULT_IMAGE_QUALITY = int(os.getenv("RESULT_IMAGE_QUALITY", 85))
+TEMPLATE_PNG_COMPRESS_LEVEL = int(os.getenv("TEMPLATE_PNG_COMPRESS_LEVEL", 6))
+
+# Miniaturas que se generan junto a cada imagen (anchos en px) para las galerías
+RENDITION_WIDTHS = [int(w) for w in os.getenv("RENDITION_WIDTHS", "240,540").split(",") if w.strip()]
+RENDITION_FORMAT = os.getenv("RENDITION_FORMAT", "webp").lower()
+if RENDITION_FORMAT not in ("png", "jpeg", "webp", "avif"):
+    raise ValueError("ERROR: RENDITION_FORMAT debe ser 'png', 'jpeg', 'webp' o 'avif'.")
+RENDITION_QUALITY = int(os.getenv("RENDITION_QUALITY", 80))
+
+# Plantillas decodificadas que el worker mantiene en memoria (1080x1350 RGBA ~ 5.6 MB)
+FRAME_CACHE_MAX_BYTES = int(os.getenv("FRAME_CACHE_MAX_BYTES", 128 * 1024 * 1024))
+
+# Elementos por página en los listados (/templates/my, /my-with-images, /public)
+LIST_PAGE_SIZE = int(os.getenv("LIST_PAGE_SIZE", 50))
+LIST_MAX_PAGE_SIZE = int(os.getenv("LIST_MAX_PAGE_SIZE", 200))
+
+# Caducidad de las páginas de /templates/public en Redis (se invalidan al cambiar el catálogo)
+PUBLIC_CATALOGUE_CACHE_TTL = int(os.getenv("PUBLIC_CATALOGUE_CACHE_TTL", 3600))
+
+# Registros por lote en la limpieza de huérfanos (páginas de lectura por s3_key y borrados con commit)
+CLEANUP_BATCH_SIZE = int(os.getenv("CLEANUP_BATCH_SIZE", 1000))
+
+# Recolección de objetos huérfanos en S3: antigüedad mínima para borrar un objeto,
+# duración de cada tramo lanzado por el cron y modo de prueba (solo contar). El modo
+# de prueba viene activado: hay que desactivarlo explícitamente para borrar objetos
+GC_GRACE_SECONDS = int(os.getenv("GC_GRACE_SECONDS", 24 * 3600))
+GC_SLICE_SECONDS = float(os.getenv("GC_SLICE_SECONDS", 60))
+GC_DRY_RUN = os.getenv("GC_DRY_RUN", "true").lower() in ("true", "1", "t")
+
+# Hilos para bcrypt (registro y login) y llamadas que pueden esperar en cola antes de
+# responder 503 con Retry-After
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", min(4, os.cpu_count() or 1)))
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", 32))
+PASSWORD_HASH_RETRY_AFTER_SECONDS = int(os.getenv("PASSWORD_HASH_RETRY_AFTER_SECONDS", 2))
+
+# Caché de usuarios autenticados (get_current_user): por worker, y opcionalmente en Redis
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", 30))
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", 10000))
+USER_CACHE_REDIS = os.getenv("USER_CACHE_REDIS", "false").lower() in ("true", "1", "t")
+USER_CACHE_REDIS_TTL = int(os.getenv("USER_CACHE_REDIS_TTL", 300))
 
 URL_PRODUCTION = os.getenv("URL_PRODUCTION", "http://localhost:5005")
 
@@ -33,3 +151,59 @@ if not REDIS_URL:
     raise ValueError("ERROR: La variable de entorno REDIS_URL no está configurada.")
 
 RATE_LIMIT_GLOBAL = os.getenv("RATE_LIMIT_GLOBAL", "6/minute")
+
+JOB_QUEUE_NAME = os.getenv("JOB_QUEUE_NAME", "totem:jobs")
+JOB_WORKER_CONCURRENCY = int(os.getenv("JOB_WORKER_CONCURRENCY", 4))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+JOB_RETRY_BACKOFF_SECONDS = float(os.getenv("JOB_RETRY_BACKOFF_SECONDS", 5))
+JOB_RETRY_BACKOFF_MAX_SECONDS = float(os.getenv("JOB_RETRY_BACKOFF_MAX_SECONDS", 300))
+# Un trabajo se da por perdido (worker muerto) si pasa JOB_TIMEOUT_SECONDS sin que el
+# worker renueve su plazo; mientras se ejecuta lo renueva cada JOB_HEARTBEAT_SECONDS
+JOB_TIMEOUT_SECONDS = int(os.getenv("JOB_TIMEOUT_SECONDS", 600))
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", 30))
+if JOB_HEARTBEAT_SECONDS * 3 > JOB_TIMEOUT_SECONDS:
+    raise ValueError("ERROR: JOB_HEARTBEAT_SECONDS debe ser como mucho un tercio de JOB_TIMEOUT_SECONDS.")
+JOB_POLL_INTERVAL_SECONDS = float(os.getenv("JOB_POLL_INTERVAL_SECONDS", 0.5))
+JOB_RESULT_TTL_SECONDS = int(os.getenv("JOB_RESULT_TTL_SECONDS", 7 * 24 * 3600))
+JOB_EVENTS_TIMEOUT_SECONDS = int(os.getenv("JOB_EVENTS_TIMEOUT_SECONDS", 300))
+JOB_EVENTS_KEEPALIVE_SECONDS = float(os.getenv("JOB_EVENTS_KEEPALIVE_SECONDS", 15))
+
+# Gemini: llamadas simultáneas como máximo entre todos los workers (semáforo en Redis),
+# espera máxima por un hueco y plazo de cada llamada (pasado el plazo el hueco se libera)
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash-image")
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", 4))
+GEMINI_SLOT_WAIT_SECONDS = float(os.getenv("GEMINI_SLOT_WAIT_SECONDS", 120))
+GEMINI_CALL_LEASE_SECONDS = float(os.getenv("GEMINI_CALL_LEASE_SECONDS", 180))
+# Resultados cacheados en S3 por hash de (modelo, prompt, imágenes); vacío para desactivar
+GEMINI_CACHE_PREFIX = os.getenv("GEMINI_CACHE_PREFIX", "gemini-cache")
+
+# Plazo de cada llamada a Gemini e intentos dentro de un mismo trabajo
+GEMINI_TIMEOUT_SECONDS = float(os.getenv("GEMINI_TIMEOUT_SECONDS", 120))
+GEMINI_MAX_ATTEMPTS = int(os.getenv("GEMINI_MAX_ATTEMPTS", 3))
+GEMINI_RETRY_BACKOFF_SECONDS = float(os.getenv("GEMINI_RETRY_BACKOFF_SECONDS", 2))
+GEMINI_RETRY_BACKOFF_MAX_SECONDS = float(os.getenv("GEMINI_RETRY_BACKOFF_MAX_SECONDS", 30))
+
+# El hueco de cada intento caduca a los GEMINI_CALL_LEASE_SECONDS: debe cubrir la llamada
+if GEMINI_CALL_LEASE_SECONDS <= GEMINI_TIMEOUT_SECONDS:
+    raise ValueError("ERROR: GEMINI_CALL_LEASE_SECONDS debe ser mayor que GEMINI_TIMEOUT_SECONDS.")
+
+# Quien espera a una petición igual en curso lo hace como mucho este tiempo (avisado
+# por Redis al terminar); después el trabajo se reintenta y libera el hilo del worker
+GEMINI_COALESCE_WAIT_SECONDS = float(os.getenv("GEMINI_COALESCE_WAIT_SECONDS", 60))
+if GEMINI_COALESCE_WAIT_SECONDS <= 0:
+    raise ValueError("ERROR: GEMINI_COALESCE_WAIT_SECONDS debe ser mayor que 0.")
+
+# Días que se conservan los resultados cacheados de Gemini: la recolección de S3
+# borra los más antiguos (0 para conservarlos siempre)
+GEMINI_CACHE_TTL_DAYS = int(os.getenv("GEMINI_CACHE_TTL_DAYS", 30))
+if GEMINI_CACHE_TTL_DAYS < 0:
+    raise ValueError("ERROR: GEMINI_CACHE_TTL_DAYS no puede ser negativo.")
+
+# Circuit breakers (Gemini y S3): se abren con CIRCUIT_FAILURE_THRESHOLD fallos en
+# CIRCUIT_FAILURE_WINDOW_SECONDS y se vuelven a probar tras CIRCUIT_RESET_SECONDS
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))
+CIRCUIT_FAILURE_WINDOW_SECONDS = float(os.getenv("CIRCUIT_FAILURE_WINDOW_SECONDS", 60))
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", 30))
+
+# Imprime la tabla de rutas al arrancar cada worker (útil en desarrollo)
+PRINT_ROUTES = os.getenv("PRINT_ROUTES", "false").lower() in ("true", "1", "t")
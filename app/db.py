@@ -1,14 +1,117 @@
-from sqlalchemy import create_engine
+"""
+Motores de base de datos.
+
+- engine / SessionLocal / get_db: motor síncrono (psycopg2), para las rutas sync,
+  el worker y las tareas en segundo plano.
+- async_engine / AsyncSessionLocal / get_async_db: motor asíncrono (asyncpg), para
+  las rutas async: la BD no bloquea el event loop ni ocupa hilos del threadpool.
+
+Cada worker de gunicorn tiene sus propios pools: el máximo de conexiones a Postgres
+es workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) por motor que se use (el asíncrono
+no abre conexiones hasta la primera petición que lo usa).
+
+Los pools miden cuánto se espera para obtener una conexión (/templates/admin/stats):
+si la espera crece, faltan conexiones o sobran workers.
+"""
+import threading
+import time
+from collections import deque
+
+from sqlalchemy import create_engine, exc
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
-from app.config import DATABASE_URL
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from app.config import (
+    DATABASE_URL,
+    DATABASE_ASYNC_URL,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    DB_POOL_TIMEOUT,
+    DB_POOL_RECYCLE,
+    DB_POOL_PRE_PING
+)
+
+
+class TimedPoolMixin:
+    """Mide la espera de cada checkout (incluye abrir la conexión y el pre-ping)."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._metrics_lock = threading.Lock()
+        self._waits = deque(maxlen=1024)  # Esperas recientes (s), para percentiles
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            connection = super().connect()
+        except exc.TimeoutError:
+            with self._metrics_lock:
+                self.timeouts += 1
+            raise
+        wait = time.perf_counter() - started
+        with self._metrics_lock:
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self._waits.append(wait)
+        return connection
+
+    def stats(self) -> dict:
+        with self._metrics_lock:
+            waits = sorted(self._waits)
+            checkouts = self.checkouts
+            return {
+                "size": self.size(),
+                "checked_out": self.checkedout(),
+                "overflow": self.overflow(),
+                "checked_in": self.checkedin(),
+                "checkouts": checkouts,
+                "timeouts": self.timeouts,
+                "wait_ms_avg": round(self.total_wait / checkouts * 1000, 2) if checkouts else 0.0,
+                "wait_ms_p95": round(waits[int(len(waits) * 0.95)] * 1000, 2) if waits else 0.0,
+                "wait_ms_max": round(self.max_wait * 1000, 2),
+            }
+
 
-engine = create_engine(DATABASE_URL)
+class TimedQueuePool(TimedPoolMixin, QueuePool):
+    pass
+
+
+class TimedAsyncQueuePool(TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+pool_options = dict(
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING
+)
+
+engine = create_engine(DATABASE_URL, poolclass=TimedQueuePool, **pool_options)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# Con expire_on_commit=False los objetos siguen legibles tras el commit sin
+# recargarse (en async no se puede cargar un atributo de forma implícita)
+async_engine = create_async_engine(DATABASE_ASYNC_URL, poolclass=TimedAsyncQueuePool, **pool_options)
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+def pool_stats() -> dict:
+    return {"sync": engine.pool.stats(), "async": async_engine.pool.stats()}
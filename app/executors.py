@@ -0,0 +1,107 @@
+"""
+Executors dedicados para trabajo bloqueante desde rutas async, con métricas.
+
+El threadpool genérico de anyio (40 hilos) lo comparten todas las rutas sync: un
+trabajo lento o una ráfaga (llamadas a S3, bcrypt...) deja al resto esperando
+por un hilo. Cada tipo de trabajo tiene su executor, de tamaño fijo, y mide la
+espera en cola y la duración de cada llamada para /templates/admin/stats.
+
+Con `max_queue`, si ya hay ese número de llamadas esperando, run() rechaza la
+nueva con ExecutorSaturatedError en lugar de encolarla (la ruta responde 503).
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ExecutorSaturatedError(RuntimeError):
+    """La cola del executor está llena; reintentar en unos segundos."""
+
+
+def _percentile(values: list, fraction: float) -> float:
+    return round(values[min(int(len(values) * fraction), len(values) - 1)] * 1000, 2) if values else 0.0
+
+
+class MeteredExecutor:
+    """ThreadPoolExecutor con límite de cola y métricas de espera y ejecución."""
+
+    def __init__(self, max_workers: int, name: str, max_queue: int | None = None, window: int = 1024):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._waits = deque(maxlen=window)     # Esperas recientes en cola (s), para percentiles
+        self._runtimes = deque(maxlen=window)  # Duraciones recientes (s)
+        self.calls = 0
+        self.rejected = 0
+        self.in_flight = 0
+        self.queued = 0
+        self.max_wait = 0.0
+        self.total_wait = 0.0
+
+    async def run(self, fn, *args, **kwargs):
+        """Ejecuta `fn(*args, **kwargs)` en el executor y espera su resultado."""
+        submitted = time.perf_counter()
+        dequeued = False
+        with self._lock:
+            # Solo se rechaza si además todos los hilos están ocupados
+            if self.max_queue is not None and self.queued >= self.max_queue and self.in_flight >= self.max_workers:
+                self.rejected += 1
+                raise ExecutorSaturatedError(f"{self.name} executor saturated ({self.queued} queued)")
+            self.queued += 1
+
+        def leave_queue() -> bool:
+            nonlocal dequeued
+            if dequeued:
+                return False
+            dequeued = True
+            self.queued -= 1
+            return True
+
+        def call():
+            started = time.perf_counter()
+            wait = started - submitted
+            with self._lock:
+                leave_queue()
+                self.in_flight += 1
+                self.calls += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                self._waits.append(wait)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+                    self._runtimes.append(time.perf_counter() - started)
+
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._executor, call)
+        finally:
+            # Petición cancelada antes de llegar a ejecutarse
+            with self._lock:
+                leave_queue()
+
+    def stats(self) -> dict:
+        with self._lock:
+            waits = sorted(self._waits)
+            runtimes = sorted(self._runtimes)
+            calls = self.calls
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "in_flight": self.in_flight,
+                "queued": self.queued,
+                "calls": calls,
+                "rejected": self.rejected,
+                "wait_ms_avg": round(self.total_wait / calls * 1000, 2) if calls else 0.0,
+                "wait_ms_p50": _percentile(waits, 0.5),
+                "wait_ms_p95": _percentile(waits, 0.95),
+                "wait_ms_max": round(self.max_wait * 1000, 2),
+                "run_ms_p50": _percentile(runtimes, 0.5),
+                "run_ms_p95": _percentile(runtimes, 0.95),
+            }
@@ -0,0 +1,303 @@
+"""
+Pasarela de las llamadas a Gemini (utils.process_with_gemini) para el worker.
+
+- Caché de resultados en S3, con clave hash(modelo, prompt, píxeles de las imágenes):
+  repetir un prompt o volver a subir la misma referencia no llama al modelo.
+- Agrupación de peticiones en curso: si otro hilo o worker ya está generando lo
+  mismo, se espera a su aviso por Redis (pub/sub) y se lee el resultado de la caché
+  en lugar de repetirlo. La espera tiene un tope (GEMINI_COALESCE_WAIT_SECONDS).
+- Semáforo global en Redis: como mucho GEMINI_MAX_CONCURRENCY llamadas a la vez
+  entre todos los workers, para no agotar la cuota del proveedor en una ráfaga.
+
+Claves en Redis (prefijo "totem:gemini"):
+    :slots             zset titular -> fin del plazo (huecos del semáforo)
+    :inflight:{hash}   titular de la generación en curso de ese resultado (la renueva
+                       mientras genera, reintentos incluidos)
+    :stats             contadores (hits, misses, coalesced, slot_waits...)
+    :done:{hash}       canal en el que el titular avisa al terminar (con o sin éxito)
+"""
+import hashlib
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from io import BytesIO
+
+from PIL import Image
+
+from app import utils
+from app.config import (
+    S3_BUCKET_NAME,
+    GEMINI_MODEL,
+    GEMINI_MAX_CONCURRENCY,
+    GEMINI_SLOT_WAIT_SECONDS,
+    GEMINI_CALL_LEASE_SECONDS,
+    GEMINI_CACHE_PREFIX,
+    GEMINI_MAX_ATTEMPTS,
+    GEMINI_RETRY_BACKOFF_SECONDS,
+    GEMINI_RETRY_BACKOFF_MAX_SECONDS,
+    GEMINI_COALESCE_WAIT_SECONDS
+)
+from app.redis_client import redis_client
+from app.resilience import CircuitBreaker, call_with_retry
+from app.storage import s3
+
+KEY_PREFIX = "totem:gemini"
+SLOTS_KEY = f"{KEY_PREFIX}:slots"
+STATS_KEY = f"{KEY_PREFIX}:stats"
+
+POLL_INTERVAL_SECONDS = 0.5
+
+# Compartido con la API: con el breaker abierto no se aceptan trabajos que usan Gemini
+gemini_breaker = CircuitBreaker("gemini")
+
+# Ocupa un hueco si hay alguno libre (los de plazo vencido se liberan antes)
+ACQUIRE_SLOT_SCRIPT = redis_client.register_script("""
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('ZADD', KEYS[1], ARGV[3], ARGV[4])
+    return 1
+end
+return 0
+""")
+
+# Borra la clave solo si sigue siendo nuestra
+RELEASE_SCRIPT = redis_client.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+# Alarga el plazo de la clave solo si sigue siendo nuestra
+EXTEND_SCRIPT = redis_client.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+
+class GeminiBusyError(RuntimeError):
+    """No hubo hueco libre a tiempo; el trabajo se reintenta más tarde."""
+
+
+def _count(field: str):
+    try:
+        redis_client.hincrby(STATS_KEY, field, 1)
+    except Exception:
+        pass
+
+
+def stats() -> dict:
+    raw = redis_client.hgetall(STATS_KEY)
+    counters = {k.decode(): int(v) for k, v in raw.items()}
+    counters["max_concurrency"] = GEMINI_MAX_CONCURRENCY
+    counters["active_calls"] = redis_client.zcount(SLOTS_KEY, time.time(), "+inf")
+    return counters
+
+
+def request_hash(prompt: str, images) -> str:
+    """Hash del contenido de la petición: modelo, prompt y píxeles de cada imagen."""
+    digest = hashlib.sha256()
+    digest.update(GEMINI_MODEL.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(prompt.encode("utf-8"))
+    for img in images:
+        digest.update(f"\0{img.mode}:{img.width}x{img.height}\0".encode("ascii"))
+        digest.update(img.tobytes())
+    return digest.hexdigest()
+
+
+def cache_key(digest: str) -> str:
+    return f"{GEMINI_CACHE_PREFIX}/{digest}.png"
+
+
+def _read_cached(digest: str) -> Image.Image | None:
+    try:
+        obj = s3.get_object(Bucket=S3_BUCKET_NAME, Key=cache_key(digest))
+    except s3.exceptions.NoSuchKey:
+        return None
+    with obj["Body"] as body:
+        img = Image.open(BytesIO(body.read()))
+        img.load()
+    return img
+
+
+def _store_cached(digest: str, img: Image.Image):
+    buffer = BytesIO()
+    # Sin pérdida: el resultado se vuelve a procesar (ventana, resize) al usarlo
+    img.save(buffer, format="PNG", compress_level=1)
+    buffer.seek(0)
+    s3.put_object(Bucket=S3_BUCKET_NAME, Key=cache_key(digest), Body=buffer, ContentType="image/png")
+
+
+def _acquire_slot(holder: str):
+    deadline = time.monotonic() + GEMINI_SLOT_WAIT_SECONDS
+    waited = False
+    while True:
+        now = time.time()
+        if ACQUIRE_SLOT_SCRIPT(
+            keys=[SLOTS_KEY],
+            args=[now, GEMINI_MAX_CONCURRENCY, now + GEMINI_CALL_LEASE_SECONDS, holder]
+        ):
+            return
+        if not waited:
+            waited = True
+            _count("slot_waits")
+        if time.monotonic() >= deadline:
+            _count("slot_timeouts")
+            raise GeminiBusyError(f"No Gemini slot free after {GEMINI_SLOT_WAIT_SECONDS:.0f}s")
+        time.sleep(POLL_INTERVAL_SECONDS)
+
+
+def is_outage(error: Exception) -> bool:
+    """Errores que indican que Gemini no está disponible (cuentan para el breaker)."""
+    from google.genai import errors as genai_errors  # ya cargado: solo llega aquí tras llamar a Gemini
+
+    if isinstance(error, (utils.GeminiNoImageError, GeminiBusyError)):
+        return False
+    if isinstance(error, genai_errors.ClientError):
+        # 429 (cuota) y errores de autenticación sí; una petición inválida no
+        return error.code in (401, 403, 429)
+    return True
+
+
+def is_retryable(error: Exception) -> bool:
+    from google.genai import errors as genai_errors
+
+    if isinstance(error, genai_errors.ClientError):
+        return error.code == 429
+    return not isinstance(error, GeminiBusyError)
+
+
+def _call_model_once(prompt: str, base_image: Image.Image, other_image: Image.Image | None) -> Image.Image:
+    holder = uuid.uuid4().hex
+    _acquire_slot(holder)
+    try:
+        _count("model_calls")
+        img = utils.process_with_gemini(prompt, base_image, other_image)
+        img.load()
+        return img
+    finally:
+        redis_client.zrem(SLOTS_KEY, holder)
+
+
+def _call_model(prompt: str, base_image: Image.Image, other_image: Image.Image | None) -> Image.Image:
+    """Llamada con reintentos (backoff con jitter) y breaker; el hueco se libera entre intentos."""
+    return call_with_retry(
+        lambda: _call_model_once(prompt, base_image, other_image),
+        breaker=gemini_breaker,
+        attempts=GEMINI_MAX_ATTEMPTS,
+        base_delay=GEMINI_RETRY_BACKOFF_SECONDS,
+        max_delay=GEMINI_RETRY_BACKOFF_MAX_SECONDS,
+        is_failure=is_outage,
+        is_retryable=is_retryable
+    )
+
+
+@contextmanager
+def _keep_inflight(key: str, holder: str, lease_ms: int):
+    """
+    Renueva la marca de generación en curso cada tercio de su plazo mientras dura el
+    bloque: con los reintentos, una generación puede durar mucho más que el plazo y,
+    si caducara, otro worker repetiría la llamada. Si el proceso muere, caduca sola.
+    """
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(lease_ms / 3000):
+            try:
+                if not EXTEND_SCRIPT(keys=[key], args=[holder, lease_ms]):
+                    return  # Ya no es nuestra
+            except Exception as e:
+                print(f"Error renewing Gemini in-flight marker: {e}")
+
+    thread = threading.Thread(target=renew, name="gemini-inflight", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+
+
+def _wait_for_holder(pubsub, inflight_key: str, deadline: float):
+    """
+    Espera a que el titular de la marca avise de que terminó. Sin aviso, solo se
+    comprueba en Redis que su marca sigue viva (si el proceso murió, caduca): S3 no
+    se vuelve a leer hasta que hay algo nuevo que leer.
+    """
+    while redis_client.exists(inflight_key):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            _count("coalesce_timeouts")
+            raise GeminiBusyError(
+                f"Identical Gemini request still running after {GEMINI_COALESCE_WAIT_SECONDS:.0f}s"
+            )
+        if pubsub.get_message(timeout=min(remaining, 1.0)) is not None:
+            return
+
+
+def generate_image(prompt: str, base_image: Image.Image, other_image: Image.Image | None = None) -> Image.Image:
+    """
+    Igual que utils.process_with_gemini, pero pasando por la caché, la agrupación
+    de peticiones iguales en curso y el semáforo global.
+    """
+    if not GEMINI_CACHE_PREFIX:
+        return _call_model(prompt, base_image, other_image)
+
+    images = [base_image] + ([other_image] if other_image else [])
+    digest = request_hash(prompt, images)
+    inflight_key = f"{KEY_PREFIX}:inflight:{digest}"
+    holder = uuid.uuid4().hex
+    done_channel = f"{KEY_PREFIX}:done:{digest}"
+    lease_ms = int((GEMINI_SLOT_WAIT_SECONDS + GEMINI_CALL_LEASE_SECONDS) * 1000)
+    deadline = time.monotonic() + GEMINI_COALESCE_WAIT_SECONDS
+    coalesced = False
+    pubsub = None
+
+    try:
+        while True:
+            cached = _read_cached(digest)
+            if cached is not None:
+                _count("coalesced" if coalesced else "hits")
+                return cached
+
+            # Quien consigue la marca genera; el resto espera su aviso y vuelve a mirar
+            # la caché. Si el que generaba falla, avisa igual (o su marca caduca) y otro
+            # lo intenta.
+            if redis_client.set(inflight_key, holder, nx=True, px=lease_ms):
+                break
+            if pubsub is None:
+                # Suscrito antes de volver a mirar: un aviso de ahora no se pierde
+                pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(done_channel)
+                continue
+            coalesced = True
+            _wait_for_holder(pubsub, inflight_key, deadline)
+    finally:
+        if pubsub is not None:
+            pubsub.close()
+
+    try:
+        # Pudo terminar otro justo entre la lectura de la caché y la marca
+        cached = _read_cached(digest)
+        if cached is not None:
+            _count("coalesced" if coalesced else "hits")
+            return cached
+
+        _count("misses")
+        with _keep_inflight(inflight_key, holder, lease_ms):
+            img = _call_model(prompt, base_image, other_image)
+            try:
+                _store_cached(digest, img)
+            except Exception as e:
+                print(f"Error caching Gemini result {digest}: {e}")
+        return img
+    finally:
+        RELEASE_SCRIPT(keys=[inflight_key], args=[holder])
+        try:
+            redis_client.publish(done_channel, holder)
+        except Exception as e:
+            print(f"Error notifying Gemini waiters for {digest}: {e}")
@@ -0,0 +1,365 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+
+class CachedImage(NamedTuple):
+    data: bytes
+    content_type: str
+    etag: Optional[str]
+    last_modified: Optional[str]  # Fecha HTTP ya formateada
+
+
+class ByteLRU:
+    """
+    LRU en memoria acotada por el total de bytes almacenados (no por número de entradas).
+    Es segura entre hilos. Con `ttl` las entradas caducan pasado ese tiempo en segundos.
+    """
+
+    def __init__(self, max_bytes: int, ttl: Optional[float] = None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.evictions = 0
+        self._items = OrderedDict()  # key -> (value, size, stored_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            value, size, stored_at = item
+            if self.ttl and time.monotonic() - stored_at > self.ttl:
+                self._remove(key)
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value, size: int) -> bool:
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            self._remove(key)
+            self._items[key] = (value, size, time.monotonic())
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._items))
+                self._remove(oldest)
+                self.evictions += 1
+        return True
+
+    def pop(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._bytes -= item[1]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._items),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+            }
+
+
+class DiskCache:
+    """
+    Caché en disco local con expulsión por tamaño (los ficheros usados hace más tiempo
+    se borran primero). Puede compartirse entre los workers de gunicorn de una máquina:
+    las escrituras son atómicas (fichero temporal + os.replace).
+
+    Cada entrada es un único fichero: una línea JSON con los metadatos (incluida la
+    hora en que se guardó) y, a continuación, los bytes de la imagen. Con `ttl` las
+    entradas caducan pasado ese tiempo en segundos (la mtime no sirve: marca el uso).
+    """
+
+    def __init__(self, directory: str, max_bytes: int, ttl: Optional[float] = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.evictions = 0
+        self._bytes = None  # Estimación local; se recalcula al expulsar
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def get(self, key: str) -> Optional[CachedImage]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                meta = json.loads(f.readline())
+                if self.ttl and time.time() - meta.get("stored_at", 0) > self.ttl:
+                    expired = True
+                else:
+                    expired = False
+                    data = f.read()
+            if expired:
+                self.pop(key)
+                return None
+            os.utime(path)  # Marca de uso para la expulsión LRU
+        except (OSError, ValueError):
+            return None
+        return CachedImage(data, meta["content_type"], meta.get("etag"), meta.get("last_modified"))
+
+    def set(self, key: str, image: CachedImage):
+        if len(image.data) > self.max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        meta = {
+            "content_type": image.content_type,
+            "etag": image.etag,
+            "last_modified": image.last_modified,
+            "stored_at": time.time(),  # Reloj de pared: el disco lo comparten varios procesos
+        }
+        header = json.dumps(meta).encode("utf-8") + b"\n"
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(header)
+                f.write(image.data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Image disk cache write failed: {e}")
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            return
+
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = self._scan_size()
+            else:
+                self._bytes += len(header) + len(image.data)
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def pop(self, key: str):
+        path = self._path(key)
+        try:
+            size = os.stat(path).st_size
+            os.unlink(path)
+        except OSError:
+            return
+        with self._lock:
+            if self._bytes is not None:
+                self._bytes = max(self._bytes - size, 0)
+
+    def clear(self):
+        """Borra todas las entradas (de todos los workers de la máquina)."""
+        for path, _, _ in list(self._entries()):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        with self._lock:
+            self._bytes = 0
+
+    def _entries(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        """Borra los ficheros menos usados hasta quedar en el 90% del límite."""
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        target = int(self.max_bytes * 0.9)
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+        self._bytes = total
+
+    def stats(self) -> dict:
+        return {
+            "directory": self.directory,
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+        }
+
+
+class ImageCache:
+    """
+    Caché de lectura en dos niveles delante de S3: LRU en memoria acotada por bytes
+    y, detrás, caché en disco local. Las imágenes mayores que `max_item_bytes`
+    no se cachean.
+
+    Una descarga que empezó antes de invalidar su clave no debe volver a meter la
+    versión vieja: quien descarga toma `generation()` antes de pedir el objeto y lo
+    pasa a `set(..., since=)`, que descarta la entrada si la clave se invalidó entre
+    medias. Para eso se recuerdan las últimas RECENT_INVALIDATIONS invalidaciones.
+    """
+
+    RECENT_INVALIDATIONS = 10000
+
+    def __init__(
+        self,
+        memory_max_bytes: int,
+        memory_ttl: Optional[float],
+        disk_dir: Optional[str],
+        disk_max_bytes: int,
+        max_item_bytes: int,
+        disk_ttl: Optional[float] = None
+    ):
+        self.max_item_bytes = max_item_bytes
+        self.memory = ByteLRU(memory_max_bytes, ttl=memory_ttl)
+        self.disk = DiskCache(disk_dir, disk_max_bytes, ttl=disk_ttl) if disk_dir and disk_max_bytes > 0 else None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.stale_writes = 0
+        self._generation = 0
+        self._recent = OrderedDict()  # key -> generación de su última invalidación
+        self._forgotten = 0  # Generación más alta que ya no está en _recent
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[CachedImage]:
+        image = self.get_memory(key)
+        if image is not None:
+            return image
+        return self.get_disk(key)
+
+    def get_memory(self, key: str) -> Optional[CachedImage]:
+        """Solo el nivel en memoria (no hace E/S: se puede llamar desde el event loop)."""
+        image = self.memory.get(key)
+        if image is not None:
+            self.memory_hits += 1
+        return image
+
+    def get_disk(self, key: str) -> Optional[CachedImage]:
+        """Nivel en disco; si acierta, sube la entrada a memoria. Cuenta el fallo si no está."""
+        if self.disk:
+            image = self.disk.get(key)
+            if image is not None:
+                self.disk_hits += 1
+                self.memory.set(key, image, len(image.data))
+                return image
+
+        self.misses += 1
+        return None
+
+    def generation(self) -> int:
+        return self._generation
+
+    def invalidated_since(self, key: str, since: int) -> bool:
+        with self._lock:
+            seq = self._recent.get(key)
+            if seq is not None:
+                return seq > since
+            # Si se olvidó alguna invalidación posterior, no se sabe: se trata como invalidada
+            return self._forgotten > since
+
+    def set(self, key: str, image: CachedImage, since: Optional[int] = None):
+        if len(image.data) > self.max_item_bytes:
+            return
+        self.memory.set(key, image, len(image.data))
+        if self.disk:
+            self.disk.set(key, image)
+        # Se comprueba después de guardar: invalidate() sube la generación antes de
+        # borrar, así que una invalidación concurrente o la ve aquí o borra lo guardado
+        if since is not None and self.invalidated_since(key, since):
+            self.stale_writes += 1
+            self.memory.pop(key)
+            if self.disk:
+                self.disk.pop(key)
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._generation += 1
+            self._recent[key] = self._generation
+            self._recent.move_to_end(key)
+            if len(self._recent) > self.RECENT_INVALIDATIONS:
+                _, self._forgotten = self._recent.popitem(last=False)
+        self.invalidations += 1
+        self.memory.pop(key)
+        if self.disk:
+            self.disk.pop(key)
+
+    def clear(self):
+        """Vacía los dos niveles (p.ej. si se han podido perder avisos de invalidación)."""
+        self.memory.clear()
+        if self.disk:
+            self.disk.clear()
+
+    def stats(self) -> dict:
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "stale_writes": self.stale_writes,
+            "memory": self.memory.stats(),
+            "disk": self.disk.stats() if self.disk else None,
+        }
+
+
+class FrameCache:
+    """
+    Plantillas ya decodificadas (RGBA) en memoria, compartidas por los hilos del worker.
+    Cada entrada guarda el ETag del objeto en S3 para poder revalidarla con una
+    petición condicional; el tamaño se cuenta como ancho * alto * 4 bytes.
+    Las imágenes guardadas no deben modificarse: quien las use trabaja sobre copias.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.frames = ByteLRU(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key: str):
+        """Devuelve (etag, imagen) o None."""
+        return self.frames.get(key)
+
+    def set(self, key: str, etag: Optional[str], image):
+        width, height = image.size
+        self.frames.set(key, (etag, image), width * height * 4)
+
+    def invalidate(self, key: str):
+        self.invalidations += 1
+        self.frames.pop(key)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "memory": self.frames.stats(),
+        }
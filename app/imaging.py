@@ -0,0 +1,301 @@
+"""
+Operaciones de imagen (Pillow) usadas al generar plantillas e integrar fotos.
+No dependen de S3 ni de la base de datos.
+"""
+import math
+from functools import lru_cache
+from io import BytesIO
+from typing import NamedTuple
+from PIL import Image, ImageChops, ImageOps, features
+
+
+#  CONFIGURACIÓN GLOBAL
+CANVAS_WIDTH = 1080
+CANVAS_HEIGHT = 1350
+
+FRAME_THICKNESS_X = 120
+FRAME_THICKNESS_TOP = 160
+FRAME_THICKNESS_BOTTOM = 200
+
+# Image.reduce (promedio por bloques) deja al menos este múltiplo del tamaño final,
+# para que el resize LANCZOS posterior conserve la calidad. El escalado DCT de los
+# JPEG (draft) ya filtra bien, así que solo necesita llegar al tamaño final.
+REDUCING_GAP = 2.0
+
+EXIF_ORIENTATION_TAG = 0x0112
+
+# Umbrales de "píxel de marco": visible (alfa > 10) y no casi blanco (algún canal <= 240)
+VISIBLE_ALPHA_THRESHOLD = 10
+WHITE_THRESHOLD = 240
+
+
+def threshold_mask(band: Image.Image, limit: int) -> Image.Image:
+    """Máscara "L": 255 donde el valor de la banda supera `limit`, 0 en el resto."""
+    return band.point(lambda v: 255 if v > limit else 0)
+
+
+def frame_coverage(img: Image.Image) -> float:
+    """
+    Fracción del canvas ocupada por el marco: píxeles visibles que no son casi blancos.
+
+    Se calcula con máscaras de Pillow (tablas de consulta + ImageChops) y un histograma,
+    todo en C, en lugar de recorrer los píxeles uno a uno en Python.
+    """
+    r, g, b, a = img.convert("RGBA").split()
+
+    # AND de máscaras 0/255 == mínimo píxel a píxel
+    white = ImageChops.darker(
+        ImageChops.darker(threshold_mask(r, WHITE_THRESHOLD), threshold_mask(g, WHITE_THRESHOLD)),
+        threshold_mask(b, WHITE_THRESHOLD)
+    )
+    visible = threshold_mask(a, VISIBLE_ALPHA_THRESHOLD)
+
+    # visible AND NOT white (la resta se satura en 0)
+    frame_pixels = ImageChops.subtract(visible, white)
+
+    w, h = img.size
+    return frame_pixels.histogram()[255] / (w * h)
+
+
+def ensure_frame_fills_canvas(img: Image.Image, min_coverage=0.9) -> Image.Image:
+    img = img.convert("RGBA")
+    w, h = img.size
+
+    coverage = frame_coverage(img)
+
+    # Si el marco ocupa muy poco → escalarlo
+    if coverage < min_coverage:
+        # Crop al área no blanca
+        bbox = img.getbbox()
+        if bbox:
+            cropped = img.crop(bbox)
+            return cropped.resize((w, h), Image.Resampling.LANCZOS)
+
+    return img
+
+
+class ImageTooLargeError(ValueError):
+    """La imagen supera el límite de píxeles configurado."""
+    retryable = False  # Reintentar el trabajo no cambiaría nada
+
+
+def reduce_for_target(img: Image.Image, target_size: tuple[int, int]) -> Image.Image:
+    """
+    Reduce la imagen (sin decodificar aún) a lo justo para cubrir `target_size`
+    tras la rotación EXIF.
+
+    Los JPEG se decodifican directamente a menor escala (draft: escalado DCT 1/2, 1/4, 1/8);
+    el resto de formatos se reduce por un factor entero (Image.reduce), que es mucho más
+    barato que un resize y hace que la rotación posterior trabaje con menos píxeles.
+    """
+    target_w, target_h = target_size
+    # Orientaciones 5-8 giran 90°: el ancho final sale del alto original
+    if img.getexif().get(EXIF_ORIENTATION_TAG, 1) in (5, 6, 7, 8):
+        target_w, target_h = target_h, target_w
+
+    # Misma escala "cover" que integrate_photo_with_frame
+    scale = max(target_w / img.width, target_h / img.height)
+    if scale >= 1:
+        return img
+
+    if img.format == "JPEG":
+        img.draft(None, (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+        scale = max(target_w / img.width, target_h / img.height)
+
+    factor = int(1 / (scale * REDUCING_GAP))
+    if factor >= 2:
+        img = img.reduce(factor)
+
+    return img
+
+
+def load_image_corrected(data, target_size: tuple[int, int] | None = None, max_pixels: int | None = None) -> Image.Image:
+    """
+    Abre una imagen (bytes o fichero), aplica la orientación EXIF y la pasa a RGB.
+
+    Con `target_size` la imagen se decodifica a una resolución cercana a la necesaria
+    antes de rotarla; el resize final de calidad lo hace quien la usa.
+    Con `max_pixels` se rechazan imágenes mayores antes de decodificarlas.
+    """
+    img = Image.open(data if hasattr(data, "read") else BytesIO(data))
+
+    if max_pixels and img.width * img.height > max_pixels:
+        raise ImageTooLargeError(
+            f"Image too large: {img.width}x{img.height} exceeds {max_pixels} pixels"
+        )
+
+    if target_size:
+        img = reduce_for_target(img, target_size)
+
+    img = ImageOps.exif_transpose(img)
+    return img.convert("RGB")
+
+
+def window_rect(size: tuple[int, int]) -> tuple[int, int, int, int]:
+    """Ventana fija (x0, y0, x1, y1) donde va la foto, para un canvas de `size`."""
+    w, h = size
+    return (
+        FRAME_THICKNESS_X,
+        FRAME_THICKNESS_TOP,
+        w - FRAME_THICKNESS_X,
+        h - FRAME_THICKNESS_BOTTOM
+    )
+
+
+@lru_cache(maxsize=8)
+def window_alpha_mask(size: tuple[int, int], rect: tuple[int, int, int, int]) -> Image.Image:
+    """
+    Canal alfa del marco: opaco (255) salvo la ventana (0). La geometría es constante,
+    así que se construye una vez por tamaño de canvas y se comparte: NO modificarla.
+    """
+    alpha = Image.new("L", size, 255)
+    alpha.paste(0, rect)
+    return alpha
+
+
+def is_opaque(img: Image.Image) -> bool:
+    if img.mode in ("RGBA", "LA"):
+        return img.getchannel("A").getextrema()[0] == 255
+    return img.mode not in ("RGBa", "La", "PA") and "transparency" not in img.info
+
+
+def has_window_alpha(frame: Image.Image, rect: tuple[int, int, int, int]) -> bool:
+    """
+    True si el alfa del marco (RGBA) es exactamente el de apply_fixed_transparent_window.
+    Se decide con dos histogramas (el del borde usando la máscara cacheada), sin
+    reservar ninguna imagen: si todo el borde vale 255 y el canvas entero solo tiene
+    tantos píxeles a 255 como el borde y tantos a 0 como la ventana, la ventana es 0.
+    """
+    x0, y0, x1, y1 = rect
+    window_area = max(0, x1 - x0) * max(0, y1 - y0)
+    border_area = frame.width * frame.height - window_area
+    alpha = frame.histogram()[768:]
+    border_alpha = frame.histogram(window_alpha_mask(frame.size, rect))[768:]
+    return border_alpha[255] == border_area and alpha[255] == border_area and alpha[0] == window_area
+
+
+def integrate_photo_with_frame(frame_img: Image.Image, person_img: Image.Image) -> Image.Image:
+    frame = frame_img if frame_img.mode == "RGBA" else frame_img.convert("RGBA")
+
+    w, h = frame.size
+
+    x0, y0, x1, y1 = window_rect((w, h))
+
+    hole_w = x1 - x0
+    hole_h = y1 - y0
+
+    # scale = min(hole_w / person.width, hole_h / person.height)
+    scale = max(hole_w / person_img.width, hole_h / person_img.height)
+    new_w = int(person_img.width * scale)
+    new_h = int(person_img.height * scale)
+
+    # Una foto sin transparencia se redimensiona en RGB: 3 canales en lugar de 4
+    # y sin premultiplicar alfa (el resultado es idéntico con alfa 255)
+    opaque = is_opaque(person_img)
+    if opaque:
+        person = person_img if person_img.mode == "RGB" else person_img.convert("RGB")
+    else:
+        person = person_img if person_img.mode == "RGBA" else person_img.convert("RGBA")
+
+    person_resized = person.resize((new_w, new_h), Image.Resampling.LANCZOS)
+
+    px = x0 + (hole_w - new_w) // 2
+    py = y0 + (hole_h - new_h) // 2
+
+    if opaque and has_window_alpha(frame, (x0, y0, x1, y1)):
+        # Marco estándar: opaco fuera de la ventana y transparente dentro. El resultado
+        # es el propio marco con la parte visible de la foto copiada en la ventana:
+        # una sola copia del canvas y ninguna mezcla alfa.
+        canvas = frame.copy()
+        canvas.paste((0, 0, 0, 0), (x0, y0, x1, y1))
+
+        left, top = max(x0, px), max(y0, py)
+        right, bottom = min(x1, px + new_w), min(y1, py + new_h)
+        if right > left and bottom > top:
+            visible = person_resized.crop((left - px, top - py, right - px, bottom - py))
+            canvas.paste(visible, (left, top))
+        return canvas
+
+    canvas = Image.new("RGBA", (w, h), (0, 0, 0, 0))
+
+    if opaque:
+        canvas.paste(person_resized, (px, py))
+    else:
+        canvas.paste(person_resized, (px, py), person_resized)
+    canvas.paste(frame, (0, 0), frame)
+
+    return canvas
+
+
+def apply_fixed_transparent_window(frame_img: Image.Image) -> Image.Image:
+    frame = frame_img.convert("RGBA")
+    frame.putalpha(window_alpha_mask(frame.size, window_rect(frame.size)))
+    return frame
+
+
+def make_renditions(img: Image.Image, widths) -> list[tuple[int, Image.Image]]:
+    """
+    Versiones reducidas de `img` para cada ancho (manteniendo la proporción).
+    Se generan de mayor a menor, cada una a partir de la anterior, y se omiten
+    los anchos que no son menores que el de la imagen.
+    """
+    renditions = []
+    source = img
+    for width in sorted(set(widths), reverse=True):
+        if width >= img.width:
+            continue
+        height = max(1, round(img.height * width / img.width))
+        source = source.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
+        renditions.append((width, source))
+    return renditions
+
+
+# ============================================================
+#  CODIFICACIÓN DE LOS RESULTADOS
+# ============================================================
+# formato -> (formato de Pillow, content type, extensión de la clave S3, admite alfa)
+OUTPUT_FORMATS = {
+    "png": ("PNG", "image/png", "png", True),
+    "jpeg": ("JPEG", "image/jpeg", "jpg", False),
+    "webp": ("WEBP", "image/webp", "webp", True),
+    "avif": ("AVIF", "image/avif", "avif", True),
+}
+
+
+class ImageEncoding(NamedTuple):
+    format: str
+    content_type: str
+    extension: str
+    keeps_alpha: bool
+    params: dict
+
+
+def output_encoding(name: str, quality: int = 85, compress_level: int = 6) -> ImageEncoding:
+    """Parámetros del codificador para un formato de salida (png, jpeg, webp o avif)."""
+    name = name.lower()
+    if name not in OUTPUT_FORMATS:
+        raise ValueError(f"Formato de salida no soportado: {name}")
+    if name in ("webp", "avif") and not features.check(name):
+        raise ValueError(f"Pillow no tiene soporte para {name} en este entorno")
+
+    pil_format, content_type, extension, keeps_alpha = OUTPUT_FORMATS[name]
+    if name == "png":
+        params = {"compress_level": compress_level}
+    elif name == "jpeg":
+        params = {"quality": quality, "progressive": True}
+    else:
+        params = {"quality": quality}
+    return ImageEncoding(pil_format, content_type, extension, keeps_alpha, params)
+
+
+def encode_image(img: Image.Image, encoding: ImageEncoding) -> BytesIO:
+    """
+    Codifica `img` con `encoding`. Las imágenes sin transparencia real se guardan en RGB:
+    el canal alfa no aporta nada y en WebP/AVIF ocupa espacio.
+    """
+    if img.mode != "RGB" and (not encoding.keeps_alpha or is_opaque(img)):
+        img = img.convert("RGB")
+    buffer = BytesIO()
+    img.save(buffer, format=encoding.format, **encoding.params)
+    buffer.seek(0)
+    return buffer
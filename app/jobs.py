@@ -0,0 +1,334 @@
+"""
+Cola de trabajos persistente en Redis para el procesamiento pesado (Gemini + Pillow).
+
+La API solo encola; los trabajos los ejecuta un proceso aparte (`python -m app.worker`),
+así que sobreviven a reinicios de la API y la capacidad de proceso escala por separado.
+
+Claves en Redis (prefijo JOB_QUEUE_NAME):
+    {prefix}:queue          lista de ids pendientes
+    {prefix}:running        zset id -> fin del plazo de ejecución (si vence, se reencola);
+                            el worker lo renueva cada JOB_HEARTBEAT_SECONDS mientras ejecuta
+    {prefix}:delayed        zset id -> momento del siguiente reintento
+    {prefix}:job:{id}       hash con el estado del trabajo
+    {prefix}:events:{id}    canal pub/sub con cada cambio de estado
+"""
+import json
+import random
+import signal
+import threading
+import time
+import traceback
+
+from app.config import (
+    JOB_QUEUE_NAME,
+    JOB_WORKER_CONCURRENCY,
+    JOB_MAX_ATTEMPTS,
+    JOB_RETRY_BACKOFF_SECONDS,
+    JOB_RETRY_BACKOFF_MAX_SECONDS,
+    JOB_TIMEOUT_SECONDS,
+    JOB_HEARTBEAT_SECONDS,
+    JOB_POLL_INTERVAL_SECONDS,
+    JOB_RESULT_TTL_SECONDS
+)
+from app.redis_client import redis_client
+
+QUEUE_KEY = f"{JOB_QUEUE_NAME}:queue"
+RUNNING_KEY = f"{JOB_QUEUE_NAME}:running"
+DELAYED_KEY = f"{JOB_QUEUE_NAME}:delayed"
+
+JOB_PENDING = "pending"
+JOB_PROCESSING = "processing"
+JOB_RETRYING = "retrying"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+TERMINAL_STATUSES = (JOB_DONE, JOB_FAILED)
+
+STATUS_HOOK_ATTEMPTS = 3
+
+# Saca un id de la cola y lo marca como en ejecución de forma atómica
+CLAIM_SCRIPT = redis_client.register_script("""
+local job_id = redis.call('RPOP', KEYS[1])
+if job_id then
+    redis.call('ZADD', KEYS[2], ARGV[1], job_id)
+end
+return job_id
+""")
+
+# Devuelve a la cola los reintentos que ya tocan y los trabajos cuyo plazo venció
+# (el worker que los tenía murió o se colgó)
+REQUEUE_SCRIPT = redis_client.register_script("""
+local moved = 0
+for _, source in ipairs({KEYS[1], KEYS[2]}) do
+    local ids = redis.call('ZRANGEBYSCORE', source, '-inf', ARGV[1], 'LIMIT', 0, 100)
+    for _, job_id in ipairs(ids) do
+        redis.call('ZREM', source, job_id)
+        redis.call('LPUSH', KEYS[3], job_id)
+        moved = moved + 1
+    end
+end
+return moved
+""")
+
+_tasks = {}
+_status_hooks = {}
+
+# Trabajos que se están ejecutando en este proceso (_heartbeat_loop renueva su plazo)
+_running = set()
+_running_lock = threading.Lock()
+
+
+def job_key(job_id: str) -> str:
+    return f"{JOB_QUEUE_NAME}:job:{job_id}"
+
+
+def events_channel(job_id: str) -> str:
+    return f"{JOB_QUEUE_NAME}:events:{job_id}"
+
+
+def register_task(name: str, fn, on_status=None):
+    """
+    Registra una función ejecutable por el worker bajo un nombre estable.
+    `on_status(job_id, status, error)` se llama en cada cambio de estado
+    (p.ej. para reflejarlo en la base de datos).
+    """
+    _tasks[name] = fn
+    if on_status:
+        _status_hooks[name] = on_status
+
+
+def _notify(job: dict, status: str, error: str = ""):
+    """Publica el cambio de estado (para los clientes SSE) y avisa al hook de la tarea."""
+    event = {
+        "uuid": job["id"],
+        "status": status,
+        "error": error or None,
+        "attempts": int(job.get("attempts") or 0),
+        "at": time.time(),
+    }
+    try:
+        redis_client.publish(events_channel(job["id"]), json.dumps(event))
+    except Exception as e:
+        print(f"Error publishing job event {job['id']}: {e}")
+
+    hook = _status_hooks.get(job.get("task"))
+    if not hook:
+        return
+    # El hook escribe en la BD: un fallo puntual (conexión caída, bloqueo) no debe dejar
+    # la fila en "processing" para siempre. Si se agotan los intentos, la limpieza
+    # periódica la concilia con el estado guardado en Redis (replay_status).
+    for attempt in range(1, STATUS_HOOK_ATTEMPTS + 1):
+        try:
+            hook(job["id"], status, error or None)
+            return
+        except Exception as e:
+            print(f"Error recording status of job {job['id']} (attempt {attempt}/{STATUS_HOOK_ATTEMPTS}): {e}")
+            if attempt < STATUS_HOOK_ATTEMPTS:
+                time.sleep(attempt * 0.5)
+    print(f"Status of job {job['id']} not recorded; the cleanup will reconcile it")
+
+
+def replay_status(job: dict) -> bool:
+    """
+    Vuelve a avisar al hook de la tarea con el estado final que guarda Redis. Lo usa la
+    limpieza para las filas que se quedaron en curso porque el hook falló al terminar.
+    """
+    hook = _status_hooks.get(job.get("task"))
+    if not hook or job.get("status") not in TERMINAL_STATUSES:
+        return False
+    hook(job["id"], job["status"], job.get("error") or None)
+    return True
+
+
+def enqueue(task_name: str, job_id: str, args: dict):
+    """
+    Encola un trabajo. El id es el del template o la imagen que se genera, de modo que
+    el estado queda consultable por ese mismo UUID. `args` debe ser serializable a JSON
+    (las fotos subidas no van en Redis: la tarea recibe su clave en S3).
+    """
+    job = {
+        "id": job_id,
+        "task": task_name,
+        "args": json.dumps(args),
+        "status": JOB_PENDING,
+        "attempts": 0,
+        "max_attempts": JOB_MAX_ATTEMPTS,
+        "created_at": time.time(),
+        "error": "",
+    }
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.hset(job_key(job_id), mapping=job)
+    pipe.lpush(QUEUE_KEY, job_id)
+    pipe.execute()
+
+
+def get_job(job_id: str) -> dict | None:
+    raw = redis_client.hgetall(job_key(job_id))
+    if not raw:
+        return None
+    return {k.decode(): v.decode() for k, v in raw.items()}
+
+
+def retry_delay(attempts: int) -> float:
+    """Backoff exponencial con algo de dispersión para no reintentar todos a la vez."""
+    delay = min(JOB_RETRY_BACKOFF_SECONDS * (2 ** (attempts - 1)), JOB_RETRY_BACKOFF_MAX_SECONDS)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def _finish(job: dict, status: str, error: str = ""):
+    job_id = job["id"]
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.zrem(RUNNING_KEY, job_id)
+    pipe.hset(job_key(job_id), mapping={"status": status, "finished_at": time.time(), "error": error})
+    pipe.expire(job_key(job_id), JOB_RESULT_TTL_SECONDS)
+    pipe.execute()
+    _notify(job, status, error)
+
+
+def _schedule_retry(job: dict, attempts: int, error: str, min_delay: float = 0):
+    job_id = job["id"]
+    delay = max(retry_delay(attempts), min_delay)
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.zrem(RUNNING_KEY, job_id)
+    pipe.hset(job_key(job_id), mapping={"status": JOB_RETRYING, "error": error})
+    pipe.zadd(DELAYED_KEY, {job_id: time.time() + delay})
+    pipe.execute()
+    _notify(job, JOB_RETRYING, error)
+    print(f"Job {job_id} failed (attempt {attempts}), retrying in {delay:.1f}s")
+
+
+def claim_job() -> str | None:
+    job_id = CLAIM_SCRIPT(keys=[QUEUE_KEY, RUNNING_KEY], args=[time.time() + JOB_TIMEOUT_SECONDS])
+    return job_id.decode() if job_id else None
+
+
+def run_job(job_id: str):
+    with _running_lock:
+        _running.add(job_id)
+    try:
+        _run_job(job_id)
+    finally:
+        with _running_lock:
+            _running.discard(job_id)
+
+
+def _run_job(job_id: str):
+    job = get_job(job_id)
+    if not job:
+        # El hash caducó o se borró: no hay nada que ejecutar
+        redis_client.zrem(RUNNING_KEY, job_id)
+        return
+
+    attempts = redis_client.hincrby(job_key(job_id), "attempts", 1)
+    job["attempts"] = attempts
+    max_attempts = int(job.get("max_attempts") or JOB_MAX_ATTEMPTS)
+    if attempts > max_attempts:
+        _finish(job, JOB_FAILED, job.get("error") or "Max attempts exceeded")
+        return
+
+    task = _tasks.get(job["task"])
+    if task is None:
+        _finish(job, JOB_FAILED, f"Unknown task: {job['task']}")
+        return
+
+    kwargs = json.loads(job["args"])
+
+    redis_client.hset(job_key(job_id), mapping={"status": JOB_PROCESSING, "started_at": time.time()})
+    _notify(job, JOB_PROCESSING)
+    try:
+        task(**kwargs)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        traceback.print_exc()
+        # Las excepciones pueden marcarse con `retryable = False` (p.ej. una imagen inválida)
+        if attempts < max_attempts and getattr(e, "retryable", True):
+            # Con un circuit breaker abierto no tiene sentido reintentar antes de que se cierre
+            _schedule_retry(job, attempts, error, min_delay=getattr(e, "retry_after", 0))
+        else:
+            _finish(job, JOB_FAILED, error)
+            print(f"Job {job_id} failed permanently: {error}")
+        return
+
+    _finish(job, JOB_DONE)
+
+
+def _worker_loop(stop: threading.Event):
+    while not stop.is_set():
+        try:
+            job_id = claim_job()
+        except Exception as e:
+            print(f"Error claiming job: {e}")
+            stop.wait(JOB_POLL_INTERVAL_SECONDS)
+            continue
+
+        if job_id is None:
+            stop.wait(JOB_POLL_INTERVAL_SECONDS)
+            continue
+
+        try:
+            run_job(job_id)
+        except Exception as e:
+            # Error de Redis al guardar el estado: el plazo vencerá y el trabajo se reencolará
+            print(f"Error running job {job_id}: {e}")
+
+
+def _heartbeat_loop(stop: threading.Event):
+    """
+    Renueva el plazo de los trabajos en ejecución: uno que reintenta Gemini puede
+    durar más que JOB_TIMEOUT_SECONDS y no debe reencolarse mientras sigue vivo.
+    XX: si el trabajo ya terminó (o se reencoló) no se vuelve a añadir.
+    """
+    while not stop.wait(JOB_HEARTBEAT_SECONDS):
+        with _running_lock:
+            job_ids = list(_running)
+        if not job_ids:
+            continue
+        try:
+            deadline = time.time() + JOB_TIMEOUT_SECONDS
+            pipe = redis_client.pipeline(transaction=False)
+            for job_id in job_ids:
+                pipe.zadd(RUNNING_KEY, {job_id: deadline}, xx=True)
+            pipe.execute()
+        except Exception as e:
+            print(f"Error renewing job leases: {e}")
+
+
+def _scheduler_loop(stop: threading.Event):
+    while not stop.is_set():
+        try:
+            REQUEUE_SCRIPT(keys=[DELAYED_KEY, RUNNING_KEY, QUEUE_KEY], args=[time.time()])
+        except Exception as e:
+            print(f"Error requeuing jobs: {e}")
+        stop.wait(1)
+
+
+def run_worker(concurrency: int = JOB_WORKER_CONCURRENCY):
+    """Arranca `concurrency` hilos de ejecución más el planificador de reintentos."""
+    stop = threading.Event()
+
+    def handle_signal(signum, frame):
+        print("Worker stopping, waiting for running jobs to finish...")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    # El heartbeat sigue hasta que terminan los trabajos en curso, no hasta la señal
+    heartbeat_stop = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat_loop, args=(heartbeat_stop,), name="job-heartbeat", daemon=True)
+    heartbeat.start()
+
+    threads = [threading.Thread(target=_scheduler_loop, args=(stop,), name="job-scheduler", daemon=True)]
+    for i in range(concurrency):
+        threads.append(threading.Thread(target=_worker_loop, args=(stop,), name=f"job-worker-{i}"))
+
+    for thread in threads:
+        thread.start()
+
+    print(f"Worker started with {concurrency} threads on queue '{QUEUE_KEY}'")
+    while not stop.is_set():
+        stop.wait(1)
+
+    for thread in threads:
+        thread.join()
+    heartbeat_stop.set()
+    print("Worker stopped")
@@ -1,23 +1,54 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Depends, Request
 from fastapi.responses import JSONResponse
 from starlette.middleware.sessions import SessionMiddleware
 from fastapi.middleware.cors import CORSMiddleware
 from app import models
-from app.db import engine, Base
+from app.db import engine, async_engine
 from app.auth import router as auth_router
-from app.templates_routes import router as templates_router
+from app.templates_routes import router as templates_router, listen_image_invalidations
 from app.schemas import UserOut
 from app.utils import get_current_user
-from app.config import SECRET_KEY
+from app.config import SECRET_KEY, PRINT_ROUTES
+from app.redis_client import async_redis_client
 from tabulate import tabulate
 import uvicorn
 from app.limiter import limiter
 from slowapi.errors import RateLimitExceeded
 from slowapi.middleware import SlowAPIMiddleware
+from app.uploads import UploadSizeLimitMiddleware
 
-Base.metadata.create_all(bind=engine)
+# El esquema no se crea al importar: lo gestiona Alembic (`alembic upgrade head`,
+# que se ejecuta antes de arrancar gunicorn). Los clientes pesados (S3, Gemini,
+# OAuth) se construyen en su primer uso.
 
-app = FastAPI(title="Totem API", version="1.0.0")
+
+def show_routes(app: FastAPI):
+    data = []
+    for route in app.routes:
+        if hasattr(route, "methods"):
+            methods = ",".join(route.methods)
+            data.append([methods, route.path])
+    print("\n [XXX] API ROUTES:\n")
+    print(tabulate(data, headers=["METHODS", "PATH"], tablefmt="fancy_grid"))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if PRINT_ROUTES:
+        show_routes(app)
+    # Invalidaciones de la caché de imágenes hechas por otros procesos
+    image_invalidations = asyncio.create_task(listen_image_invalidations())
+    yield
+    image_invalidations.cancel()
+    # Cierra las conexiones del worker al pararse (Postgres y Redis)
+    await async_redis_client.aclose()
+    await async_engine.dispose()
+    engine.dispose()
+
+
+app = FastAPI(title="Totem API", version="1.0.0", lifespan=lifespan)
 
 # --- CONFIGURACIÓN DEL RATE LIMITER ---
 # 1. Poner el limiter en el estado de la app
@@ -36,6 +67,9 @@ async def rate_limit_exceeded_handler(request: Request, exc: RateLimitExceeded):
 
 app.add_middleware(SlowAPIMiddleware)
 
+# Corta con 413 las subidas mayores que MAX_UPLOAD_BYTES mientras se reciben
+app.add_middleware(UploadSizeLimitMiddleware)
+
 app.include_router(auth_router)
 app.include_router(templates_router)
 
@@ -45,23 +79,13 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],  # Cursor de la página siguiente en los listados
 )
 
 
 app.add_middleware(SessionMiddleware, secret_key=SECRET_KEY)
 
 
-@app.on_event("startup")
-async def show_routes():
-    data = []
-    for route in app.routes:
-        if hasattr(route, "methods"):
-            methods = ",".join(route.methods)
-            data.append([methods, route.path])
-    print("\n [XXX] API ROUTES:\n")
-    print(tabulate(data, headers=["METHODS", "PATH"], tablefmt="fancy_grid"))
-
-
 @app.get("/users/me", response_model=UserOut)
 def read_users_me(current_user: models.User = Depends(get_current_user)):
     return current_user
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, String, Boolean, ForeignKey
+from datetime import datetime
+from sqlalchemy import Column, String, Boolean, ForeignKey, DateTime, Index, func
 from sqlalchemy.orm import relationship
 from app.db import Base
 
@@ -17,15 +18,34 @@ class User(Base):
 
 class Template(Base):
     __tablename__ = "templates"
+    # Índices de los listados paginados (por usuario y catálogo público, ver paginate).
+    # Los crea la migración 0006 (alembic/versions), sin bloquear la tabla.
+    __table_args__ = (
+        Index("ix_templates_user_id_created_at", "user_id", "created_at", "id"),
+        Index("ix_templates_is_public_created_at", "is_public", "created_at", "id"),
+    )
 
     id = Column(String, primary_key=True, index=True)
     s3_key = Column(String, nullable=False)
+    # Formato con el que se guardó el objeto (image/png, image/webp...)
+    content_type = Column(String, nullable=True)
+    # Miniaturas generadas junto al original: "formato:ancho,ancho" (p.ej. "webp:240,540")
+    renditions = Column(String, nullable=True)
     user_id = Column(String, ForeignKey("users.id"))
 
     user = relationship("User", back_populates="templates")
 
     is_public = Column(Boolean, default=False, index=True)
 
+    # Estado del procesamiento en el worker: pending / processing / done / failed
+    status = Column(String, default="pending")
+    processing_started_at = Column(DateTime, nullable=True)
+    processing_finished_at = Column(DateTime, nullable=True)
+    processing_error = Column(String, nullable=True)
+
+    # Orden de los listados (paginación por cursor sobre (created_at, id))
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow, server_default=func.now())
+
     user = relationship("User", back_populates="templates")
     # Relación con TemplateWithImage
     template_with_images = relationship("TemplateWithImage", back_populates="template")
@@ -33,13 +53,29 @@ class Template(Base):
 
 class TemplateWithImage(Base):
     __tablename__ = "templates_with_images"
+    __table_args__ = (
+        Index("ix_templates_with_images_user_id_created_at", "user_id", "created_at", "id"),
+    )
 
     id = Column(String, primary_key=True, index=True)
     s3_key = Column(String, nullable=False)
+    # Formato con el que se guardó el objeto (image/png, image/webp...)
+    content_type = Column(String, nullable=True)
+    # Miniaturas generadas junto al original: "formato:ancho,ancho" (p.ej. "webp:240,540")
+    renditions = Column(String, nullable=True)
     user_id = Column(String, ForeignKey("users.id"))
 
     # Nueva relación hacia Template
-    template_id = Column(String, ForeignKey("templates.id"), nullable=False)
+    template_id = Column(String, ForeignKey("templates.id"), nullable=False, index=True)
+
+    # Estado del procesamiento en el worker: pending / processing / done / failed
+    status = Column(String, default="pending")
+    processing_started_at = Column(DateTime, nullable=True)
+    processing_finished_at = Column(DateTime, nullable=True)
+    processing_error = Column(String, nullable=True)
+
+    # Orden de los listados (paginación por cursor sobre (created_at, id))
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow, server_default=func.now())
 
     user = relationship("User")
     template = relationship("Template", back_populates="template_with_images")
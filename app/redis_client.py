@@ -0,0 +1,10 @@
+import redis
+import redis.asyncio
+from app.config import REDIS_URL
+
+# Cliente compartido (mismo Redis que usa slowapi para el rate limiting).
+# Trabaja con bytes: cada módulo decodifica lo que necesita.
+redis_client = redis.Redis.from_url(REDIS_URL)
+
+# Cliente asíncrono para las rutas async (p.ej. suscripciones pub/sub de SSE)
+async_redis_client = redis.asyncio.Redis.from_url(REDIS_URL)
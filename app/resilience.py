@@ -0,0 +1,170 @@
+"""
+Circuit breakers y reintentos con backoff para las dependencias externas (Gemini, S3).
+
+El estado de cada breaker vive en Redis, así que lo comparten la API y los workers:
+si Gemini falla en el worker, la API deja de aceptar trabajo que lo necesita y
+responde 503 con Retry-After en lugar de encolarlo.
+
+Claves en Redis (prefijo "totem:breaker:{nombre}"):
+    :failures   fallos recientes (caduca FAILURE_WINDOW segundos tras el primero)
+    :open       existe mientras el breaker está abierto (caduca a los RESET segundos)
+
+Con el breaker cerrado, los éxitos no tocan el contador: caduca con su ventana, así
+que el éxito de un proceso no borra los fallos que otros van sumando.
+Al caducar `:open` el breaker queda "medio abierto": se dejan pasar llamadas, pero
+el contador de fallos sigue por encima del umbral, así que un solo fallo lo vuelve
+a abrir y un éxito lo cierra del todo.
+
+Si Redis no responde, los breakers no bloquean nada (se prefiere intentar la llamada).
+"""
+import random
+import time
+
+from app.config import (
+    CIRCUIT_FAILURE_THRESHOLD,
+    CIRCUIT_FAILURE_WINDOW_SECONDS,
+    CIRCUIT_RESET_SECONDS
+)
+from app.redis_client import redis_client
+
+# Cada proceso recuerda el estado leído de Redis durante este tiempo, para no
+# consultarlo en cada llamada a S3
+LOCAL_STATE_TTL_SECONDS = 1.0
+
+
+# Cierra el breaker medio abierto: borra los fallos solo si ya no está abierto y el
+# contador llegó al umbral (en estado cerrado el contador caduca solo)
+CLOSE_SCRIPT = redis_client.register_script("""
+if redis.call('EXISTS', KEYS[2]) == 0 and tonumber(redis.call('GET', KEYS[1]) or '0') >= tonumber(ARGV[1]) then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+class CircuitOpenError(RuntimeError):
+    """La dependencia está marcada como caída; reintentar pasados `retry_after` segundos."""
+
+    def __init__(self, name: str, retry_after: int):
+        super().__init__(f"{name} unavailable (circuit open), retry after {retry_after}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+        failure_window: float = CIRCUIT_FAILURE_WINDOW_SECONDS,
+        reset_timeout: float = CIRCUIT_RESET_SECONDS
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.failure_window = failure_window
+        self.reset_timeout = reset_timeout
+        self.failures_key = f"totem:breaker:{name}:failures"
+        self.open_key = f"totem:breaker:{name}:open"
+        self._open_until = 0.0    # Estado leído de Redis (cacheado localmente)
+        self._checked_at = 0.0
+        self._maybe_half_open = True  # Hasta el primer éxito no se sabe si estaba abierto
+
+    def retry_after(self) -> int:
+        """Segundos que quedan abierto (0 si está cerrado)."""
+        now = time.monotonic()
+        if now - self._checked_at > LOCAL_STATE_TTL_SECONDS:
+            try:
+                ttl_ms = redis_client.pttl(self.open_key)
+            except Exception as e:
+                print(f"Circuit breaker {self.name}: Redis error reading state: {e}")
+                ttl_ms = -2
+            self._open_until = now + ttl_ms / 1000 if ttl_ms > 0 else 0.0
+            self._checked_at = now
+            if ttl_ms > 0:
+                # Tras el periodo abierto, el primer éxito de este proceso cierra el breaker
+                self._maybe_half_open = True
+        remaining = self._open_until - now
+        return max(int(remaining + 0.999), 1) if remaining > 0 else 0
+
+    def is_open(self) -> bool:
+        return self.retry_after() > 0
+
+    def check(self):
+        """Lanza CircuitOpenError si el breaker está abierto."""
+        retry_after = self.retry_after()
+        if retry_after:
+            raise CircuitOpenError(self.name, retry_after)
+
+    def record_success(self):
+        # Solo se toca Redis si este proceso vio el breaker abierto (no en cada llamada a S3)
+        if not self._maybe_half_open:
+            return
+        try:
+            if CLOSE_SCRIPT(keys=[self.failures_key, self.open_key], args=[self.failure_threshold]):
+                print(f"Circuit breaker {self.name} CLOSED after a successful call")
+            if not redis_client.exists(self.open_key):
+                self._maybe_half_open = False
+        except Exception as e:
+            print(f"Circuit breaker {self.name}: Redis error on success: {e}")
+
+    def record_failure(self):
+        try:
+            pipe = redis_client.pipeline(transaction=True)
+            pipe.incr(self.failures_key)
+            pipe.pttl(self.failures_key)
+            failures, ttl_ms = pipe.execute()
+            if ttl_ms < 0:
+                redis_client.pexpire(self.failures_key, int(self.failure_window * 1000))
+            if failures >= self.failure_threshold:
+                redis_client.set(self.open_key, 1, px=int(self.reset_timeout * 1000))
+                # El contador sobrevive al periodo abierto: en la fase medio abierta
+                # basta un fallo para volver a abrir
+                redis_client.pexpire(self.failures_key, int((self.reset_timeout + self.failure_window) * 1000))
+                self._open_until = time.monotonic() + self.reset_timeout
+                self._checked_at = time.monotonic()
+                self._maybe_half_open = True
+                if failures == self.failure_threshold:
+                    print(f"Circuit breaker {self.name} OPEN for {self.reset_timeout:.0f}s after {failures} failures")
+        except Exception as e:
+            print(f"Circuit breaker {self.name}: Redis error on failure: {e}")
+
+    def stats(self) -> dict:
+        try:
+            failures = int(redis_client.get(self.failures_key) or 0)
+        except Exception:
+            failures = None
+        return {
+            "open": self.is_open(),
+            "retry_after": self.retry_after(),
+            "recent_failures": failures,
+            "failure_threshold": self.failure_threshold,
+        }
+
+
+def backoff_delay(attempt: int, base: float, maximum: float) -> float:
+    """Backoff exponencial con "full jitter": aleatorio entre 0 y base * 2^(intento-1)."""
+    return random.uniform(0, min(maximum, base * (2 ** (attempt - 1))))
+
+
+def call_with_retry(fn, *, breaker: CircuitBreaker, attempts: int, base_delay: float, max_delay: float,
+                    is_failure=lambda e: True, is_retryable=lambda e: True):
+    """
+    Llama a `fn()` hasta `attempts` veces con backoff entre intentos.
+    `is_failure(e)` decide si el error cuenta para el breaker (caída del servicio)
+    e `is_retryable(e)` si merece la pena repetir. Con el breaker abierto no se llama.
+    """
+    for attempt in range(1, attempts + 1):
+        breaker.check()
+        try:
+            result = fn()
+        except Exception as e:
+            if is_failure(e):
+                breaker.record_failure()
+            if attempt == attempts or not is_retryable(e) or breaker.is_open():
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            print(f"{breaker.name} call failed (attempt {attempt}/{attempts}): {e}; retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+        breaker.record_success()
+        return result
@@ -0,0 +1,205 @@
+"""
+Recolección de objetos huérfanos en S3: objetos sin registro en la BD (trabajos
+fallidos, borrados de S3 que fallaron, imágenes de plantillas borradas...).
+
+Recorre el bucket en orden de clave, una página de list_objects_v2 cada vez, y
+guarda en Redis la última clave revisada: cada llamada hace un tramo limitado en
+tiempo (run_gc_slice) y la siguiente sigue donde se quedó. Al llegar al final del
+bucket se empieza una pasada nueva.
+
+Un objeto está referenciado si:
+    - su clave es el s3_key de una plantilla o imagen integrada,
+    - es una miniatura ({original}_w{ancho}.{ext}) de un original referenciado,
+    - es una subida temporal (staging/{id}) de un trabajo pendiente o en curso.
+Solo se borran objetos más antiguos que GC_GRACE_SECONDS, para no competir con
+subidas en curso. La caché de Gemini (GEMINI_CACHE_PREFIX) no tiene registros: sus
+objetos se borran cuando superan GEMINI_CACHE_TTL_DAYS (una regla de ciclo de vida
+del bucket sobre ese prefijo hace lo mismo sin pasar por aquí).
+
+Claves en Redis (prefijo "totem:s3gc"):
+    :checkpoint   última clave revisada de la pasada actual
+    :lock         evita que dos tramos se ejecuten a la vez
+    :stats        contadores (objetos revisados, borrados, bytes liberados, pasadas)
+"""
+import re
+import time
+from datetime import datetime, timedelta, timezone
+
+from app import models
+from app.config import (
+    S3_BUCKET_NAME,
+    GEMINI_CACHE_PREFIX,
+    GEMINI_CACHE_TTL_DAYS,
+    GC_GRACE_SECONDS,
+    GC_SLICE_SECONDS,
+    GC_DRY_RUN
+)
+from app.db import SessionLocal
+from app.imaging import OUTPUT_FORMATS
+from app.redis_client import redis_client
+from app.storage import s3
+
+KEY_PREFIX = "totem:s3gc"
+CHECKPOINT_KEY = f"{KEY_PREFIX}:checkpoint"
+LOCK_KEY = f"{KEY_PREFIX}:lock"
+STATS_KEY = f"{KEY_PREFIX}:stats"
+
+# Máximo de claves por llamada a list_objects_v2 y a delete_objects
+PAGE_SIZE = 1000
+
+# Claves generadas por templates_routes (staging_key y rendition_key)
+STAGING_PREFIX = "staging/"
+RENDITION_RE = re.compile(r"^(?P<stem>.+)_w\d+\.[a-z0-9]+$")
+ORIGINAL_EXTENSIONS = sorted({fmt[2] for fmt in OUTPUT_FORMATS.values()})
+
+# Estados en los que la subida temporal todavía se necesita
+IN_PROGRESS_STATUSES = ("pending", "processing")
+
+
+def owner_keys(key: str) -> list[str]:
+    """s3_key que referenciaría el objeto: el propio, o los posibles originales de una miniatura."""
+    match = RENDITION_RE.match(key)
+    if not match:
+        return [key]
+    stem = match.group("stem")
+    return [key] + [f"{stem}.{ext}" for ext in ORIGINAL_EXTENSIONS]
+
+
+def find_referenced(db, keys: list[str]) -> set[str]:
+    """De una página de claves del bucket, las que tienen registro en la BD."""
+    referenced = set()
+
+    staged_ids = [key[len(STAGING_PREFIX):] for key in keys if key.startswith(STAGING_PREFIX)]
+    if staged_ids:
+        for model in (models.Template, models.TemplateWithImage):
+            rows = db.query(model.id).filter(
+                model.id.in_(staged_ids),
+                model.status.in_(IN_PROGRESS_STATUSES)
+            )
+            referenced.update(f"{STAGING_PREFIX}{record_id}" for (record_id,) in rows)
+
+    owners = {key: owner_keys(key) for key in keys if not key.startswith(STAGING_PREFIX)}
+    candidates = {owner for possible in owners.values() for owner in possible}
+    if candidates:
+        known = set()
+        for model in (models.Template, models.TemplateWithImage):
+            known.update(s3_key for (s3_key,) in db.query(model.s3_key).filter(model.s3_key.in_(candidates)))
+        referenced.update(key for key, possible in owners.items() if any(owner in known for owner in possible))
+
+    return referenced
+
+
+def delete_objects(objects: list[dict]) -> tuple[int, int]:
+    """Borra los objetos (con delete_objects, de PAGE_SIZE en PAGE_SIZE). Devuelve (borrados, bytes)."""
+    deleted = reclaimed = 0
+    for start in range(0, len(objects), PAGE_SIZE):
+        batch = objects[start:start + PAGE_SIZE]
+        response = s3.delete_objects(
+            Bucket=S3_BUCKET_NAME,
+            Delete={"Objects": [{"Key": obj["Key"]} for obj in batch], "Quiet": True}
+        )
+        failed = {error["Key"] for error in response.get("Errors", [])}
+        for error in response.get("Errors", []):
+            print(f"S3 GC: error deleting {error['Key']}: {error.get('Code')} {error.get('Message')}")
+        for obj in batch:
+            if obj["Key"] not in failed:
+                deleted += 1
+                reclaimed += obj["Size"]
+    return deleted, reclaimed
+
+
+def run_gc_slice(max_seconds: float = GC_SLICE_SECONDS, dry_run: bool = GC_DRY_RUN) -> dict:
+    """
+    Revisa páginas del bucket desde el checkpoint hasta agotar `max_seconds`
+    (al menos una, y la página en curso siempre se termina) y borra los huérfanos.
+    Con `dry_run` solo cuenta lo que borraría.
+    """
+    lock = redis_client.lock(LOCK_KEY, timeout=max_seconds + 300, blocking=False)
+    if not lock.acquire():
+        print("S3 GC: another slice is already running, skipping.")
+        return {"status": "skipped"}
+
+    report = {
+        "status": "ok", "scanned": 0, "orphans": 0, "expired_cache": 0,
+        "deleted": 0, "reclaimed_bytes": 0, "pass_finished": False
+    }
+    started = time.monotonic()
+    now = datetime.now(timezone.utc)
+    cutoff = now - timedelta(seconds=GC_GRACE_SECONDS)
+    cache_prefix = f"{GEMINI_CACHE_PREFIX}/" if GEMINI_CACHE_PREFIX else None
+    cache_cutoff = now - timedelta(days=GEMINI_CACHE_TTL_DAYS) if GEMINI_CACHE_TTL_DAYS else None
+    db = SessionLocal()
+    try:
+        checkpoint = redis_client.get(CHECKPOINT_KEY)
+        start_after = checkpoint.decode() if checkpoint else ""
+        print(f"--- [S3 GC slice started after '{start_after}'] ---")
+
+        while True:
+            page = s3.list_objects_v2(Bucket=S3_BUCKET_NAME, StartAfter=start_after, MaxKeys=PAGE_SIZE)
+            objects, expired = [], []
+            for obj in page.get("Contents", []):
+                if cache_prefix and obj["Key"].startswith(cache_prefix):
+                    if cache_cutoff and obj["LastModified"] < cache_cutoff:
+                        expired.append(obj)
+                else:
+                    objects.append(obj)
+            report["scanned"] += len(page.get("Contents", []))
+            report["expired_cache"] += len(expired)
+
+            orphans = []
+            candidates = [obj for obj in objects if obj["LastModified"] < cutoff]
+            if candidates:
+                referenced = find_referenced(db, [obj["Key"] for obj in candidates])
+                orphans = [obj for obj in candidates if obj["Key"] not in referenced]
+                report["orphans"] += len(orphans)
+                db.rollback()  # Cerrar la transacción de lectura entre páginas
+            if (orphans or expired) and not dry_run:
+                deleted, reclaimed = delete_objects(orphans + expired)
+                report["deleted"] += deleted
+                report["reclaimed_bytes"] += reclaimed
+
+            if not page.get("IsTruncated"):
+                # Fin del bucket: la próxima llamada empieza una pasada nueva
+                redis_client.delete(CHECKPOINT_KEY)
+                report["pass_finished"] = True
+                break
+            start_after = page["Contents"][-1]["Key"]
+            redis_client.set(CHECKPOINT_KEY, start_after)
+            if time.monotonic() - started >= max_seconds:
+                break
+
+        if not dry_run:
+            pipe = redis_client.pipeline()
+            pipe.hincrby(STATS_KEY, "scanned", report["scanned"])
+            pipe.hincrby(STATS_KEY, "deleted", report["deleted"])
+            pipe.hincrby(STATS_KEY, "reclaimed_bytes", report["reclaimed_bytes"])
+            if report["pass_finished"]:
+                pipe.hincrby(STATS_KEY, "passes", 1)
+            pipe.execute()
+
+        print(
+            f"S3 GC slice: scanned {report['scanned']} objects in {time.monotonic() - started:.1f}s, "
+            f"{report['orphans']} orphaned, {report['expired_cache']} expired Gemini results, deleted {report['deleted']} "
+            f"({report['reclaimed_bytes'] / (1024 * 1024):.1f} MiB reclaimed)"
+            + (" [dry run]" if dry_run else "")
+        )
+        return report
+
+    except Exception as e:
+        print(f"FATAL ERROR in S3 GC slice: {e}")
+        return {**report, "status": "error", "error": str(e)}
+    finally:
+        db.close()
+        try:
+            lock.release()
+        except Exception:
+            pass  # Caducó mientras se ejecutaba el tramo
+
+
+def stats() -> dict:
+    raw = redis_client.hgetall(STATS_KEY)
+    counters = {k.decode(): int(v) for k, v in raw.items()}
+    checkpoint = redis_client.get(CHECKPOINT_KEY)
+    counters["checkpoint"] = checkpoint.decode() if checkpoint else None
+    counters["running"] = bool(redis_client.exists(LOCK_KEY))
+    return counters
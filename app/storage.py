@@ -0,0 +1,164 @@
+"""
+Acceso a S3: clientes boto3 y una capa asíncrona para las rutas.
+
+boto3 es bloqueante. Las rutas async no deben llamarlo directamente (bloquearía el
+event loop) ni desde el threadpool genérico de anyio (40 hilos compartidos con
+todas las rutas sync). Las llamadas async pasan por un executor propio con tantos
+hilos como conexiones tiene el pool HTTP del cliente (S3_MAX_POOL_CONNECTIONS),
+así que un hilo nunca espera por una conexión. La espera que queda, la cola del
+executor, se mide para /templates/admin/stats.
+
+El pool es uno por proceso (cada worker de gunicorn tiene el suyo).
+
+Los clientes se construyen en el primer uso, no al importar: boto3 y botocore
+tardan en cargarse y en leer los modelos del servicio, y un worker que arranca
+no los necesita hasta la primera petición que toca S3.
+"""
+import threading
+
+from app.config import (
+    S3_REGION,
+    S3_ACCESS_KEY,
+    S3_SECRET_KEY,
+    S3_ENDPOINT,
+    S3_USE_SSL,
+    S3_PUBLIC_ENDPOINT,
+    S3_MAX_POOL_CONNECTIONS,
+    S3_CONNECT_TIMEOUT_SECONDS,
+    S3_READ_TIMEOUT_SECONDS,
+    S3_MAX_ATTEMPTS
+)
+from app.executors import MeteredExecutor
+from app.resilience import CircuitBreaker
+
+# ============================================================
+#  CONFIGURAR CLIENTE S3
+# ============================================================
+
+protocol = "https" if S3_USE_SSL else "http"
+
+if S3_ENDPOINT.startswith("http"):
+    endpoint_url = S3_ENDPOINT
+else:
+    endpoint_url = f"{protocol}://{S3_ENDPOINT}"
+
+if S3_PUBLIC_ENDPOINT:
+    public_endpoint_url = S3_PUBLIC_ENDPOINT if S3_PUBLIC_ENDPOINT.startswith("http") else f"{protocol}://{S3_PUBLIC_ENDPOINT}"
+else:
+    public_endpoint_url = endpoint_url
+
+# boto3.client() no es thread-safe sobre la sesión por defecto: un único lock
+# para construir cualquiera de los clientes
+_client_lock = threading.Lock()
+
+
+class LazyClient:
+    """
+    Cliente boto3 que se construye la primera vez que se usa.
+
+    Reenvía cualquier atributo al cliente real, así que se usa igual que uno
+    normal (s3.get_object(...), s3.exceptions.NoSuchKey, s3.meta.events...).
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+
+    def get(self):
+        if self._client is None:
+            with _client_lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return self._client
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._client is not None
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+def build_client(url: str):
+    import boto3
+    from botocore.config import Config as BotocoreConfig
+
+    config = BotocoreConfig(
+        region_name=S3_REGION,
+        signature_version="s3v4",
+        s3={"addressing_style": "path"},
+        retries={"max_attempts": S3_MAX_ATTEMPTS, "mode": "adaptive"},
+        max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+        connect_timeout=S3_CONNECT_TIMEOUT_SECONDS,
+        read_timeout=S3_READ_TIMEOUT_SECONDS,
+    )
+    return boto3.client(
+        "s3",
+        endpoint_url=url,
+        aws_access_key_id=S3_ACCESS_KEY,
+        aws_secret_access_key=S3_SECRET_KEY,
+        config=config,
+        verify=S3_USE_SSL
+    )
+
+
+def build_s3_client():
+    client = build_client(endpoint_url)
+    register_breaker(client)
+    return client
+
+
+s3 = LazyClient(build_s3_client)
+
+# La firma s3v4 incluye el host: si los clientes acceden a S3 por otra URL
+# (p.ej. MinIO publicado fuera de la red de docker) se firma con ese endpoint.
+# Este cliente solo se usa para construir URLs, nunca hace peticiones.
+if S3_PUBLIC_ENDPOINT:
+    s3_public = LazyClient(lambda: build_client(public_endpoint_url))
+else:
+    s3_public = s3
+
+
+# ============================================================
+#  CIRCUIT BREAKER
+# ============================================================
+# Se engancha a los eventos del cliente, así que cubre todas las llamadas (rutas,
+# worker, upload_fileobj...). Los reintentos con backoff ya los hace botocore;
+# before-call/after-call se emiten una vez por operación, después de sus reintentos.
+# Solo cuentan como caída los errores de red y los 5xx (no un 404 o un 304).
+s3_breaker = CircuitBreaker("s3")
+
+
+def _check_breaker(**kwargs):
+    s3_breaker.check()
+
+
+def _record_response(http_response, **kwargs):
+    status = http_response.status_code
+    if status >= 500:
+        s3_breaker.record_failure()
+    elif status < 400:
+        s3_breaker.record_success()
+    # Los 4xx (objeto inexistente, condición no cumplida...) no dicen si S3 está sano
+
+
+def _record_error(exception, **kwargs):
+    s3_breaker.record_failure()
+
+
+def register_breaker(client):
+    client.meta.events.register("before-call.s3", _check_breaker)
+    client.meta.events.register("after-call.s3", _record_response)
+    client.meta.events.register("after-call-error.s3", _record_error)
+
+
+# ============================================================
+#  CAPA ASÍNCRONA
+# ============================================================
+# Sin límite de cola: las peticiones de imágenes esperan a que haya conexión libre
+s3_executor = MeteredExecutor(S3_MAX_POOL_CONNECTIONS, "s3")
+
+
+async def run_s3(fn, *args, **kwargs):
+    """Llama a un método del cliente (o cualquier operación bloqueante de S3) sin bloquear el event loop."""
+    return await s3_executor.run(fn, *args, **kwargs)
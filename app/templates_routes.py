@@ -1,25 +1,74 @@
+import asyncio
+import base64
+import heapq
+import json
+import re
+import time
 import uuid
-from io import BytesIO
-from PIL import Image, ImageOps
-import boto3
-import botocore
-from botocore.config import Config as BotocoreConfig
-from fastapi import APIRouter, UploadFile, File, Depends, HTTPException, BackgroundTasks
-from fastapi.responses import StreamingResponse
-from sqlalchemy import or_
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from tempfile import SpooledTemporaryFile
+from urllib.parse import quote
+from PIL import Image
+import botocore.exceptions
+from fastapi import APIRouter, UploadFile, File, Depends, HTTPException, BackgroundTasks, Request, Query
+from fastapi.responses import RedirectResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import and_, literal, or_, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
-from app.utils import get_current_user, process_with_gemini
-from app.db import get_db, SessionLocal
-from app import models
+from app.utils import get_current_user, get_current_user_id, get_current_user_or_query_token, password_executor
+from app import gemini_gateway, s3_gc, catalogue_cache
+from app.db import get_db, get_async_db, SessionLocal, pool_stats
+from app import models, jobs
+from app.user_cache import user_cache
+from app.image_cache import CachedImage, ImageCache, FrameCache
+from app.imaging import (
+    ensure_frame_fills_canvas,
+    load_image_corrected,
+    integrate_photo_with_frame,
+    apply_fixed_transparent_window,
+    window_rect,
+    output_encoding,
+    encode_image,
+    make_renditions,
+    OUTPUT_FORMATS,
+    CANVAS_WIDTH,
+    CANVAS_HEIGHT
+)
+from app.redis_client import redis_client, async_redis_client
+from app.storage import s3, s3_public, public_endpoint_url, s3_executor, run_s3, s3_breaker
+from app.resilience import CircuitOpenError
 from app.config import (
     S3_BUCKET_NAME,
-    S3_REGION,
-    S3_ACCESS_KEY,
-    S3_SECRET_KEY,
-    S3_ENDPOINT,
-    S3_USE_SSL,
-    URL_PRODUCTION
+    S3_PRESIGNED_URL_EXPIRES,
+    IMAGE_DELIVERY_MODE,
+    URL_PRODUCTION,
+    IMAGE_STREAM_CHUNK_SIZE,
+    IMAGE_CACHE_CONTROL,
+    IMAGE_CACHE_MEMORY_MAX_BYTES,
+    IMAGE_CACHE_MEMORY_TTL,
+    IMAGE_CACHE_DISK_DIR,
+    IMAGE_CACHE_DISK_MAX_BYTES,
+    IMAGE_CACHE_DISK_TTL,
+    IMAGE_CACHE_MAX_ITEM_BYTES,
+    MAX_IMAGE_PIXELS,
+    MAX_UPLOAD_BYTES,
+    UPLOAD_SPOOL_MAX_MEMORY,
+    RESULT_IMAGE_FORMAT,
+    RESULT_IMAGE_QUALITY,
+    TEMPLATE_PNG_COMPRESS_LEVEL,
+    RENDITION_WIDTHS,
+    RENDITION_FORMAT,
+    RENDITION_QUALITY,
+    FRAME_CACHE_MAX_BYTES,
+    CLEANUP_BATCH_SIZE,
+    LIST_PAGE_SIZE,
+    LIST_MAX_PAGE_SIZE,
+    JOB_EVENTS_TIMEOUT_SECONDS,
+    JOB_EVENTS_KEEPALIVE_SECONDS,
+    JOB_TIMEOUT_SECONDS
 )
 
 class PromptRequest(BaseModel):
@@ -27,110 +76,495 @@ class PromptRequest(BaseModel):
 
 router = APIRouter(prefix="/templates", tags=["templates"])
 
+def image_url(s3_key: str) -> str:
+    """URL que reciben los clientes para descargar una imagen, según IMAGE_DELIVERY_MODE."""
+    if IMAGE_DELIVERY_MODE == "presigned":
+        return s3_public.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": S3_BUCKET_NAME, "Key": s3_key},
+            ExpiresIn=S3_PRESIGNED_URL_EXPIRES
+        )
+    if IMAGE_DELIVERY_MODE == "public":
+        return f"{public_endpoint_url}/{S3_BUCKET_NAME}/{quote(s3_key)}"
+    return f"{URL_PRODUCTION}/templates/image/{s3_key}"
+
+
 # ============================================================
-#  CONFIGURAR CLIENTE S3 
+#  MINIATURAS: se generan junto al original con la clave {original}_w{ancho}.{ext}
+#  y el registro guarda cuáles hay en la columna `renditions` ("webp:240,540")
 # ============================================================
+def rendition_key(s3_key: str, width: int, fmt: str = RENDITION_FORMAT) -> str:
+    stem = s3_key.rsplit(".", 1)[0]
+    return f"{stem}_w{width}.{OUTPUT_FORMATS[fmt][2]}"
 
-protocol = "https" if S3_USE_SSL else "http"
 
-if S3_ENDPOINT.startswith("http"):
-    endpoint_url = S3_ENDPOINT
-else:
-    endpoint_url = f"{protocol}://{S3_ENDPOINT}"
+def format_renditions(widths, fmt: str = RENDITION_FORMAT) -> str | None:
+    return f"{fmt}:{','.join(str(w) for w in sorted(widths))}" if widths else None
 
-config = BotocoreConfig(
-    region_name=S3_REGION,
-    signature_version="s3v4",
-    s3={"addressing_style": "path"},
-    retries={"max_attempts": 3, "mode": "adaptive"},
-)
 
-s3 = boto3.client(
-    "s3",
-    endpoint_url=endpoint_url,
-    aws_access_key_id=S3_ACCESS_KEY,
-    aws_secret_access_key=S3_SECRET_KEY,
-    config=config,
-    verify=S3_USE_SSL
+def parse_renditions(value: str | None) -> tuple[str, list[int]]:
+    if not value or ":" not in value:
+        return RENDITION_FORMAT, []
+    fmt, widths = value.split(":", 1)
+    return fmt, [int(w) for w in widths.split(",") if w]
+
+
+def rendition_keys(record) -> list[str]:
+    fmt, widths = parse_renditions(record.renditions)
+    return [rendition_key(record.s3_key, w, fmt) for w in widths]
+
+
+def pick_rendition(widths, size: int) -> int | None:
+    """La miniatura más pequeña que llega a `size` px de ancho (None: hace falta el original)."""
+    candidates = [w for w in widths if w >= size]
+    return min(candidates) if candidates else None
+
+
+def thumbnail_url(record) -> str | None:
+    """Miniatura del registro; None mientras el trabajo no termina (aún no está en S3)."""
+    if (record.status or jobs.JOB_DONE) != jobs.JOB_DONE:
+        return None
+    return rendition_url(record.s3_key, record.renditions)
+
+
+def rendition_url(s3_key: str, renditions: str | None) -> str:
+    """URL de la miniatura más pequeña (la del original si no tiene miniaturas)."""
+    fmt, widths = parse_renditions(renditions)
+    if not widths:
+        return image_url(s3_key)
+    return image_url(rendition_key(s3_key, min(widths), fmt))
+
+# Codificación de los resultados: las plantillas llevan la ventana transparente
+# (PNG); las fotos integradas son opacas y usan RESULT_IMAGE_FORMAT
+TEMPLATE_ENCODING = output_encoding("png", compress_level=TEMPLATE_PNG_COMPRESS_LEVEL)
+RESULT_ENCODING = output_encoding(RESULT_IMAGE_FORMAT, quality=RESULT_IMAGE_QUALITY)
+
+
+def upload_encoded(img: Image.Image, s3_key: str, encoding, rendition_widths=None, rendition_format: str = RENDITION_FORMAT):
+    """
+    Codifica `img` y la sube a S3 con su content type, junto con sus miniaturas.
+    Las miniaturas se suben primero: cuando el original existe, ya están todas.
+    `rendition_format` es el que se guardó en la columna `renditions` al encolar.
+    """
+    rendition_encoding = output_encoding(rendition_format, quality=RENDITION_QUALITY)
+    uploads = [
+        (rendition_key(s3_key, width, rendition_format), rendition, rendition_encoding)
+        for width, rendition in make_renditions(img, rendition_widths or [])
+    ]
+    uploads.append((s3_key, img, encoding))
+
+    for key, image, image_encoding in uploads:
+        s3.put_object(
+            Bucket=S3_BUCKET_NAME,
+            Key=key,
+            Body=encode_image(image, image_encoding),
+            ContentType=image_encoding.content_type,
+            ACL="public-read"
+        )
+    invalidate_images([key for key, _, _ in uploads])
+
+# ============================================================
+#  CACHÉ DE IMÁGENES (memoria + disco local) delante de S3
+# ============================================================
+image_cache = ImageCache(
+    memory_max_bytes=IMAGE_CACHE_MEMORY_MAX_BYTES,
+    memory_ttl=IMAGE_CACHE_MEMORY_TTL,
+    disk_dir=IMAGE_CACHE_DISK_DIR,
+    disk_max_bytes=IMAGE_CACHE_DISK_MAX_BYTES,
+    max_item_bytes=IMAGE_CACHE_MAX_ITEM_BYTES,
+    disk_ttl=IMAGE_CACHE_DISK_TTL
 )
 
+# Cada worker de la API tiene su propia memoria (y cada máquina su disco): los
+# borrados y sobrescrituras se avisan por pub/sub a todos los procesos, que quitan
+# la clave de su caché (listen_image_invalidations). Si la suscripción se corta se
+# vacían memoria y disco, porque pudo perderse algún aviso; y si falla la publicación,
+# ninguna entrada vive más de IMAGE_CACHE_MEMORY_TTL en memoria ni de
+# IMAGE_CACHE_DISK_TTL en disco.
+IMAGE_CACHE_CHANNEL = "totem:image-cache:invalidate"
+IMAGE_CACHE_RESUBSCRIBE_SECONDS = 5
+
+
+def invalidate_images(keys):
+    """Quita las claves de la caché de este proceso y avisa a los demás (API de todas las máquinas)."""
+    for key in keys:
+        image_cache.invalidate(key)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.publish(IMAGE_CACHE_CHANNEL, key)
+        pipe.execute()
+    except Exception as e:
+        print(f"Error publishing image cache invalidation: {e}")
+
+
+async def listen_image_invalidations():
+    """Aplica los avisos de invalidación de los demás procesos. La arranca el lifespan de app.main."""
+    while True:
+        pubsub = async_redis_client.pubsub()
+        try:
+            await pubsub.subscribe(IMAGE_CACHE_CHANNEL)
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=30)
+                if message is None:
+                    continue
+                key = message["data"].decode()
+                if image_cache.disk:
+                    await run_in_threadpool(image_cache.invalidate, key)
+                else:
+                    image_cache.invalidate(key)
+        except Exception as e:
+            print(f"Image cache invalidation listener error: {e}")
+            image_cache.memory.clear()
+            if image_cache.disk:
+                await run_in_threadpool(image_cache.disk.clear)
+            await asyncio.sleep(IMAGE_CACHE_RESUBSCRIBE_SECONDS)
+        finally:
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
+
+# Plantillas decodificadas para el worker: una plantilla pública se reutiliza
+# para miles de fotos en un evento y así no se descarga ni decodifica cada vez
+frame_cache = FrameCache(FRAME_CACHE_MAX_BYTES)
+
+
+def load_template_frame(s3_key: str) -> Image.Image:
+    """
+    Devuelve la plantilla decodificada en RGBA. Si está en caché se revalida con
+    un GET condicional por ETag (304 sin cuerpo); si el objeto cambió o ya no
+    existe, la entrada se descarta. La imagen devuelta es compartida: no modificarla.
+    """
+    cached = frame_cache.get(s3_key)
+    params = {"IfNoneMatch": cached[0]} if cached and cached[0] else {}
+    try:
+        obj = s3.get_object(Bucket=S3_BUCKET_NAME, Key=s3_key, **params)
+    except botocore.exceptions.ClientError as e:
+        if params and s3_error_code(e) == "304":
+            frame_cache.hits += 1
+            return cached[1]
+        frame_cache.invalidate(s3_key)
+        raise
+
+    frame_cache.misses += 1
+    with obj["Body"] as body:
+        frame_img = Image.open(body).convert("RGBA")
+    frame_cache.set(s3_key, obj.get("ETag"), frame_img)
+    return frame_img
+
+
+async def require_available(*breakers):
+    """
+    503 con Retry-After si alguna dependencia que necesita el trabajo está caída
+    (breaker abierto): mejor fallar ya que encolar trabajo que va a fallar.
+    El estado se lee de Redis con el cliente síncrono, así que va al threadpool.
+    """
+    for breaker in breakers:
+        retry_after = await run_in_threadpool(breaker.retry_after)
+        if retry_after:
+            raise HTTPException(
+                status_code=503,
+                detail=f"{breaker.name} temporarily unavailable",
+                headers={"Retry-After": str(retry_after)}
+            )
+
+
+async def enqueue_job(db: AsyncSession, record, task_name: str, args: dict):
+    """
+    Encola el procesamiento del registro recién creado (el id del trabajo es el del registro).
+    Si Redis no responde se borra el registro, para no dejar filas sin trabajo, y se responde 503.
+    """
+    try:
+        await run_in_threadpool(jobs.enqueue, task_name, record.id, args)
+    except Exception as e:
+        print(f"Error enqueuing job {record.id}: {e}")
+        await db.delete(record)
+        await db.commit()
+        if args.get("upload_key"):
+            await run_s3(discard_staged_upload, args["upload_key"])
+        raise HTTPException(status_code=503, detail="Processing queue unavailable")
+
+# ============================================================
+#  SUBIDAS: se copian a una clave temporal de S3 y el worker las lee de ahí
+# ============================================================
+def staging_key(upload_id: str) -> str:
+    """Clave temporal de la subida; el id es el del registro (y el del trabajo)."""
+    return f"staging/{upload_id}"
+
+
+async def stage_upload(file: UploadFile, key: str):
+    """
+    Copia la subida a S3 por partes, sin leerla entera en memoria: Starlette ya la
+    tiene en un SpooledTemporaryFile y el límite de tamaño lo aplica UploadSizeLimitMiddleware.
+    """
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Upload too large (max {MAX_UPLOAD_BYTES} bytes)")
+
+    await file.seek(0)
+    try:
+        await run_s3(
+            s3.upload_fileobj,
+            file.file,
+            S3_BUCKET_NAME,
+            key,
+            ExtraArgs={"ContentType": file.content_type or "application/octet-stream"}
+        )
+    except CircuitOpenError as e:
+        raise HTTPException(status_code=503, detail="Storage unavailable", headers={"Retry-After": str(e.retry_after)})
+    except Exception as e:
+        print(f"Error staging upload {key}: {e}")
+        raise HTTPException(status_code=503, detail="Storage unavailable")
+
+
+def open_staged_upload(key: str) -> SpooledTemporaryFile:
+    """Descarga la subida a un fichero temporal: en memoria hasta UPLOAD_SPOOL_MAX_MEMORY, luego a disco."""
+    spool = SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_MEMORY)
+    try:
+        s3.download_fileobj(S3_BUCKET_NAME, key, spool)
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+def discard_staged_upload(key: str):
+    try:
+        s3.delete_object(Bucket=S3_BUCKET_NAME, Key=key)
+    except Exception as e:
+        print(f"Error deleting staged upload {key}: {e}")
+
 # ==============================
 #  SUBIR TEMPLATE
 # ==============================
 @router.post("/upload")
 async def upload_template(
-    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user=Depends(get_current_user)
 ):
     if file.content_type not in ["image/png", "image/jpeg", "image/jpg", "image/webp", "image/heic"]:
         raise HTTPException(status_code=400, detail="Invalid image type")
 
-    contents = await file.read()
+    await require_available(s3_breaker, gemini_gateway.gemini_breaker)
 
     # Generar UUID y clave S3
     uid = str(uuid.uuid4())
-    s3_key = f"{current_user.id}/{uid}.png"
+    s3_key = f"{current_user.id}/{uid}.{TEMPLATE_ENCODING.extension}"
+
+    # Copiar la referencia a S3 para el worker
+    await stage_upload(file, staging_key(uid))
 
     # Guardar en la base de datos
-    template = models.Template(id=uid, user_id=current_user.id, s3_key=s3_key)
+    template = models.Template(
+        id=uid,
+        user_id=current_user.id,
+        s3_key=s3_key,
+        content_type=TEMPLATE_ENCODING.content_type,
+        renditions=format_renditions(RENDITION_WIDTHS)
+    )
     db.add(template)
-    db.commit()
-    db.refresh(template)
-
-    background_tasks.add_task(process_and_upload_template, contents, s3_key, current_user.id)
+    await db.commit()
+
+    await enqueue_job(
+        db,
+        template,
+        "process_and_upload_template",
+        {
+            "s3_key": s3_key,
+            "user_id": current_user.id,
+            "upload_key": staging_key(uid),
+            "rendition_widths": RENDITION_WIDTHS,
+            "rendition_format": RENDITION_FORMAT
+        }
+    )
     return {"uuid": uid}
 
 
 # ==============================
 #  LISTAR TEMPLATES
 # ==============================
+# ==============================
+#  PAGINACIÓN DE LOS LISTADOS
+#  Por cursor sobre (created_at, id), de más reciente a más antiguo: cada página
+#  es una búsqueda por índice, sin OFFSET. El cursor de la página siguiente va en
+#  la cabecera X-Next-Cursor (ausente en la última página).
+# ==============================
+def encode_cursor(created_at: datetime, record_id: str) -> str:
+    raw = json.dumps([created_at.isoformat(), record_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, record_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), str(record_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def paginate(query, model, cursor: str | None, limit: int) -> tuple[list, str | None]:
+    """Aplica el cursor y el límite a `query` (columnas de `model`). Devuelve (filas, cursor siguiente)."""
+    if cursor:
+        created_at, record_id = decode_cursor(cursor)
+        query = query.filter(tuple_(model.created_at, model.id) < tuple_(created_at, record_id))
+    rows = query.order_by(model.created_at.desc(), model.id.desc()).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1].created_at, rows[-1].id)
+
+
 @router.get("/my")
-def list_templates(db: Session = Depends(get_db), current_user=Depends(get_current_user)):
-    templates = db.query(models.Template).filter_by(user_id=current_user.id).all()
+def list_templates(
+    response: Response,
+    cursor: str | None = None,
+    limit: int = Query(LIST_PAGE_SIZE, ge=1, le=LIST_MAX_PAGE_SIZE),
+    db: Session = Depends(get_db),
+    user_id: str = Depends(get_current_user_id)
+):
+    # Solo las columnas que se devuelven, sin cargar objetos del ORM
+    query = db.query(
+        models.Template.id,
+        models.Template.s3_key,
+        models.Template.renditions,
+        models.Template.status,
+        models.Template.created_at
+    ).filter(models.Template.user_id == user_id)
+    rows, next_cursor = paginate(query, models.Template, cursor, limit)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
     result = []
-    for t in templates:
-        proxy_url = f"{URL_PRODUCTION}/templates/image/{current_user.id}/{t.id}.png"
+    for t in rows:
         result.append({
             "uuid": t.id,
             "s3_key": t.s3_key,
-            "url": proxy_url
+            "url": image_url(t.s3_key),
+            "thumbnail_url": thumbnail_url(t),
+            "status": t.status or jobs.JOB_DONE
         })
     return result
 
 @router.get("/my-with-images")
-def list_templates_with_images(db: Session = Depends(get_db), current_user=Depends(get_current_user)):
-    images = db.query(models.TemplateWithImage).filter_by(user_id=current_user.id).all()
+def list_templates_with_images(
+    response: Response,
+    cursor: str | None = None,
+    limit: int = Query(LIST_PAGE_SIZE, ge=1, le=LIST_MAX_PAGE_SIZE),
+    db: Session = Depends(get_db),
+    user_id: str = Depends(get_current_user_id)
+):
+    query = db.query(
+        models.TemplateWithImage.id,
+        models.TemplateWithImage.s3_key,
+        models.TemplateWithImage.renditions,
+        models.TemplateWithImage.content_type,
+        models.TemplateWithImage.status,
+        models.TemplateWithImage.created_at
+    ).filter(models.TemplateWithImage.user_id == user_id)
+    rows, next_cursor = paginate(query, models.TemplateWithImage, cursor, limit)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
     result = []
-    for img in images:
-        proxy_url = f"{URL_PRODUCTION}/templates/image/{current_user.id}/{img.id}.png"
+    for img in rows:
         result.append({
             "uuid": img.id,
-            "url": proxy_url
+            "url": image_url(img.s3_key),
+            "thumbnail_url": thumbnail_url(img),
+            "content_type": img.content_type or "image/png",
+            "status": img.status or jobs.JOB_DONE
         })
     return result
 
-@router.get("/public")
-def list_public_templates(db: Session = Depends(get_db)):
-    """Devuelve todas las plantillas marcadas como públicas """
-    templates = db.query(models.Template).filter(models.Template.is_public == True).all()
-    
-    result = []
-    # Usamos un ID genérico o 'system' en la URL si el user_id es nulo
-    for t in templates:
-        # Si el template no tiene usuario (es del sistema), ajustamos la ruta
-        folder = t.user_id if t.user_id else "system"
-        
-        proxy_url = f"{URL_PRODUCTION}/templates/image/{folder}/{t.id}.png"
-        
-        result.append({
+def load_public_templates(cursor: str | None, limit: int) -> tuple[list, str | None]:
+    """
+    Filas de una página del catálogo público, sin URLs (es lo que se cachea).
+    Abre su propia sesión: solo se llega aquí cuando la página no está en caché.
+    """
+    db = SessionLocal()
+    try:
+        query = db.query(
+            models.Template.id,
+            models.Template.s3_key,
+            models.Template.renditions,
+            models.Template.status,
+            models.Template.created_at
+        ).filter(models.Template.is_public == True)
+        rows, next_cursor = paginate(query, models.Template, cursor, limit)
+    finally:
+        db.close()
+
+    result = [
+        {
             "uuid": t.id,
             "s3_key": t.s3_key,
-            "url": proxy_url,
-            "is_public": True
-        })
-    return result
+            "renditions": t.renditions,
+            "status": t.status or jobs.JOB_DONE
+        }
+        for t in rows
+    ]
+    return result, next_cursor
+
+
+def render_public_templates(rows: list) -> str:
+    """Cuerpo de /templates/public: las filas cacheadas con sus URLs."""
+    # La clave S3 ya incluye la carpeta: el user_id, o 'system' si el template es del sistema
+    return json.dumps([
+        {
+            "uuid": row["uuid"],
+            "s3_key": row["s3_key"],
+            "url": image_url(row["s3_key"]),
+            "thumbnail_url": rendition_url(row["s3_key"], row["renditions"]) if row["status"] == jobs.JOB_DONE else None,
+            "is_public": True,
+            "status": row["status"]
+        }
+        for row in rows
+    ], separators=(",", ":"))
+
+
+@router.get("/public")
+async def list_public_templates(
+    request: Request,
+    cursor: str | None = None,
+    limit: int = Query(LIST_PAGE_SIZE, ge=1, le=LIST_MAX_PAGE_SIZE)
+):
+    """
+    Devuelve las plantillas marcadas como públicas (paginadas, las más recientes primero).
+    Las páginas se sirven desde Redis (catalogue_cache) y admiten If-None-Match.
+    Un acierto no toca la BD ni el threadpool (salvo en modo presigned, que firma las URLs).
+    """
+    if cursor:
+        decode_cursor(cursor)  # 400 antes de tocar la caché
+
+    field = catalogue_cache.page_field(cursor, limit)
+    entry = await catalogue_cache.get_page(field)
+    if entry is None:
+        version = await catalogue_cache.current_version()
+        rows, next_cursor = await run_in_threadpool(load_public_templates, cursor, limit)
+        content = None if IMAGE_DELIVERY_MODE == "presigned" else render_public_templates(rows)
+        entry = catalogue_cache.make_entry(rows, next_cursor, content)
+        await catalogue_cache.store_page(field, entry, version)
+
+    headers = {"Cache-Control": "no-cache"}
+    if entry["next_cursor"]:
+        headers["X-Next-Cursor"] = entry["next_cursor"]
+
+    if IMAGE_DELIVERY_MODE == "presigned":
+        # Firmas nuevas en cada respuesta y sin ETag: con un 304 el kiosco seguiría
+        # usando las URLs de su copia, que caducan a los S3_PRESIGNED_URL_EXPIRES
+        content = await run_in_threadpool(render_public_templates, entry["rows"])
+        return Response(content=content, media_type="application/json", headers=headers)
+
+    # Los kioscos revalidan en cada arranque; si nada cambió, 304 sin cuerpo
+    headers["ETag"] = entry["etag"]
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        if "*" in candidates or entry["etag"] in candidates:
+            return Response(status_code=304, headers=headers)
+    content = entry["content"] or render_public_templates(entry["rows"])
+    return Response(content=content, media_type="application/json", headers=headers)
 
 
 # ==============================
@@ -139,47 +573,56 @@ def list_public_templates(db: Session = Depends(get_db)):
 @router.post("/integrate/{template_id}")
 async def integrate_person(
     template_id: str,
-    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user=Depends(get_current_user)
 ):
     #  Buscar plantilla privada o pública
-    template = db.query(models.Template).filter(
+    template = await db.scalar(select(models.Template).where(
         models.Template.id == template_id,
         or_(
             models.Template.user_id == current_user.id,
             models.Template.is_public == True
         )
-    ).first()
+    ))
 
     if not template:
         raise HTTPException(status_code=404, detail="Template not found")
 
+    await require_available(s3_breaker)
+
     #  NUEVA imagen integrada
     new_uid = str(uuid.uuid4())
-    s3_key = f"{current_user.id}/{new_uid}.png"
+    s3_key = f"{current_user.id}/{new_uid}.{RESULT_ENCODING.extension}"
+
+    # Copiar la foto a S3 para el worker
+    await stage_upload(file, staging_key(new_uid))
 
     # Guardar relación en BD
     template_with_image = models.TemplateWithImage(
         id=new_uid,
         user_id=current_user.id,
         s3_key=s3_key,
+        content_type=RESULT_ENCODING.content_type,
+        renditions=format_renditions(RENDITION_WIDTHS),
         template_id=template.id
     )
     db.add(template_with_image)
-    db.commit()
-    db.refresh(template_with_image)
-
-    # Leer foto
-    contents = await file.read()
+    await db.commit()
 
     #  Integrar usando el S3 KEY REAL del template
-    background_tasks.add_task(
-        process_and_integrate_person,
-        template.s3_key,   #  IMPORTANTE (system/xxx.png o user/xxx.png)
-        contents,
-        s3_key
+    await enqueue_job(
+        db,
+        template_with_image,
+        "process_and_integrate_person",
+        {
+            "template_s3_key": template.s3_key,   #  IMPORTANTE (system/xxx.png o user/xxx.png)
+            "output_s3_key": s3_key,
+            "upload_key": staging_key(new_uid),
+            "output_format": RESULT_IMAGE_FORMAT,
+            "rendition_widths": RENDITION_WIDTHS,
+            "rendition_format": RENDITION_FORMAT
+        }
     )
 
     return {
@@ -188,30 +631,168 @@ async def integrate_person(
     }
 
 
+# ==============================
+#  ESTADO DEL PROCESAMIENTO
+# ==============================
+def find_job_record(db: Session, job_uuid: str, user_id: str):
+    """Busca el template (propio o público) o la imagen integrada (propia) con ese UUID."""
+    template = db.query(models.Template).filter(
+        models.Template.id == job_uuid,
+        or_(
+            models.Template.user_id == user_id,
+            models.Template.is_public == True
+        )
+    ).first()
+    if template:
+        return "template", template
+
+    image = db.query(models.TemplateWithImage).filter(
+        models.TemplateWithImage.id == job_uuid,
+        models.TemplateWithImage.user_id == user_id
+    ).first()
+    if image:
+        return "image", image
+
+    raise HTTPException(status_code=404, detail="Job not found")
+
+
+def job_status_payload(kind: str, record) -> dict:
+    # Las filas anteriores a la columna de estado ya estaban procesadas
+    status = record.status or jobs.JOB_DONE
+    payload = {
+        "uuid": record.id,
+        "type": kind,
+        "status": status,
+        "started_at": record.processing_started_at.isoformat() if record.processing_started_at else None,
+        "finished_at": record.processing_finished_at.isoformat() if record.processing_finished_at else None,
+        "error": record.processing_error,
+        "url": image_url(record.s3_key) if status == jobs.JOB_DONE else None,
+    }
+
+    job = jobs.get_job(record.id)
+    if job:
+        payload["attempts"] = int(job.get("attempts") or 0)
+        payload["queued_at"] = datetime.utcfromtimestamp(float(job["created_at"])).isoformat()
+    return payload
+
+
+def sse_event(data: dict) -> str:
+    return f"event: status\ndata: {json.dumps(data)}\n\n"
+
+
+async def job_event_stream(job_id: str, s3_key: str, initial: dict):
+    """
+    Emite el estado actual y después cada cambio publicado por el worker, hasta que
+    el trabajo termina (done/failed) o vence JOB_EVENTS_TIMEOUT_SECONDS.
+    """
+    yield sse_event(initial)
+    if initial["status"] in jobs.TERMINAL_STATUSES:
+        return
+
+    pubsub = async_redis_client.pubsub()
+    await pubsub.subscribe(jobs.events_channel(job_id))
+    try:
+        # El trabajo pudo terminar entre la consulta inicial y la suscripción
+        raw_status = await async_redis_client.hget(jobs.job_key(job_id), "status")
+        if raw_status and raw_status.decode() in jobs.TERMINAL_STATUSES:
+            status = raw_status.decode()
+            yield sse_event({
+                "uuid": job_id,
+                "status": status,
+                "url": image_url(s3_key) if status == jobs.JOB_DONE else None
+            })
+            return
+
+        deadline = time.monotonic() + JOB_EVENTS_TIMEOUT_SECONDS
+        while time.monotonic() < deadline:
+            message = await pubsub.get_message(
+                ignore_subscribe_messages=True,
+                timeout=JOB_EVENTS_KEEPALIVE_SECONDS
+            )
+            if message is None:
+                yield ": keep-alive\n\n"
+                continue
+
+            event = json.loads(message["data"])
+            if event["status"] == jobs.JOB_DONE:
+                event["url"] = image_url(s3_key)
+            yield sse_event(event)
+            if event["status"] in jobs.TERMINAL_STATUSES:
+                return
+    finally:
+        await pubsub.unsubscribe()
+        await pubsub.aclose()
+
+
+@router.get("/jobs/{job_uuid}")
+def get_job_status(
+    job_uuid: str,
+    db: Session = Depends(get_db),
+    user_id: str = Depends(get_current_user_id)
+):
+    """Estado del procesamiento de un template o de una imagen integrada."""
+    kind, record = find_job_record(db, job_uuid, user_id)
+    return job_status_payload(kind, record)
+
+
+@router.get("/jobs/{job_uuid}/events")
+def stream_job_events(
+    job_uuid: str,
+    db: Session = Depends(get_db),
+    current_user=Depends(get_current_user_or_query_token)
+):
+    """
+    Server-Sent Events con los cambios de estado del trabajo; se cierra al terminar.
+    Como EventSource no permite cabeceras, el token puede ir en ?access_token=.
+    """
+    kind, record = find_job_record(db, job_uuid, current_user.id)
+    initial = job_status_payload(kind, record)
+
+    return StreamingResponse(
+        job_event_stream(record.id, record.s3_key, initial),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @router.post("/admin/generate-public-template")
 async def generate_public_template(
     request: PromptRequest,
-    background_tasks: BackgroundTasks,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user=Depends(get_current_user) 
     # Idealmente, aquí verificarías si current_user es admin
 ):
+    await require_available(s3_breaker, gemini_gateway.gemini_breaker)
+
     uid = str(uuid.uuid4())
     # Guardamos en una carpeta "system" o en la del admin, pero marcamos como público
-    s3_key = f"system/{uid}.png" 
+    s3_key = f"system/{uid}.{TEMPLATE_ENCODING.extension}"
 
     # Crear registro en BD como PÚBLICO
     template = models.Template(
         id=uid, 
         user_id=None, 
-        s3_key=s3_key, 
-        is_public=True 
+        s3_key=s3_key,
+        content_type=TEMPLATE_ENCODING.content_type,
+        renditions=format_renditions(RENDITION_WIDTHS),
+        is_public=True
     )
     db.add(template)
-    db.commit()
-
-    # Llamamos a una tarea para generar la imagen con Gemini
-    background_tasks.add_task(generate_and_upload_public_template, request.prompt, s3_key)
+    await db.commit()
+    await catalogue_cache.invalidate_async()
+
+    # Encolamos la generación de la imagen con Gemini
+    await enqueue_job(
+        db,
+        template,
+        "generate_and_upload_public_template",
+        {
+            "prompt_theme": request.prompt,
+            "s3_key": s3_key,
+            "rendition_widths": RENDITION_WIDTHS,
+            "rendition_format": RENDITION_FORMAT
+        }
+    )
 
     return {"uuid": uid, "status": "generating_public_template"}
 
@@ -229,49 +810,381 @@ def trigger_s3_cleanup(
     return {"status": "success", "message": "S3 cleanup task initiated in background."}
 
 @router.post("/admin/internal-cleanup", status_code=202, include_in_schema=False)
-def trigger_internal_cleanup(background_tasks: BackgroundTasks):
+def trigger_internal_cleanup(
+    background_tasks: BackgroundTasks,
+    scope: str = Query("records", pattern="^(all|records|objects)$")
+):
     """
     Endpoint NO protegido, para ser llamado por el cron job de Dokploy.
     Es seguro porque solo es accesible desde dentro del contenedor (localhost).
+
+    records (por defecto, lo que hacía siempre): borra los registros de la BD sin
+    objeto en S3 (perform_s3_cleanup).
+    objects: un tramo de GC_SLICE_SECONDS de la recolección de objetos huérfanos
+    en S3, que continúa donde lo dejó la llamada anterior. Solo cuenta lo que
+    borraría mientras GC_DRY_RUN no se desactive.
     """
-    print(f"Internal cleanup task triggered by Cron Job.")
-    background_tasks.add_task(perform_s3_cleanup)
+    print(f"Internal cleanup task triggered by Cron Job (scope: {scope}).")
+    if scope in ("all", "records"):
+        background_tasks.add_task(perform_s3_cleanup)
+    if scope in ("all", "objects"):
+        background_tasks.add_task(s3_gc.run_gc_slice)
     return {"status": "success", "message": "S3 internal cleanup task initiated."}
 
-@router.get("/image/{folder}/{filename}")
-def get_template_image(folder: str, filename: str):
-    """Devuelve la imagen desde S3 a través del backend con cabeceras CORS."""
-    s3_key = f"{folder}/{filename}"
+@router.get("/admin/stats")
+def get_admin_stats(current_user=Depends(get_current_user)):
+    """Contadores internos del worker que atiende la petición (cachés, etc.)."""
+    return {
+        "image_cache": image_cache.stats(),
+        "frame_cache": frame_cache.stats(),
+        "s3_pool": s3_executor.stats(),
+        "db_pool": pool_stats(),
+        "gemini": gemini_gateway.stats(),
+        "s3_gc": s3_gc.stats(),
+        "public_catalogue_cache": catalogue_cache.stats(),
+        "user_cache": user_cache.stats(),
+        "password_hashing": password_executor.stats(),
+        "circuit_breakers": {
+            "s3": s3_breaker.stats(),
+            "gemini": gemini_gateway.gemini_breaker.stats()
+        }
+    }
+
+# ==============================
+#  PROXY DE IMÁGENES
+# ==============================
+IMAGE_CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET, HEAD",
+    "Access-Control-Allow-Headers": "*"
+}
+
+# Solo se acepta un rango simple: "bytes=inicio-fin", "bytes=inicio-" o "bytes=-sufijo"
+RANGE_HEADER_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_range_header(range_header: str | None) -> str | None:
+    """
+    Devuelve el rango que se reenvía a S3, o None si la cabecera no existe o no
+    es un rango simple (en ese caso se sirve la imagen completa con 200).
+    """
+    if not range_header:
+        return None
+
+    match = RANGE_HEADER_RE.match(range_header.strip())
+    if not match:
+        return None
+
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if start and end and int(end) < int(start):
+        return None
+
+    return f"bytes={start}-{end}"
 
-    buffer = BytesIO()
+
+def resolve_byte_range(byte_range: str, size: int) -> tuple[int, int] | None:
+    """Convierte un rango ya validado en (inicio, fin) inclusivos, o None si no es satisfacible."""
+    start, end = RANGE_HEADER_RE.match(byte_range).groups()
+    if not start:
+        suffix = int(end)
+        if suffix == 0:
+            return None
+        return max(size - suffix, 0), size - 1
+
+    start = int(start)
+    if start >= size:
+        return None
+    end = min(int(end), size - 1) if end else size - 1
+    return start, end
+
+
+def s3_error_code(error: Exception) -> str | None:
+    if isinstance(error, botocore.exceptions.ClientError):
+        return error.response.get("Error", {}).get("Code")
+    return None
+
+
+def conditional_params(request: Request) -> dict:
+    """
+    Traduce If-None-Match / If-Modified-Since a los parámetros condicionales de S3.
+    Si hay If-None-Match, If-Modified-Since se ignora (RFC 9110).
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        return {"IfNoneMatch": if_none_match}
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return {"IfModifiedSince": parsedate_to_datetime(if_modified_since)}
+        except (TypeError, ValueError):
+            return {}
+
+    return {}
+
+
+def validator_headers(etag: str | None, last_modified) -> dict:
+    """Cabeceras de caché: las claves de imagen son UUIDs que nunca cambian."""
+    headers = {"Cache-Control": IMAGE_CACHE_CONTROL}
+    if etag:
+        headers["ETag"] = etag
+    if last_modified:
+        if not isinstance(last_modified, str):
+            last_modified = format_datetime(last_modified.astimezone(timezone.utc), usegmt=True)
+        headers["Last-Modified"] = last_modified
+    return headers
+
+
+def not_modified_response(error: botocore.exceptions.ClientError) -> Response:
+    """304 a partir de la respuesta condicional de S3 (sin cuerpo)."""
+    s3_headers = error.response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+    headers = dict(IMAGE_CORS_HEADERS)
+    headers.update(validator_headers(s3_headers.get("etag"), s3_headers.get("last-modified")))
+    return Response(status_code=304, headers=headers)
+
+
+def is_not_modified(request: Request, image: CachedImage) -> bool:
+    """Evalúa If-None-Match / If-Modified-Since contra los validadores cacheados."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in candidates or (image.etag is not None and image.etag in candidates)
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and image.last_modified:
+        try:
+            return parsedate_to_datetime(image.last_modified) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+
+def cached_image_response(request: Request, image: CachedImage, headers: dict) -> Response:
+    """Sirve una imagen desde la caché local (condicional, HEAD y Range incluidos)."""
+    headers.update(validator_headers(image.etag, image.last_modified))
+    if is_not_modified(request, image):
+        return Response(status_code=304, headers=headers)
+
+    size = len(image.data)
+    if request.method == "HEAD":
+        headers["Content-Length"] = str(size)
+        return Response(status_code=200, media_type=image.content_type, headers=headers)
+
+    byte_range = parse_range_header(request.headers.get("range"))
+    if byte_range:
+        bounds = resolve_byte_range(byte_range, size)
+        if bounds is None:
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response(status_code=416, headers=headers)
+        start, end = bounds
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        return Response(
+            content=image.data[start:end + 1],
+            status_code=206,
+            media_type=image.content_type,
+            headers=headers
+        )
+
+    return Response(content=image.data, media_type=image.content_type, headers=headers)
+
+
+def image_not_found(error: Exception) -> HTTPException:
+    if isinstance(error, CircuitOpenError):
+        headers = {"Access-Control-Allow-Origin": "*", "Retry-After": str(error.retry_after)}
+        return HTTPException(status_code=503, detail="Storage unavailable", headers=headers)
+    return HTTPException(
+        status_code=404,
+        detail=f"Image not found: {str(error)}",
+        headers={"Access-Control-Allow-Origin": "*"}
+    )
+
+
+async def iter_s3_body(body, chunk_size: int = IMAGE_STREAM_CHUNK_SIZE, cache_key: str | None = None, cache_meta: dict | None = None):
+    """
+    Reenvía el cuerpo de S3 en bloques según van llegando y cierra la conexión al final.
+    Cada lectura del socket pasa por el executor de S3, no por el event loop.
+    Con `cache_key`, los bloques se van guardando y, si la descarga se completa,
+    la imagen entra en la caché local, salvo que la clave se invalidara después de
+    `cache_meta["generation"]` (la descarga empezó antes de un borrado).
+    """
+    chunks = [] if cache_key else None
     try:
-        s3.download_fileobj(S3_BUCKET_NAME, s3_key, buffer)
-    except Exception as e:
-        raise HTTPException(
-            status_code=404,
-            detail=f"Image not found: {str(e)}",
-            headers={"Access-Control-Allow-Origin": "*"}
+        while True:
+            chunk = await run_s3(body.read, chunk_size)
+            if not chunk:
+                break
+            if chunks is not None:
+                chunks.append(chunk)
+            yield chunk
+    finally:
+        body.close()
+
+    if chunks is not None:
+        data = b"".join(chunks)
+        if len(data) == cache_meta["content_length"]:
+            # La caché en disco escribe un fichero: fuera del event loop
+            await run_in_threadpool(image_cache.set, cache_key, CachedImage(
+                data,
+                cache_meta["content_type"],
+                cache_meta["etag"],
+                cache_meta["last_modified"]
+            ), cache_meta["generation"])
+
+
+@router.api_route("/image/{folder}/{filename}", methods=["GET", "HEAD"])
+async def get_template_image(
+    folder: str,
+    filename: str,
+    request: Request,
+    size: int | None = Query(None, ge=1),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Devuelve la imagen desde S3 a través del backend con cabeceras CORS.
+
+    La ruta es async: las llamadas a S3 van por el executor de app.storage, con su propio
+    pool de conexiones, en lugar de ocupar el threadpool de las rutas sync.
+    El cuerpo se transmite en streaming desde S3 (no se carga entero en memoria),
+    y se soportan peticiones HEAD y Range (206 Partial Content).
+    Se reenvían ETag/Last-Modified de S3 y, ante If-None-Match/If-Modified-Since,
+    se responde 304 con una petición condicional a S3 que no descarga el cuerpo.
+    Las imágenes más pedidas se sirven desde la caché local (memoria + disco).
+
+    Con `size` (ancho en px) se sirve la miniatura más pequeña que lo cubre, o el
+    original si no hay ninguna (p.ej. imágenes anteriores a las miniaturas).
+
+    En los modos 'presigned' y 'public' no se sirven bytes: se redirige (302) a S3.
+    """
+    s3_key = f"{folder}/{filename}"
+    headers = dict(IMAGE_CORS_HEADERS)
+
+    if IMAGE_DELIVERY_MODE != "proxy":
+        # Sin HEAD a S3: las miniaturas que existen son las que guardó el registro
+        # (ancho y formato con los que se generaron, no los de la config actual)
+        target = s3_key
+        if size:
+            fmt, widths = parse_renditions(await load_renditions(db, s3_key))
+            width = pick_rendition(widths, size)
+            if width:
+                target = rendition_key(s3_key, width, fmt)
+        # Una URL firmada caduca, así que la redirección no debe cachearse
+        headers["Cache-Control"] = "no-cache" if IMAGE_DELIVERY_MODE == "presigned" else IMAGE_CACHE_CONTROL
+        return RedirectResponse(image_url(target), status_code=302, headers=headers)
+
+    width = pick_rendition(RENDITION_WIDTHS, size) if size else None
+    if width:
+        try:
+            return await serve_s3_image(rendition_key(s3_key, width), request, dict(headers))
+        except HTTPException:
+            pass  # Sin miniatura: se sirve el original
+
+    return await serve_s3_image(s3_key, request, headers)
+
+
+async def load_renditions(db: AsyncSession, s3_key: str) -> str | None:
+    """Columna `renditions` del registro de `s3_key` (su id es el nombre del fichero)."""
+    record_id = s3_key.rsplit("/", 1)[-1].rsplit(".", 1)[0]
+    for model in (models.Template, models.TemplateWithImage):
+        row = (await db.execute(
+            select(model.renditions).where(model.id == record_id, model.s3_key == s3_key)
+        )).first()
+        if row:
+            return row.renditions
+    return None
+
+
+async def serve_s3_image(s3_key: str, request: Request, headers: dict) -> Response:
+    """Respuesta del proxy para un objeto concreto (caché, HEAD, condicionales y Range)."""
+    headers["Accept-Ranges"] = "bytes"
+
+    cached = image_cache.get_memory(s3_key)
+    if cached is None:
+        # El nivel en disco lee un fichero: fuera del event loop
+        if image_cache.disk:
+            cached = await run_in_threadpool(image_cache.get_disk, s3_key)
+        else:
+            cached = image_cache.get_disk(s3_key)
+    if cached is not None:
+        return cached_image_response(request, cached, headers)
+
+    conditions = conditional_params(request)
+
+    # HEAD: solo metadatos, sin descargar el cuerpo
+    if request.method == "HEAD":
+        try:
+            meta = await run_s3(s3.head_object, Bucket=S3_BUCKET_NAME, Key=s3_key, **conditions)
+        except Exception as e:
+            if s3_error_code(e) == "304":
+                return not_modified_response(e)
+            raise image_not_found(e)
+
+        headers.update(validator_headers(meta.get("ETag"), meta.get("LastModified")))
+        headers["Content-Length"] = str(meta["ContentLength"])
+        return Response(
+            status_code=200,
+            media_type=meta.get("ContentType") or "image/png",
+            headers=headers
         )
 
-    buffer.seek(0)
+    params = {"Bucket": S3_BUCKET_NAME, "Key": s3_key, **conditions}
+    generation = image_cache.generation()  # Antes de pedir el objeto (ver ImageCache)
+    byte_range = parse_range_header(request.headers.get("range"))
+    if byte_range:
+        params["Range"] = byte_range
 
-    # --- AÑADIR CABECERAS CORS A LA RESPUESTA DE STREAMING ---
-    headers = {
-        "Access-Control-Allow-Origin": "*",
-        "Access-Control-Allow-Methods": "GET",
-        "Access-Control-Allow-Headers": "*"
-    }
+    try:
+        obj = await run_s3(s3.get_object, **params)
+    except Exception as e:
+        error_code = s3_error_code(e)
+        if error_code == "304":
+            return not_modified_response(e)
+        if error_code == "InvalidRange":
+            # Rango fuera del tamaño del objeto → 416 con el tamaño real
+            try:
+                meta = await run_s3(s3.head_object, Bucket=S3_BUCKET_NAME, Key=s3_key)
+            except Exception as head_error:
+                raise image_not_found(head_error)
+            headers["Content-Range"] = f"bytes */{meta['ContentLength']}"
+            return Response(status_code=416, headers=headers)
+        raise image_not_found(e)
+
+    headers.update(validator_headers(obj.get("ETag"), obj.get("LastModified")))
+    headers["Content-Length"] = str(obj["ContentLength"])
+    status_code = 200
+    if obj.get("ContentRange"):
+        headers["Content-Range"] = obj["ContentRange"]
+        status_code = 206
+
+    # Solo se cachean descargas completas de tamaño razonable
+    cache_key = None
+    cache_meta = None
+    if status_code == 200 and obj["ContentLength"] <= image_cache.max_item_bytes:
+        cache_key = s3_key
+        cache_meta = {
+            "content_length": obj["ContentLength"],
+            "content_type": obj.get("ContentType") or "image/png",
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "generation": generation
+        }
 
     return StreamingResponse(
-        buffer,
-        media_type="image/png",
-        headers=headers # Incluye las cabeceras en la respuesta
+        iter_s3_body(obj["Body"], cache_key=cache_key, cache_meta=cache_meta),
+        status_code=status_code,
+        media_type=obj.get("ContentType") or "image/png",
+        headers=headers
     )
 
 def process_and_integrate_person(
     template_s3_key: str,
-    photo_bytes: bytes,
-    output_s3_key: str
+    output_s3_key: str,
+    upload_key: str,
+    output_format: str = "png",
+    rendition_widths: list[int] | None = None,
+    rendition_format: str = RENDITION_FORMAT
 ):
     """
     Integra una foto del usuario dentro de una plantilla (privada o pública)
@@ -279,18 +1192,24 @@ def process_and_integrate_person(
 
     template_s3_key:  templates/{user_id}/{template_id}.png
                       ó templates/system/{template_id}.png
-    output_s3_key:    {user_id}/{uuid}.png
+    output_s3_key:    {user_id}/{uuid}.{extensión del formato}
+    upload_key:       staging/{uuid}, la foto subida
+    output_format:    formato con el que se creó la clave (RESULT_IMAGE_FORMAT al encolar)
+    rendition_widths: anchos de las miniaturas a generar
+    rendition_format: formato de las miniaturas (RENDITION_FORMAT al encolar)
     """
     try:
-        # 1 Cargar plantilla desde S3
-        frame_obj = s3.get_object(
-            Bucket=S3_BUCKET_NAME,
-            Key=template_s3_key
-        )
-        frame_img = Image.open(frame_obj["Body"]).convert("RGBA")
-
-        # 2 Cargar foto de la persona
-        person_img = load_image_corrected(photo_bytes).convert("RGBA")
+        # 1 Cargar plantilla (decodificada y en caché entre trabajos)
+        frame_img = load_template_frame(template_s3_key)
+
+        # 2 Cargar foto de la persona, decodificada a la resolución de la ventana
+        x0, y0, x1, y1 = window_rect(frame_img.size)
+        with open_staged_upload(upload_key) as photo:
+            person_img = load_image_corrected(
+                photo,
+                target_size=(x1 - x0, y1 - y0),
+                max_pixels=MAX_IMAGE_PIXELS
+            )
 
         # 3 Integrar foto en el marco (VENTANA FIJA)
         final_img = integrate_photo_with_frame(
@@ -299,16 +1218,12 @@ def process_and_integrate_person(
         )
 
         # 4 Guardar resultado en S3
-        buffer = BytesIO()
-        final_img.save(buffer, format="PNG")
-        buffer.seek(0)
-
-        s3.put_object(
-            Bucket=S3_BUCKET_NAME,
-            Key=output_s3_key,
-            Body=buffer,
-            ContentType="image/png",
-            ACL="public-read"
+        upload_encoded(
+            final_img,
+            output_s3_key,
+            output_encoding(output_format, quality=RESULT_IMAGE_QUALITY),
+            rendition_widths,
+            rendition_format
         )
 
         print(f" Image integrated successfully: {output_s3_key}")
@@ -317,6 +1232,18 @@ def process_and_integrate_person(
         print(f" Error integrating frame: {str(e)}")
         raise
 
+def delete_image_objects(record):
+    """Borra de S3 la imagen de un registro y sus miniaturas, y las quita de la caché."""
+    keys = [record.s3_key] + rendition_keys(record)
+    try:
+        s3.delete_objects(
+            Bucket=S3_BUCKET_NAME,
+            Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True}
+        )
+    except Exception as e:
+        print(f"Error deleting from S3: {e}")
+    invalidate_images(keys)
+
 # ==============================
 #  ELIMINAR IMAGEN INTEGRADA (Foto final)
 # ==============================
@@ -335,12 +1262,9 @@ def delete_integrated_image(
     if not image:
         raise HTTPException(status_code=404, detail="Image not found")
 
-    # 2. Borrar de S3
-    try:
-        s3.delete_object(Bucket=S3_BUCKET_NAME, Key=image.s3_key)
-    except Exception as e:
-        print(f"Error deleting from S3: {e}") 
-        # Continuamos para borrar de la BD aunque falle S3
+    # 2. Borrar de S3 (original y miniaturas)
+    # Si falla S3 continuamos para borrar de la BD
+    delete_image_objects(image)
 
     # 3. Borrar de BD
     db.delete(image)
@@ -367,25 +1291,34 @@ def delete_my_template(
     if not template:
         raise HTTPException(status_code=404, detail="Template not found or system protected")
 
-    # 2. Borrar de S3
-    try:
-        s3.delete_object(Bucket=S3_BUCKET_NAME, Key=template.s3_key)
-    except Exception as e:
-        print(f"Error deleting from S3: {e}")
+    # 2. Borrar de S3 (original y miniaturas)
+    delete_image_objects(template)
+    frame_cache.invalidate(template.s3_key)
 
     # 3. Borrar de BD
     db.delete(template)
     db.commit()
+    if template.is_public:
+        catalogue_cache.invalidate()
 
     return {"status": "success", "uuid": template_uuid}
 
 
-def process_and_upload_template(contents: bytes, s3_key: str, user_id: str):
+def process_and_upload_template(
+    s3_key: str,
+    user_id: str,
+    upload_key: str,
+    rendition_widths: list[int] | None = None,
+    rendition_format: str = RENDITION_FORMAT
+):
     try:
-        img = load_image_corrected(contents)
-
-        CANVAS_WIDTH = 1080
-        CANVAS_HEIGHT = 1350
+        # La referencia para Gemini no necesita más resolución que el canvas final
+        with open_staged_upload(upload_key) as reference:
+            img = load_image_corrected(
+                reference,
+                target_size=(CANVAS_WIDTH, CANVAS_HEIGHT),
+                max_pixels=MAX_IMAGE_PIXELS
+            )
 
         prompt = f"""
         You are designing a SOLID PHOTO FRAME TEMPLATE.
@@ -413,7 +1346,7 @@ def process_and_upload_template(contents: bytes, s3_key: str, user_id: str):
         """
 
         #  Generar marco sólido
-        result_img = process_with_gemini(
+        result_img = gemini_gateway.generate_image(
             prompt,
             img
         )
@@ -431,107 +1364,213 @@ def process_and_upload_template(contents: bytes, s3_key: str, user_id: str):
         result_img = apply_fixed_transparent_window(result_img)
 
         #  Guardar
-        buffer = BytesIO()
-        result_img.save(buffer, format="PNG")
-        buffer.seek(0)
-
-        s3.put_object(
-            Bucket=S3_BUCKET_NAME,
-            Key=s3_key,
-            Body=buffer,
-            ContentType="image/png",
-            ACL="public-read"
-        )
+        upload_encoded(result_img, s3_key, TEMPLATE_ENCODING, rendition_widths, rendition_format)
+        frame_cache.invalidate(s3_key)
 
         print(f" Template generated and uploaded: {s3_key}")
 
     except Exception as e:
         print(f" Error generating template: {str(e)}")
+        raise  # El worker decide si se reintenta
 
 
-def ensure_frame_fills_canvas(img: Image.Image, min_coverage=0.9) -> Image.Image:
-    img = img.convert("RGBA")
-    w, h = img.size
-    pixels = img.getdata()
+# Estados en los que el objeto de S3 todavía no existe (lo sube el worker al terminar)
+IN_PROGRESS_STATUSES = ("pending", "processing")
 
-    non_white = sum(
-        1 for r, g, b, a in pixels
-        if a > 10 and not (r > 240 and g > 240 and b > 240)
-    )
 
-    coverage = non_white / (w * h)
+def iter_bucket_keys(prefix: str = ""):
+    """Claves del bucket en orden binario (el de list_objects_v2), página a página."""
+    paginator = s3.get_paginator("list_objects_v2")
+    pages = paginator.paginate(
+        Bucket=S3_BUCKET_NAME,
+        Prefix=prefix,
+        PaginationConfig={"PageSize": 1000}
+    )
+    for page in pages:
+        for obj in page.get("Contents", []):
+            yield obj["Key"]
 
-    # Si el marco ocupa muy poco → escalarlo
-    if coverage < min_coverage:
-        # Crop al área no blanca
-        bbox = img.getbbox()
-        if bbox:
-            cropped = img.crop(bbox)
-            return cropped.resize((w, h), Image.Resampling.LANCZOS)
 
-    return img
+def iter_record_keys(db: Session, model):
+    """
+    (s3_key, modelo, fila) de una tabla, ordenadas como las devuelve S3.
+    Solo se leen las columnas necesarias, en páginas de CLEANUP_BATCH_SIZE por
+    (s3_key, id): no se carga la tabla ni queda un cursor abierto entre commits.
+    """
+    key_column = model.s3_key
+    if db.bind.dialect.name == "postgresql":
+        # Orden byte a byte, como S3 (la collation del servidor puede ignorar '/', '-'...)
+        key_column = key_column.collate("C")
+    last = None
+    while True:
+        query = db.query(model.id, model.s3_key, model.status, model.processing_finished_at)
+        if last is not None:
+            query = query.filter(or_(
+                key_column > last.s3_key,
+                and_(model.s3_key == last.s3_key, model.id > last.id)
+            ))
+        rows = query.order_by(key_column, model.id).limit(CLEANUP_BATCH_SIZE).all()
+        for row in rows:
+            yield row.s3_key, model, row
+        if len(rows) < CLEANUP_BATCH_SIZE:
+            return
+        last = rows[-1]
+
+
+class OrphanRecordDeleter:
+    """Acumula ids de registros huérfanos y los borra por lotes, con un commit por lote."""
+
+    def __init__(self, db: Session, batch_size: int):
+        self.db = db
+        self.batch_size = batch_size
+        self.pending = {models.Template: [], models.TemplateWithImage: []}
+        self.deleted = 0
+        self.skipped_referenced = 0
+
+    def add(self, model, record_id: str):
+        self.pending[model].append(record_id)
+        if len(self.pending[model]) >= self.batch_size:
+            self.flush(model)
+
+    def flush(self, model):
+        ids = self.pending[model]
+        self.pending[model] = []
+        if not ids:
+            return
+        if model is models.Template:
+            # Una plantilla con imágenes que la usan no se puede borrar (FK)
+            referenced = {
+                template_id for (template_id,) in
+                self.db.query(models.TemplateWithImage.template_id)
+                .filter(models.TemplateWithImage.template_id.in_(ids))
+                .distinct()
+            }
+            self.skipped_referenced += len(referenced)
+            ids = [i for i in ids if i not in referenced]
+        if ids:
+            self.db.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+        self.db.commit()
+        self.deleted += len(ids)
+
+    def flush_all(self):
+        # Primero las imágenes: así sus plantillas huérfanas pueden borrarse en la misma pasada
+        self.flush(models.TemplateWithImage)
+        self.flush(models.Template)
+
+
+def reconcile_stale_jobs(db: Session, stale_before: datetime) -> int:
+    """
+    Concilia las filas que siguen "pending"/"processing" desde antes de `stale_before`
+    con el trabajo en Redis. Si el trabajo terminó pero su hook no pudo escribir en la
+    BD, se vuelve a aplicar el estado final; si ya no existe (caducó o se perdió), la
+    fila pasa a "failed". En ambos casos se borra la subida temporal. Los trabajos que
+    siguen vivos en Redis se dejan en paz: la cola los reintenta o los da por perdidos.
+    """
+    stale = []
+    for model in (models.Template, models.TemplateWithImage):
+        is_public = model.is_public if model is models.Template else literal(False)
+        rows = (
+            db.query(model.id, is_public.label("is_public"))
+            .filter(model.status.in_(IN_PROGRESS_STATUSES), model.created_at < stale_before)
+            .order_by(model.created_at)
+            .limit(CLEANUP_BATCH_SIZE)
+            .all()
+        )
+        stale.extend((model, row.id, bool(row.is_public)) for row in rows)
+    # Los hooks abren su propia sesión: no dejar abierta la lectura (SQLite la bloquearía)
+    db.commit()
 
+    reconciled = 0
+    for model, record_id, is_public in stale:
+        try:
+            job = jobs.get_job(record_id)
+            if job is None:
+                on_status = record_job_status(model, staged_upload=not is_public, public_catalogue=is_public)
+                on_status(record_id, jobs.JOB_FAILED, "Job lost before its status was recorded")
+            elif not jobs.replay_status(job):
+                continue  # Sigue en cola o en curso
+            reconciled += 1
+            print(f"Reconciled stale job {record_id}")
+        except Exception as e:
+            print(f"Error reconciling stale job {record_id}: {e}")
+    return reconciled
 
 def perform_s3_cleanup():
     """
     Tarea en segundo plano para encontrar y eliminar registros huérfanos de la BD.
+
+    En lugar de un head_object por registro, recorre el listado del bucket y las
+    claves de ambas tablas a la vez, las dos ordenadas, como en un merge: cada clave
+    de la BD que no aparece en el listado es un huérfano. La memoria no depende del
+    tamaño de las tablas ni del bucket, y los borrados salen por lotes.
+
     Crea su propia sesión de BD para ser segura en hilos.
     """
     db = SessionLocal()
+    started_at = datetime.utcnow()
+    started = time.monotonic()
+    checked = 0
     try:
         print("--- [S3 Cleanup Task Started] ---")
 
-        # 1. Obtener todos los registros de ambas tablas
-        all_templates = db.query(models.Template).all()
-        all_images = db.query(models.TemplateWithImage).all()
-        all_records = all_templates + all_images
+        # Filas que un hook de estado fallido dejó en curso (ver jobs._notify)
+        reconciled = reconcile_stale_jobs(db, started_at - timedelta(seconds=JOB_TIMEOUT_SECONDS))
 
-        print(f"Found {len(all_records)} total records to check in DB.")
-
-        deleted_count = 0
+        records = heapq.merge(
+            iter_record_keys(db, models.Template),
+            iter_record_keys(db, models.TemplateWithImage),
+            key=lambda item: item[0]
+        )
+        bucket_keys = iter_bucket_keys()
+        bucket_key = next(bucket_keys, None)
+        deleter = OrphanRecordDeleter(db, CLEANUP_BATCH_SIZE)
+        skipped_in_progress = 0
+
+        for s3_key, model, row in records:
+            checked += 1
+            # Avanzar el listado hasta la clave actual (o la primera mayor)
+            while bucket_key is not None and bucket_key < s3_key:
+                bucket_key = next(bucket_keys, None)
+            if bucket_key == s3_key:
+                continue
 
-        for record in all_records:
-            if not record.s3_key: # Seguridad por si algún registro tiene clave nula
+            # Sin objeto todavía: trabajos en cola o en curso, o que terminaron
+            # después de empezar el listado (su objeto pudo no salir en él)
+            if row.status in IN_PROGRESS_STATUSES or (
+                row.processing_finished_at and row.processing_finished_at >= started_at
+            ):
+                skipped_in_progress += 1
                 continue
 
-            try:
-                # 2. Usar 'head_object' es la forma más rápida de verificar si existe
-                s3.head_object(Bucket=S3_BUCKET_NAME, Key=record.s3_key)
-
-            except botocore.exceptions.ClientError as e:
-                if e.response['Error']['Code'] == '404':
-                    # 3. Si S3 da 404 (No Encontrado), el objeto no existe. Borrar de la BD.
-                    print(f"Orphaned record found (404): {record.s3_key}. Deleting from DB.")
-                    db.delete(record)
-                    deleted_count += 1
-                else:
-                    # Otro error de S3 (ej. 403 Forbidden)
-                    print(f"S3 error checking {record.s3_key}: {e}")
-            except Exception as e:
-                # Otro error inesperado
-                print(f"Unexpected error checking {record.s3_key}: {e}")
-
-        # 4. Hacer commit de todas las eliminaciones al final
-        if deleted_count > 0:
-            db.commit()
-            print(f"Committed {deleted_count} deletions from database.")
-        else:
-            print("No orphaned records found. DB is clean.")
+            print(f"Orphaned record found: {s3_key}. Deleting from DB.")
+            deleter.add(model, row.id)
+
+        deleter.flush_all()
+        if deleter.deleted:
+            catalogue_cache.invalidate()  # Pudo borrar plantillas públicas
 
+        print(
+            f"Checked {checked} records in {time.monotonic() - started:.1f}s: "
+            f"deleted {deleter.deleted} orphaned records, skipped {skipped_in_progress} in progress "
+            f"and {deleter.skipped_referenced} templates still used by images; "
+            f"reconciled {reconciled} stale jobs."
+        )
         print("--- [S3 Cleanup Task Finished] ---")
 
     except Exception as e:
-        # Error general en la tarea
-        print(f"FATAL ERROR in cleanup task: {e}")
-        db.rollback() # Revertir cualquier cambio si la tarea falla a la mitad
+        # Error general en la tarea (los lotes ya confirmados se quedan borrados)
+        print(f"FATAL ERROR in cleanup task after {checked} records: {e}")
+        db.rollback()
     finally:
         db.close() # MUY importante cerrar la sesión de la base de datos
 
-def generate_and_upload_public_template(prompt_theme: str, s3_key: str):
+def generate_and_upload_public_template(
+    prompt_theme: str,
+    s3_key: str,
+    rendition_widths: list[int] | None = None,
+    rendition_format: str = RENDITION_FORMAT
+):
     try:
-        CANVAS_WIDTH = 1080
-        CANVAS_HEIGHT = 1350
-
         # --- PROMPT DE ALTA CALIDAD (Estilo Cinematográfico) ---
         full_prompt = f"""
         You are a world-class digital artist creating a premium photo frame template.
@@ -560,7 +1599,7 @@ def generate_and_upload_public_template(prompt_theme: str, s3_key: str):
         )
 
         # 1 Generar marco sólido
-        result_img = process_with_gemini(
+        result_img = gemini_gateway.generate_image(
             full_prompt,
             base_image
         )
@@ -578,88 +1617,64 @@ def generate_and_upload_public_template(prompt_theme: str, s3_key: str):
         result_img = apply_fixed_transparent_window(result_img)
 
         # 5 Guardar
-        buffer = BytesIO()
-        result_img.save(buffer, format="PNG")
-        buffer.seek(0)
-
-        s3.put_object(
-            Bucket=S3_BUCKET_NAME,
-            Key=s3_key,
-            Body=buffer,
-            ContentType="image/png",
-            ACL="public-read"
-        )
+        upload_encoded(result_img, s3_key, TEMPLATE_ENCODING, rendition_widths, rendition_format)
+        frame_cache.invalidate(s3_key)
 
         print(f"Public template created: {s3_key}")
 
     except Exception as e:
         print(f"Error generating public template: {str(e)}")
+        raise  # El worker decide si se reintenta
 
 
-def load_image_corrected(bytes_data: bytes) -> Image.Image:
-    img = Image.open(BytesIO(bytes_data))
-    img = ImageOps.exif_transpose(img)
-    return img.convert("RGB")
-
-def integrate_photo_with_frame(frame_img: Image.Image, person_img: Image.Image) -> Image.Image:
-    frame = frame_img.convert("RGBA")
-    person = person_img.convert("RGBA")
-
-    w, h = frame.size
-
-    x0 = FRAME_THICKNESS_X
-    y0 = FRAME_THICKNESS_TOP
-    x1 = w - FRAME_THICKNESS_X
-    y1 = h - FRAME_THICKNESS_BOTTOM
-
-    hole_w = x1 - x0
-    hole_h = y1 - y0
-
-    # scale = min(hole_w / person.width, hole_h / person.height)
-    scale = max(hole_w / person.width, hole_h / person.height)
-    new_w = int(person.width * scale)
-    new_h = int(person.height * scale)
-
-    person_resized = person.resize((new_w, new_h), Image.Resampling.LANCZOS)
-
-    canvas = Image.new("RGBA", (w, h), (0, 0, 0, 0))
-
-    px = x0 + (hole_w - new_w) // 2
-    py = y0 + (hole_h - new_h) // 2
-
-    canvas.paste(person_resized, (px, py), person_resized)
-    canvas.paste(frame, (0, 0), frame)
-
-    return canvas
-
-
-#  CONFIGURACIÓN GLOBAL
-CANVAS_WIDTH = 1080
-CANVAS_HEIGHT = 1350
-
-FRAME_THICKNESS_X = 120
-FRAME_THICKNESS_TOP = 160
-FRAME_THICKNESS_BOTTOM = 200
-
-
-def apply_fixed_transparent_window(frame_img: Image.Image) -> Image.Image:
-    frame = frame_img.convert("RGBA")
-    w, h = frame.size
-
-    x0 = FRAME_THICKNESS_X
-    y0 = FRAME_THICKNESS_TOP
-    x1 = w - FRAME_THICKNESS_X
-    y1 = h - FRAME_THICKNESS_BOTTOM
+# ==============================
+#  TAREAS DEL WORKER (app.worker)
+# ==============================
+def record_job_status(model, staged_upload: bool = False, public_catalogue: bool = False):
+    """
+    Hook de estado que refleja en la fila de `model` cada cambio del trabajo.
+    Con `staged_upload` además borra la subida temporal cuando el trabajo termina,
+    y con `public_catalogue` invalida la caché de /templates/public (el estado sale en ella).
+    """
+    def on_status(job_id: str, status: str, error: str | None):
+        if staged_upload and status in jobs.TERMINAL_STATUSES:
+            discard_staged_upload(staging_key(job_id))
+
+        values = {"processing_error": error}
+        if status == jobs.JOB_PROCESSING:
+            values["status"] = jobs.JOB_PROCESSING
+            values["processing_started_at"] = datetime.utcnow()
+        elif status == jobs.JOB_RETRYING:
+            # Queda pendiente del siguiente intento
+            values["status"] = jobs.JOB_PENDING
+        else:
+            values["status"] = status
+            values["processing_finished_at"] = datetime.utcnow()
 
-    alpha = Image.new("L", (w, h), 255)
+        db = SessionLocal()
+        try:
+            db.query(model).filter(model.id == job_id).update(values)
+            db.commit()
+        finally:
+            db.close()
+        if public_catalogue:
+            catalogue_cache.invalidate()
 
-    transparent_area = Image.new(
-        "L",
-        (x1 - x0, y1 - y0),
-        0
-    )
+    return on_status
 
-    alpha.paste(transparent_area, (x0, y0))
-    frame.putalpha(alpha)
 
-    return frame
+jobs.register_task(
+    "process_and_upload_template",
+    process_and_upload_template,
+    on_status=record_job_status(models.Template, staged_upload=True)
+)
+jobs.register_task(
+    "process_and_integrate_person",
+    process_and_integrate_person,
+    on_status=record_job_status(models.TemplateWithImage, staged_upload=True)
+)
+jobs.register_task(
+    "generate_and_upload_public_template",
+    generate_and_upload_public_template,
+    on_status=record_job_status(models.Template, public_catalogue=True)
+)
@@ -0,0 +1,86 @@
+"""
+Límite de tamaño para las subidas (multipart/form-data).
+
+Starlette ya vuelca cada fichero a un SpooledTemporaryFile (1 MB en memoria y el
+resto en disco), pero no limita cuánto se sube. Este middleware corta la petición
+con 413 en cuanto se supera MAX_UPLOAD_BYTES: directamente por Content-Length o,
+si no viene, contando los bytes según llegan.
+"""
+import json
+
+from app.config import MAX_UPLOAD_BYTES
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class UploadSizeLimitMiddleware:
+    def __init__(self, app, max_bytes: int = MAX_UPLOAD_BYTES):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._is_multipart(scope):
+            await self.app(scope, receive, send)
+            return
+
+        content_length = self._header(scope, b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > self.max_bytes:
+            await self._reject(send)
+            return
+
+        received = 0
+        too_large = False
+        rejected = False
+
+        async def limited_receive():
+            nonlocal received, too_large
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    too_large = True
+                    raise UploadTooLarge()
+            return message
+
+        async def limited_send(message):
+            # FastAPI convierte los errores al leer el formulario en un 400: si el
+            # corte fue por tamaño, esa respuesta se sustituye por el 413
+            nonlocal rejected
+            if not too_large:
+                await send(message)
+            elif not rejected:
+                rejected = True
+                await self._reject(send)
+
+        try:
+            await self.app(scope, limited_receive, limited_send)
+        except UploadTooLarge:
+            pass
+        if too_large and not rejected:
+            await self._reject(send)
+
+    @staticmethod
+    def _header(scope, name: bytes) -> str | None:
+        for key, value in scope.get("headers", []):
+            if key == name:
+                return value.decode("latin-1")
+        return None
+
+    def _is_multipart(self, scope) -> bool:
+        content_type = self._header(scope, b"content-type") or ""
+        return content_type.startswith("multipart/form-data")
+
+    async def _reject(self, send):
+        body = json.dumps({"detail": f"Upload too large (max {self.max_bytes} bytes)"}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("latin-1")),
+                (b"connection", b"close"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,147 @@
+"""
+Caché de usuarios autenticados para get_current_user.
+
+Cada petición autenticada buscaba su usuario en la BD aunque el JWT ya estuviera
+verificado. Ahora hay una LRU por worker con caducidad corta (USER_CACHE_TTL_SECONDS)
+y, opcionalmente (USER_CACHE_REDIS), un segundo nivel en Redis compartido entre workers.
+
+Se guarda una copia inmutable (CachedUser) con los campos públicos del usuario,
+nunca el hash de la contraseña ni un objeto del ORM ligado a una sesión.
+
+Los cambios hechos con la sesión del ORM (update/delete de un User) invalidan la
+entrada al hacer commit. Los demás workers pueden servir la copia anterior como
+mucho USER_CACHE_TTL_SECONDS. Un update masivo (query(...).update()) no pasa por
+la sesión: hay que llamar a invalidate() a mano.
+"""
+import json
+import threading
+from typing import NamedTuple, Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app import models
+from app.config import USER_CACHE_TTL_SECONDS, USER_CACHE_MAX_ENTRIES, USER_CACHE_REDIS, USER_CACHE_REDIS_TTL
+from app.image_cache import ByteLRU
+from app.redis_client import redis_client
+
+REDIS_KEY_PREFIX = "totem:user"
+
+
+class CachedUser(NamedTuple):
+    id: str
+    email: str
+    full_name: Optional[str]
+    is_active: bool
+    is_google: bool
+
+
+def snapshot(user: models.User) -> CachedUser:
+    return CachedUser(
+        id=user.id,
+        email=user.email,
+        full_name=user.full_name,
+        is_active=bool(user.is_active) if user.is_active is not None else True,
+        is_google=bool(user.is_google)
+    )
+
+
+class UserCache:
+    def __init__(self, max_entries: int, ttl: float, use_redis: bool = False, redis_ttl: int = 300):
+        # Cada entrada cuenta como 1: el límite de "bytes" es el número de usuarios
+        self._lru = ByteLRU(max_entries, ttl=ttl)
+        self.use_redis = use_redis
+        self.redis_ttl = redis_ttl
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    def _count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, user_id: str) -> CachedUser | None:
+        user = self._lru.get(user_id)
+        if user is not None:
+            self._count("hits")
+            return user
+
+        if self.use_redis:
+            try:
+                raw = redis_client.get(f"{REDIS_KEY_PREFIX}:{user_id}")
+            except Exception as e:
+                print(f"User cache: Redis error reading {user_id}: {e}")
+                raw = None
+            if raw:
+                user = CachedUser(**json.loads(raw))
+                self._lru.set(user_id, user, 1)
+                self._count("redis_hits")
+                return user
+
+        self._count("misses")
+        return None
+
+    def set(self, user: models.User) -> CachedUser:
+        cached = snapshot(user)
+        self._lru.set(cached.id, cached, 1)
+        if self.use_redis:
+            try:
+                redis_client.set(f"{REDIS_KEY_PREFIX}:{cached.id}", json.dumps(cached._asdict()), ex=self.redis_ttl)
+            except Exception as e:
+                print(f"User cache: Redis error storing {cached.id}: {e}")
+        return cached
+
+    def invalidate(self, user_id: str):
+        self._lru.pop(user_id)
+        if self.use_redis:
+            try:
+                redis_client.delete(f"{REDIS_KEY_PREFIX}:{user_id}")
+            except Exception as e:
+                print(f"User cache: Redis error invalidating {user_id}: {e}")
+
+    def stats(self) -> dict:
+        lru = self._lru.stats()
+        lookups = self.hits + self.redis_hits + self.misses
+        return {
+            "entries": lru["entries"],
+            "max_entries": lru["max_bytes"],
+            "evictions": lru["evictions"],
+            "hits": self.hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.redis_hits) / lookups, 3) if lookups else 0.0,
+            "redis_tier": self.use_redis,
+        }
+
+
+user_cache = UserCache(
+    USER_CACHE_MAX_ENTRIES,
+    ttl=USER_CACHE_TTL_SECONDS,
+    use_redis=USER_CACHE_REDIS,
+    redis_ttl=USER_CACHE_REDIS_TTL
+)
+
+
+# ============================================================
+#  INVALIDACIÓN AL CAMBIAR UN USUARIO
+# ============================================================
+# Los ids se recogen al hacer flush (dirty/deleted aún reflejan lo que se escribió)
+# y se invalidan tras el commit: antes, otra petición podría volver a cachear el
+# valor anterior, que sigue siendo el confirmado en la BD.
+@event.listens_for(Session, "after_flush")
+def _collect_changed_users(session, flush_context):
+    changed = {obj.id for obj in (*session.dirty, *session.deleted) if isinstance(obj, models.User)}
+    if changed:
+        session.info.setdefault("changed_user_ids", set()).update(changed)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_changed_users(session):
+    for user_id in session.info.pop("changed_user_ids", ()):
+        user_cache.invalidate(user_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_changed_users(session):
+    session.info.pop("changed_user_ids", None)
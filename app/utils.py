@@ -1,24 +1,50 @@
 from app import models
 from app.db import get_db
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from sqlalchemy.orm import Session
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
-from google import genai
-from google.genai import types
+import threading
 from PIL import Image
 from io import BytesIO
-from app.config import SECRET_KEY, ACCESS_TOKEN_EXPIRE_MINUTES, REFRESH_TOKEN_EXPIRE_DAYS, GEMINI_API_KEY
+from app.config import SECRET_KEY, ACCESS_TOKEN_EXPIRE_MINUTES, REFRESH_TOKEN_EXPIRE_DAYS, GEMINI_API_KEY, GEMINI_MODEL, GEMINI_TIMEOUT_SECONDS
+from app.config import PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_QUEUE, PASSWORD_HASH_RETRY_AFTER_SECONDS
+from app.executors import MeteredExecutor, ExecutorSaturatedError
 import jwt
+from app.user_cache import user_cache
 
-client = genai.Client(api_key=GEMINI_API_KEY)
+# google-genai tarda más en importarse que el resto de la app junta y solo lo usa
+# el worker: el cliente se crea (e importa) en la primera llamada a Gemini
+_genai_client = None
+_genai_client_lock = threading.Lock()
+
+
+def get_genai_client():
+    global _genai_client
+    if _genai_client is None:
+        with _genai_client_lock:
+            if _genai_client is None:
+                from google import genai
+                from google.genai import types
+
+                _genai_client = genai.Client(
+                    api_key=GEMINI_API_KEY,
+                    http_options=types.HttpOptions(timeout=int(GEMINI_TIMEOUT_SECONDS * 1000))  # milisegundos
+                )
+    return _genai_client
 
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# bcrypt (~250 ms de CPU por llamada) corre en su propio executor: una ráfaga de
+# logins no ocupa el threadpool de las demás rutas. bcrypt libera el GIL, así que
+# los hilos trabajan en paralelo. Con la cola llena se responde 503.
+password_executor = MeteredExecutor(PASSWORD_HASH_WORKERS, "bcrypt", max_queue=PASSWORD_HASH_MAX_QUEUE)
+
 def hash_password(password: str) -> str:
     # bcrypt solo acepta hasta 72 bytes
     password = password.encode("utf-8")[:72].decode("utf-8", "ignore")
@@ -27,6 +53,22 @@ def hash_password(password: str) -> str:
 def verify_password(plain: str, hashed: str) -> bool:
     return pwd_context.verify(plain, hashed)
 
+async def run_password_hashing(fn, *args):
+    try:
+        return await password_executor.run(fn, *args)
+    except ExecutorSaturatedError:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server busy, try again in a few seconds",
+            headers={"Retry-After": str(PASSWORD_HASH_RETRY_AFTER_SECONDS)}
+        )
+
+async def hash_password_async(password: str) -> str:
+    return await run_password_hashing(hash_password, password)
+
+async def verify_password_async(plain: str, hashed: str) -> bool:
+    return await run_password_hashing(verify_password, plain, hashed)
+
 def create_access_token(data: dict, expires_delta: int | None = None):
     to_encode = data.copy()
     expire = datetime.utcnow() + (timedelta(minutes=expires_delta) if expires_delta else timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
@@ -48,13 +90,17 @@ def decode_token(token: str):
     except Exception:
         return None
 
+class GeminiNoImageError(ValueError):
+    """Gemini respondió, pero sin imagen (no es una caída del servicio)."""
+
+
 def process_with_gemini(prompt: str, base_image: Image.Image, other_image: Image.Image = None):
     contents = [prompt, base_image]
     if other_image:
         contents.append(other_image)
 
-    response = client.models.generate_content(
-        model="gemini-2.5-flash-image",
+    response = get_genai_client().models.generate_content(
+        model=GEMINI_MODEL,
         contents=contents,
     )
 
@@ -65,16 +111,44 @@ def process_with_gemini(prompt: str, base_image: Image.Image, other_image: Image
     ]
 
     if not image_parts:
-        raise ValueError("Gemini did not return an image")
+        raise GeminiNoImageError("Gemini did not return an image")
 
     return Image.open(BytesIO(image_parts[0]))
 
 def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
-    token = credentials.credentials
+    return get_user_from_token(credentials.credentials, db)
+
+def get_current_user_or_query_token(
+    request: Request,
+    credentials: HTTPAuthorizationCredentials | None = Depends(optional_security),
+    db: Session = Depends(get_db)
+):
+    """Como get_current_user, pero acepta también ?access_token= (EventSource no permite cabeceras)."""
+    token = credentials.credentials if credentials else request.query_params.get("access_token")
+    if not token:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
+    return get_user_from_token(token, db)
+
+def get_current_user_id(credentials: HTTPAuthorizationCredentials = Depends(security)) -> str:
+    """
+    Solo el id del usuario, sacado del JWT ya verificado (sin consultar la BD).
+    Para rutas que únicamente filtran por el usuario.
+    """
+    return user_id_from_token(credentials.credentials)
+
+def user_id_from_token(token: str) -> str:
     data = decode_token(token)
-    if not data or data.get("type") != "access":
+    if not data or data.get("type") != "access" or not data.get("sub"):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
-    user = db.query(models.User).filter(models.User.id == data.get("sub")).first()
+    return str(data["sub"])
+
+def get_user_from_token(token: str, db: Session):
+    """Usuario del token (copia de solo lectura, servida desde user_cache si está)."""
+    user_id = user_id_from_token(token)
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+    user = db.query(models.User).filter(models.User.id == user_id).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    return user
+    return user_cache.set(user)
@@ -0,0 +1,10 @@
+"""
+Proceso worker: ejecuta los trabajos encolados en Redis por la API.
+
+    python -m app.worker
+"""
+from app import templates_routes  # noqa: F401 - registra las tareas de procesamiento
+from app.jobs import run_worker
+
+if __name__ == "__main__":
+    run_worker()
@@ -0,0 +1,119 @@
+"""
+Benchmark del arranque de un worker: tiempo de `import app.main` con los clientes
+perezosos (S3, Gemini, OAuth) frente a construirlos todos al arrancar, como se
+hacía antes. Cada medida es un intérprete nuevo (sin módulos ya cargados).
+Muestra también lo que cuesta cada cliente en su primer uso y los módulos de la
+app que más tardan en importarse.
+
+    python -m benchmarks.bench_boot
+
+No conecta con la base de datos ni con S3 (crear un cliente no hace peticiones);
+el create_all que se hacía al importar tampoco se mide.
+"""
+import json
+import statistics
+import subprocess
+import sys
+
+from tabulate import tabulate
+
+REPEAT = 5
+TOP_MODULES = 12
+
+BOOT_SCRIPT = """
+import json, resource, sys, time
+start = time.perf_counter()
+import app.main
+elapsed = time.perf_counter() - start
+if EAGER:
+    from app import auth, storage, utils
+    storage.s3.get()
+    storage.s3_public.get()
+    utils.get_genai_client()
+    auth.get_oauth()
+    elapsed = time.perf_counter() - start
+print(json.dumps({
+    "seconds": elapsed,
+    "rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "modules": len(sys.modules),
+}))
+"""
+
+FIRST_USE_SCRIPT = """
+import json, time
+import app.main
+from app import auth, storage, utils
+timings = {}
+for name, build in (
+    ("S3 (boto3)", storage.s3.get),
+    ("Gemini (google-genai)", utils.get_genai_client),
+    ("Google OAuth (authlib)", auth.get_oauth),
+):
+    start = time.perf_counter()
+    build()
+    timings[name] = time.perf_counter() - start
+print(json.dumps(timings))
+"""
+
+
+def run_python(script, *flags):
+    result = subprocess.run(
+        [sys.executable, *flags, "-c", script],
+        capture_output=True, text=True, check=True
+    )
+    return result
+
+
+def measure_boot(eager):
+    script = f"EAGER = {eager}\n{BOOT_SCRIPT}"
+    runs = [json.loads(run_python(script).stdout.strip().splitlines()[-1]) for _ in range(REPEAT)]
+    seconds = [run["seconds"] for run in runs]
+    return [
+        "eager (before)" if eager else "lazy (now)",
+        f"{statistics.median(seconds) * 1000:.0f}",
+        f"{min(seconds) * 1000:.0f}",
+        f"{statistics.median(run['rss_kb'] for run in runs) / 1024:.0f}",
+        runs[0]["modules"],
+    ]
+
+
+def slowest_app_modules():
+    # -X importtime escribe en stderr: "import time: self | cumulative | module"
+    stderr = run_python("import app.main", "-X", "importtime").stderr
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        name = name.strip()
+        if name.startswith("app."):
+            modules.append((int(cumulative), name))
+    modules.sort(reverse=True)
+    return [[name, f"{cumulative / 1000:.0f}"] for cumulative, name in modules[:TOP_MODULES]]
+
+
+def main():
+    print(tabulate(
+        [measure_boot(eager=False), measure_boot(eager=True)],
+        headers=["boot", "median ms", "min ms", "peak RSS MB", "modules loaded"],
+        tablefmt="fancy_grid"
+    ))
+
+    first_use = json.loads(run_python(FIRST_USE_SCRIPT).stdout.strip().splitlines()[-1])
+    print(tabulate(
+        [[name, f"{seconds * 1000:.0f}"] for name, seconds in first_use.items()],
+        headers=["client (first use)", "ms"],
+        tablefmt="fancy_grid"
+    ))
+
+    print(tabulate(
+        slowest_app_modules(),
+        headers=["module (import app.main)", "cumulative ms"],
+        tablefmt="fancy_grid"
+    ))
+
+
+if __name__ == "__main__":
+    main()
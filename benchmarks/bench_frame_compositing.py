@@ -0,0 +1,113 @@
+"""
+Benchmark de apply_fixed_transparent_window e integrate_photo_with_frame:
+implementación anterior frente a la actual (máscara cacheada y composición
+sin mezclas alfa innecesarias). Cuenta también las imágenes que reserva Pillow.
+
+    python -m benchmarks.bench_frame_compositing
+"""
+import os
+import time
+
+from PIL import Image
+from tabulate import tabulate
+
+from app.imaging import (
+    CANVAS_WIDTH,
+    CANVAS_HEIGHT,
+    FRAME_THICKNESS_X,
+    FRAME_THICKNESS_TOP,
+    FRAME_THICKNESS_BOTTOM,
+    apply_fixed_transparent_window,
+    integrate_photo_with_frame
+)
+
+REPEAT = 5
+
+
+def legacy_apply_fixed_transparent_window(frame_img):
+    frame = frame_img.convert("RGBA")
+    w, h = frame.size
+    x0, y0 = FRAME_THICKNESS_X, FRAME_THICKNESS_TOP
+    x1, y1 = w - FRAME_THICKNESS_X, h - FRAME_THICKNESS_BOTTOM
+    alpha = Image.new("L", (w, h), 255)
+    alpha.paste(Image.new("L", (x1 - x0, y1 - y0), 0), (x0, y0))
+    frame.putalpha(alpha)
+    return frame
+
+
+def legacy_integrate_photo_with_frame(frame_img, person_img):
+    frame = frame_img.convert("RGBA")
+    person = person_img.convert("RGBA")
+    w, h = frame.size
+    x0, y0 = FRAME_THICKNESS_X, FRAME_THICKNESS_TOP
+    x1, y1 = w - FRAME_THICKNESS_X, h - FRAME_THICKNESS_BOTTOM
+    hole_w, hole_h = x1 - x0, y1 - y0
+    scale = max(hole_w / person.width, hole_h / person.height)
+    new_w, new_h = int(person.width * scale), int(person.height * scale)
+    person_resized = person.resize((new_w, new_h), Image.Resampling.LANCZOS)
+    canvas = Image.new("RGBA", (w, h), (0, 0, 0, 0))
+    px, py = x0 + (hole_w - new_w) // 2, y0 + (hole_h - new_h) // 2
+    canvas.paste(person_resized, (px, py), person_resized)
+    canvas.paste(frame, (0, 0), frame)
+    return canvas
+
+
+def noise(mode, size):
+    bands = len(mode)
+    return Image.frombytes(mode, size, os.urandom(size[0] * size[1] * bands))
+
+
+def measure(fn, *args):
+    """Mejor tiempo de REPEAT ejecuciones e imágenes reservadas por Pillow en una."""
+    best = float("inf")
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    Image.core.reset_stats()
+    fn(*args)
+    return best, Image.core.get_stats()["new_count"], result
+
+
+def main():
+    canvas_size = (CANVAS_WIDTH, CANVAS_HEIGHT)
+    raw_frame = noise("RGB", canvas_size)
+    frame = legacy_apply_fixed_transparent_window(raw_frame)
+
+    # Marco con alfa propio (no estándar): fuerza el camino general
+    custom_frame = frame.copy()
+    custom_frame.putalpha(noise("L", canvas_size))
+
+    photo = noise("RGB", (1200, 1600))
+    photo_alpha = noise("RGBA", (1200, 1600))
+
+    cases = [
+        ("apply_fixed_transparent_window", legacy_apply_fixed_transparent_window, apply_fixed_transparent_window, (raw_frame,)),
+        ("integrate (standard frame, RGB photo)", legacy_integrate_photo_with_frame, integrate_photo_with_frame, (frame, photo)),
+        ("integrate (custom alpha frame)", legacy_integrate_photo_with_frame, integrate_photo_with_frame, (custom_frame, photo)),
+        ("integrate (RGBA photo with alpha)", legacy_integrate_photo_with_frame, integrate_photo_with_frame, (frame, photo_alpha)),
+    ]
+
+    rows = []
+    for label, legacy_fn, new_fn, args in cases:
+        legacy_time, legacy_images, expected = measure(legacy_fn, *args)
+        new_time, new_images, result = measure(new_fn, *args)
+        assert result.tobytes() == expected.tobytes(), f"{label}: output differs"
+        rows.append([
+            label,
+            f"{legacy_time * 1000:.1f}",
+            f"{new_time * 1000:.1f}",
+            f"{legacy_time / new_time:.1f}x",
+            legacy_images,
+            new_images,
+        ])
+
+    print(tabulate(
+        rows,
+        headers=["case", "before ms", "after ms", "speedup", "images before", "images after"],
+        tablefmt="fancy_grid"
+    ))
+
+
+if __name__ == "__main__":
+    main()
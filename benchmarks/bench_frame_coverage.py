@@ -0,0 +1,107 @@
+"""
+Benchmark de ensure_frame_fills_canvas: recorrido píxel a píxel en Python
+(implementación anterior) frente a máscaras de Pillow (app.imaging.frame_coverage).
+
+    python -m benchmarks.bench_frame_coverage
+"""
+import os
+import time
+import warnings
+
+from PIL import Image, ImageDraw
+from tabulate import tabulate
+
+from app.imaging import ensure_frame_fills_canvas, frame_coverage
+
+SIZES = {
+    "typical 1080x1350": (1080, 1350),
+    "4K 2160x3840": (2160, 3840),
+}
+REPEAT = 3
+
+# getdata() está obsoleto en Pillow recientes; aquí solo reproduce el código anterior
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+
+def legacy_coverage(img: Image.Image) -> float:
+    """Implementación anterior: un generador de Python sobre getdata()."""
+    img = img.convert("RGBA")
+    w, h = img.size
+    non_white = sum(
+        1 for r, g, b, a in img.getdata()
+        if a > 10 and not (r > 240 and g > 240 and b > 240)
+    )
+    return non_white / (w * h)
+
+
+def legacy_ensure_frame_fills_canvas(img: Image.Image, min_coverage=0.9) -> Image.Image:
+    img = img.convert("RGBA")
+    w, h = img.size
+    if legacy_coverage(img) < min_coverage:
+        bbox = img.getbbox()
+        if bbox:
+            return img.crop(bbox).resize((w, h), Image.Resampling.LANCZOS)
+    return img
+
+
+def make_frame(size):
+    """Marco tipo Gemini: borde con ruido de color y centro blanco."""
+    w, h = size
+    img = Image.frombytes("RGBA", size, os.urandom(w * h * 4))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((w // 8, h // 8, w - w // 8, h - h // 8), fill=(255, 255, 255, 255))
+    return img
+
+
+def make_small_frame(size):
+    """Marco pequeño y centrado sobre blanco: fuerza el crop + resize."""
+    w, h = size
+    img = Image.new("RGBA", size, (255, 255, 255, 255))
+    inner = make_frame((w // 2, h // 2))
+    img.paste(inner, (w // 4, h // 4))
+    return img
+
+
+def best_of(fn, *args):
+    best = float("inf")
+    result = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    rows = []
+    for label, size in SIZES.items():
+        for kind, factory in (("full frame", make_frame), ("small frame", make_small_frame)):
+            img = factory(size)
+            legacy_time, legacy = best_of(legacy_coverage, img)
+            new_time, new = best_of(frame_coverage, img)
+            assert legacy == new, f"coverage mismatch: {legacy} != {new}"
+
+            # La decisión y el crop deben ser idénticos a los de la versión anterior
+            expected = legacy_ensure_frame_fills_canvas(img)
+            assert ensure_frame_fills_canvas(img).tobytes() == expected.tobytes()
+
+            full_time, _ = best_of(ensure_frame_fills_canvas, img)
+            rows.append([
+                label,
+                kind,
+                f"{legacy:.4f}",
+                f"{legacy_time * 1000:.1f}",
+                f"{new_time * 1000:.1f}",
+                f"{legacy_time / new_time:.0f}x",
+                f"{full_time * 1000:.1f}",
+            ])
+
+    print(tabulate(
+        rows,
+        headers=["size", "image", "coverage", "python ms", "pillow ms", "speedup", "ensure_frame_fills_canvas ms"],
+        tablefmt="fancy_grid"
+    ))
+
+
+if __name__ == "__main__":
+    main()
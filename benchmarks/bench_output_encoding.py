@@ -0,0 +1,114 @@
+"""
+Benchmark de codificación de los resultados: tiempo de encode y bytes servidos
+para una foto integrada (opaca) y una plantilla (con ventana transparente),
+con el PNG por defecto anterior frente a los formatos configurables.
+
+    python -m benchmarks.bench_output_encoding
+"""
+import random
+import time
+from io import BytesIO
+
+from PIL import Image, ImageDraw, ImageFilter
+from tabulate import tabulate
+
+from app.imaging import (
+    CANVAS_WIDTH,
+    CANVAS_HEIGHT,
+    apply_fixed_transparent_window,
+    integrate_photo_with_frame,
+    output_encoding,
+    encode_image
+)
+
+REPEAT = 3
+
+
+def synthetic_picture(size, seed):
+    """Imagen con degradados, formas suaves y algo de grano, parecida a una foto real."""
+    rng = random.Random(seed)
+    w, h = size
+    img = Image.linear_gradient("L").resize(size).convert("RGB")
+    img = Image.merge("RGB", [
+        img.getchannel(0).point(lambda v, k=k: (v * k) % 256)
+        for k in (1, 2, 3)
+    ])
+    draw = ImageDraw.Draw(img)
+    for _ in range(60):
+        x, y = rng.randrange(w), rng.randrange(h)
+        r = rng.randrange(20, w // 4)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=color)
+    img = img.filter(ImageFilter.GaussianBlur(6))
+    grain = Image.effect_noise(size, 12).convert("RGB")
+    return Image.blend(img, grain, 0.08)
+
+
+def legacy_encode(img):
+    buffer = BytesIO()
+    img.save(buffer, format="PNG")
+    buffer.seek(0)
+    return buffer
+
+
+def measure(img, encoding):
+    best = float("inf")
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        buffer = legacy_encode(img) if encoding is None else encode_image(img, encoding)
+        best = min(best, time.perf_counter() - start)
+    return best, buffer.getbuffer().nbytes
+
+
+def main():
+    canvas_size = (CANVAS_WIDTH, CANVAS_HEIGHT)
+    template = apply_fixed_transparent_window(synthetic_picture(canvas_size, seed=1))
+    composite = integrate_photo_with_frame(template, synthetic_picture((1200, 1600), seed=2))
+
+    # La primera fila de cada imagen es lo que se hacía antes: save(format="PNG") en RGBA
+    cases = [
+        ("composite", composite, "PNG (before)", None),
+        ("composite", composite, "PNG level 6, RGB", output_encoding("png")),
+        ("composite", composite, "JPEG q85", output_encoding("jpeg", quality=85)),
+        ("composite", composite, "WebP q85", output_encoding("webp", quality=85)),
+        ("composite", composite, "WebP q75", output_encoding("webp", quality=75)),
+    ]
+    if _has_avif():
+        cases.append(("composite", composite, "AVIF q60", output_encoding("avif", quality=60)))
+    cases += [
+        ("template", template, "PNG (before)", None),
+        ("template", template, "PNG level 3", output_encoding("png", compress_level=3)),
+        ("template", template, "PNG level 1", output_encoding("png", compress_level=1)),
+    ]
+
+    rows = []
+    baselines = {}
+    for kind, img, label, encoding in cases:
+        seconds, size = measure(img, encoding)
+        baseline = baselines.setdefault(kind, (seconds, size))
+        rows.append([
+            kind,
+            label,
+            f"{seconds * 1000:.0f}",
+            f"{size / 1024:.0f}",
+            f"{size / baseline[1] * 100:.0f}%",
+            f"{baseline[0] / seconds:.1f}x",
+        ])
+
+    print(tabulate(
+        rows,
+        headers=["image", "encoding", "encode ms", "KiB", "size vs before", "speedup"],
+        tablefmt="fancy_grid"
+    ))
+
+
+def _has_avif():
+    try:
+        output_encoding("avif")
+    except ValueError:
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Benchmark de carga de fotos para la integración: decodificación completa (versión
+anterior) frente a load_image_corrected con target_size (draft/reduce previos).
+
+Cada medida se hace en un proceso nuevo para poder comparar el pico de memoria (RSS).
+
+    python -m benchmarks.bench_photo_loading
+"""
+import multiprocessing
+import resource
+import time
+from io import BytesIO
+
+from PIL import Image, ImageChops, ImageOps, ImageStat
+from tabulate import tabulate
+
+from app.imaging import CANVAS_WIDTH, CANVAS_HEIGHT, load_image_corrected, window_rect
+
+PHOTOS = {
+    "12 MP (4000x3000)": (4000, 3000),
+    "48 MP (8000x6000)": (8000, 6000),
+}
+REPEAT = 3
+
+
+def make_phone_jpeg(size) -> bytes:
+    """JPEG apaisado con orientación EXIF 6 (móvil en vertical), como los de las cámaras."""
+    w, h = size
+    img = Image.linear_gradient("L").resize(size).convert("RGB")
+    img = Image.merge("RGB", (img.getchannel(0), img.rotate(90).resize(size).getchannel(0), Image.new("L", size, 128)))
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    buffer = BytesIO()
+    img.save(buffer, format="JPEG", quality=90, exif=exif)
+    return buffer.getvalue()
+
+
+def cover_resize(img, target):
+    scale = max(target[0] / img.width, target[1] / img.height)
+    return img.resize((int(img.width * scale), int(img.height * scale)), Image.Resampling.LANCZOS)
+
+
+def legacy_load(data, target):
+    img = Image.open(BytesIO(data))
+    img = ImageOps.exif_transpose(img)
+    return cover_resize(img.convert("RGB"), target)
+
+
+def new_load(data, target):
+    return cover_resize(load_image_corrected(data, target_size=target), target)
+
+
+def peak_rss_kb() -> int:
+    """VmHWM de Linux (se reinicia en cada proceso); ru_maxrss como alternativa."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run(variant, data, target, queue):
+    fn = legacy_load if variant == "legacy" else new_load
+    best = float("inf")
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        result = fn(data, target)
+        best = min(best, time.perf_counter() - start)
+    peak_kb = peak_rss_kb()
+    queue.put((best, peak_kb, result.size, result.tobytes()))
+
+
+def measure(variant, data, target):
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=run, args=(variant, data, target, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    x0, y0, x1, y1 = window_rect((CANVAS_WIDTH, CANVAS_HEIGHT))
+    target = (x1 - x0, y1 - y0)
+
+    rows = []
+    for label, size in PHOTOS.items():
+        data = make_phone_jpeg(size)
+        legacy_time, legacy_rss, legacy_size, legacy_bytes = measure("legacy", data, target)
+        new_time, new_rss, new_size, new_bytes = measure("new", data, target)
+
+        # Diferencia media por canal (0-255) entre ambos resultados
+        diff = ImageChops.difference(
+            Image.frombytes("RGB", legacy_size, legacy_bytes),
+            Image.frombytes("RGB", new_size, new_bytes).resize(legacy_size)
+        )
+        mean_diff = sum(ImageStat.Stat(diff).mean) / 3
+
+        rows.append([
+            label,
+            f"{legacy_time * 1000:.0f}",
+            f"{new_time * 1000:.0f}",
+            f"{legacy_time / new_time:.1f}x",
+            f"{legacy_rss / 1024:.0f}",
+            f"{new_rss / 1024:.0f}",
+            f"{mean_diff:.2f}",
+        ])
+
+    print(f"Target window: {target[0]}x{target[1]}")
+    print(tabulate(
+        rows,
+        headers=["photo", "before ms", "after ms", "speedup", "peak RSS before MB", "peak RSS after MB", "mean abs diff"],
+        tablefmt="fancy_grid"
+    ))
+
+
+if __name__ == "__main__":
+    main()